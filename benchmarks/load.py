@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load generator for Flask-Email.
+
+Sends messages through a backend obtained from ``get_connection()`` from
+several threads, each with its own connection, and reports the
+throughput, the latency of the ``send_messages`` calls, and how many
+messages were sent, deferred (temporary errors), refused (permanent
+errors) or failed (exceptions, e.g. disconnects)::
+
+    python benchmarks/load.py -b smtp -n 5000 -c 8 --latency 0.01 --temp-errors 0.02
+    python benchmarks/load.py -b mailgun -n 1000 -c 4 --rate 200
+
+By default the messages are sent to the sinks of ``benchmarks/sink.py``
+started in-process with the given faults. With ``--host`` and ``--port``
+(SMTP) or ``--api-url`` (REST), they are sent to a sink running on its
+own, or to any server that is safe to load.
+"""
+from __future__ import with_statement
+
+import json
+import os
+import Queue
+import sys
+import threading
+import time
+from optparse import OptionParser
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+
+import flask_email
+from flask_email import get_connection
+from flask_email.message import EmailMessage
+
+from sink import add_fault_options, get_faults, start_sinks
+
+API_KEY = 'key-sink'
+DOMAIN = 'sink.example.com'
+
+BACKENDS = {
+    'smtp': 'flask_email.backends.smtp.Mail',
+    'rest': 'flask_email.backends.rest.Mail',
+    'mailgun': 'flask_email.contrib.mailgun.rest.Mail',
+}
+
+OUTCOMES = ('sent', 'deferred', 'refused', 'failed')
+
+
+def get_backend_options(backend, host, port, api_url):
+    """Returns the keyword arguments of the connections to a backend."""
+    if backend == 'smtp':
+        return {'host': host, 'port': port}
+    if backend == 'mailgun':
+        return {'api_key': API_KEY, 'mailgun_domain': DOMAIN, 'api_url': api_url}
+    if backend == 'rest':
+        return {'endpoint': '%s/%s/messages' % (api_url, DOMAIN)}
+    return {}
+
+
+def make_batches(count, batch_size, size, recipients):
+    """Returns the batches of messages to send."""
+    body = ('x' * 75 + '\n') * (size // 76 + 1)
+    messages = [EmailMessage('Load %d' % i, body[:size], 'from@example.com',
+                             ['to%d@example.com' % j for j in range(recipients)])
+                for i in range(count)]
+    return [messages[i:i + batch_size] for i in range(0, count, batch_size)]
+
+
+def get_outcome(result):
+    if result.error is not None:
+        return 'failed'
+    if result.deferred:
+        return 'deferred'
+    if result.refused:
+        return 'refused'
+    return 'sent'
+
+
+def work(app, path, options, batches, latencies, outcomes, lock):
+    """
+    Sends the batches taken from the queue over one connection, opened
+    again after errors.
+    """
+    with app.app_context():
+        connection = get_connection(path, fail_silently=True, return_results=True, **options)
+        connection.open()
+        try:
+            while True:
+                try:
+                    batch = batches.get_nowait()
+                except Queue.Empty:
+                    return
+                start = default_timer()
+                results = connection.send_messages(batch)
+                elapsed = default_timer() - start
+                if isinstance(results, list):
+                    batch_outcomes = [get_outcome(result) for result in results]
+                else:
+                    # Backends without results only count the messages sent.
+                    sent = results or 0
+                    batch_outcomes = ['sent'] * sent + ['failed'] * (len(batch) - sent)
+                with lock:
+                    latencies.append(elapsed)
+                    for outcome in batch_outcomes:
+                        outcomes[outcome] += 1
+                if 'failed' in batch_outcomes:
+                    connection.close()
+                    connection.open()
+        finally:
+            connection.close()
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(app, path, options, batches, concurrency):
+    """
+    Sends the batches from concurrency threads. Returns the elapsed time,
+    the sorted latencies of the calls, and the count of each outcome.
+    """
+    queue = Queue.Queue()
+    for batch in batches:
+        queue.put(batch)
+    latencies = []
+    outcomes = dict.fromkeys(OUTCOMES, 0)
+    lock = threading.Lock()
+    threads = [threading.Thread(target=work, args=(app, path, options, queue, latencies,
+                                                   outcomes, lock))
+               for i in range(concurrency)]
+    start = default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = default_timer() - start
+    latencies.sort()
+    return elapsed, latencies, outcomes
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-b', '--backend', default='smtp',
+                      help='smtp, rest, mailgun or the path of a backend [default: %default]')
+    parser.add_option('-n', '--messages', type='int', default=1000,
+                      help='messages to send [default: %default]')
+    parser.add_option('-c', '--concurrency', type='int', default=4,
+                      help='sending threads [default: %default]')
+    parser.add_option('--batch', type='int', default=1,
+                      help='messages per send_messages call [default: %default]')
+    parser.add_option('--size', type='int', default=1024,
+                      help='body size in bytes [default: %default]')
+    parser.add_option('--recipients', type='int', default=1,
+                      help='recipients per message [default: %default]')
+    parser.add_option('--host', default='127.0.0.1', help='SMTP server [default: in-process sink]')
+    parser.add_option('--port', type='int', help='SMTP port [default: in-process sink]')
+    parser.add_option('--api-url', help='REST API URL [default: in-process sink]')
+    parser.add_option('-o', '--output', help='write the report as JSON to this file')
+    add_fault_options(parser)
+    options, args = parser.parse_args()
+
+    faults = None
+    port, api_url = options.port, options.api_url
+    if port is None and api_url is None:
+        faults = get_faults(options)
+        # The generic REST backend sends no credentials.
+        api_key = API_KEY if options.backend == 'mailgun' else None
+        smtp, http = start_sinks(faults, api_key=api_key)
+        port = smtp.server_address[1]
+        api_url = 'http://127.0.0.1:%d/v2' % http.server_address[1]
+
+    path = BACKENDS.get(options.backend, options.backend)
+    backend_options = get_backend_options(options.backend, options.host, port, api_url)
+    batches = make_batches(options.messages, options.batch, options.size, options.recipients)
+    app = Flask('load')
+    elapsed, latencies, outcomes = run(app, path, backend_options, batches,
+                                       options.concurrency)
+
+    report = {
+        'backend': path,
+        'messages': options.messages,
+        'concurrency': options.concurrency,
+        'batch': options.batch,
+        'elapsed': elapsed,
+        'throughput': options.messages / elapsed if elapsed else None,
+        'latency': {
+            'p50': percentile(latencies, 0.5),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1],
+        },
+        'outcomes': outcomes,
+        'rates': dict((name, float(count) / options.messages)
+                      for name, count in outcomes.items()),
+    }
+    if faults is not None:
+        report['sink'] = faults.get_counts()
+
+    print '%s: %d messages, %d threads, %d per call' % (
+        path, options.messages, options.concurrency, options.batch)
+    print 'elapsed %.2fs, throughput %.1f messages/s' % (elapsed, report['throughput'])
+    print 'latency per call: p50 %.1fms  p95 %.1fms  p99 %.1fms  max %.1fms' % tuple(
+        report['latency'][name] * 1e3 for name in ('p50', 'p95', 'p99', 'max'))
+    print '  '.join('%s %d (%.1f%%)' % (name, outcomes[name], report['rates'][name] * 100)
+                    for name in OUTCOMES)
+    if faults is not None:
+        print 'sink: %s' % ', '.join('%s %d' % item for item in sorted(report['sink'].items()))
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(dict(report, meta={'version': flask_email.__version__,
+                                         'time': time.time()}),
+                      f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for Flask-Email.
+
+Measures building and serializing messages, the address and encoding
+helpers, and sending through every backend, the SMTP and REST backends
+talking to local stand-in servers. Every benchmark is run for a number of
+rounds and the timings of one operation are reported::
+
+    python benchmarks/run.py -o before.json
+    python benchmarks/run.py -o after.json --compare before.json
+
+With ``--compare``, the medians are compared with a previous run and the
+exit status is 1 if any benchmark is slower by more than ``--threshold``.
+"""
+from __future__ import with_statement
+
+import asyncore
+import BaseHTTPServer
+import json
+import os
+import platform
+import shutil
+import smtpd
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+from StringIO import StringIO
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+
+import flask_email
+from flask_email import get_connection
+from flask_email.encoding import force_unicode, smart_str
+from flask_email.message import EmailMessage, EmailMultiAlternatives, sanitize_address
+
+
+def plain_message():
+    return EmailMessage('Subject', 'Content\n' * 20, 'from@example.com', ['to@example.com'])
+
+
+def unicode_message():
+    return EmailMessage(u'Sübject', u'Cöntent Ж\n' * 20, u'Fröm <from@example.com>',
+                        [u'Tö <to@example.com>'])
+
+
+def html_message():
+    message = EmailMultiAlternatives('Subject', 'Content\n' * 20, 'from@example.com',
+                                     ['to@example.com'])
+    message.attach_alternative('<p>Content</p>\n' * 20, 'text/html')
+    return message
+
+
+def attachment_message():
+    message = EmailMessage('Subject', 'Content\n' * 20, 'from@example.com', ['to@example.com'])
+    message.attach('file.bin', os.urandom(100 * 1024), 'application/octet-stream')
+    return message
+
+
+def recipients_message():
+    return EmailMessage('Subject', 'Content\n' * 20, 'from@example.com', ['to@example.com'],
+                        bcc=['bcc%d@example.com' % i for i in range(100)])
+
+
+SHAPES = [
+    ('plain', plain_message),
+    ('unicode', unicode_message),
+    ('html', html_message),
+    ('attachment', attachment_message),
+    ('recipients', recipients_message),
+]
+
+
+class SinkSMTPServer(smtpd.SMTPServer):
+    """SMTP server discarding messages."""
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        pass
+
+
+class SinkHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """HTTP handler accepting any POST, standing in for a REST provider."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('{}')
+
+    def log_message(self, *args):
+        pass
+
+
+def start_servers():
+    """Starts the SMTP and HTTP sinks. Returns their ports."""
+    smtp = SinkSMTPServer(('127.0.0.1', 0), None)
+    thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.1})
+    thread.daemon = True
+    thread.start()
+    http = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), SinkHTTPHandler)
+    thread = threading.Thread(target=http.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return smtp.socket.getsockname()[1], http.server_address[1]
+
+
+def get_benchmarks(tmp_dir, smtp_port, http_port):
+    """Returns (name, setup) pairs, setup returning the operation to time."""
+    benchmarks = []
+    for shape, factory in SHAPES:
+        def message(factory=factory):
+            email = factory()
+            return email.message
+        def as_string(factory=factory):
+            msg = factory().message()
+            return msg.as_string
+        def estimate_size(factory=factory):
+            return factory().estimate_size
+        benchmarks.append(('message.%s' % shape, message))
+        benchmarks.append(('as_string.%s' % shape, as_string))
+        benchmarks.append(('estimate_size.%s' % shape, estimate_size))
+
+    benchmarks.append(('sanitize_address.ascii',
+                       lambda: lambda: sanitize_address('Name <to@example.com>', 'utf-8')))
+    benchmarks.append(('sanitize_address.unicode',
+                       lambda: lambda: sanitize_address(u'Nämé <tö@exämple.com>', 'utf-8')))
+    benchmarks.append(('force_unicode.str', lambda: lambda: force_unicode('Content ' * 100)))
+    benchmarks.append(('force_unicode.unicode', lambda: lambda: force_unicode(u'Cöntent ' * 100)))
+    benchmarks.append(('smart_str.unicode', lambda: lambda: smart_str(u'Cöntent ' * 100)))
+
+    backends = [
+        ('dummy', 'flask_email.backends.dummy.Mail', {}),
+        ('locmem', 'flask_email.backends.locmem.Mail', {'global_outbox': False}),
+        ('console', 'flask_email.backends.console.Mail', {'stream': None}),
+        ('filebased', 'flask_email.backends.filebased.Mail', {'file_path': tmp_dir}),
+        ('smtp', 'flask_email.backends.smtp.Mail',
+         {'host': '127.0.0.1', 'port': smtp_port}),
+        ('rest', 'flask_email.backends.rest.Mail',
+         {'endpoint': 'http://127.0.0.1:%d/messages' % http_port}),
+    ]
+    for name, path, options in backends:
+        for shape, factory in SHAPES:
+            def send(path=path, options=options, factory=factory):
+                if 'stream' in options:
+                    options = dict(options, stream=StringIO())
+                connection = get_connection(path, **options)
+                connection.open()
+                messages = [factory()]
+                return lambda: connection.send_messages(messages)
+            benchmarks.append(('send.%s.%s' % (name, shape), send))
+    return benchmarks
+
+
+def run_benchmark(setup, rounds, number):
+    """
+    Times rounds of number operations. Returns the statistics of the time
+    of one operation, in seconds.
+    """
+    operation = setup()
+    operation()  # Warm up
+    timings = []
+    for i in range(rounds):
+        start = default_timer()
+        for j in range(number):
+            operation()
+        timings.append((default_timer() - start) / number)
+    timings.sort()
+    mean = sum(timings) / len(timings)
+    return {
+        'rounds': rounds,
+        'number': number,
+        'min': timings[0],
+        'median': timings[len(timings) // 2],
+        'p95': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        'mean': mean,
+        'ops': 1 / mean if mean else None,
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints how the medians changed from the baseline. Returns the names of
+    the benchmarks that are slower by more than threshold.
+    """
+    regressions = []
+    print '\n%-40s %12s %12s %8s' % ('benchmark', 'baseline', 'current', 'change')
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        before = baseline[name]['median']
+        after = results[name]['median']
+        change = (after - before) / before if before else 0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = ' slower'
+        print '%-40s %10.1fus %10.1fus %+7.1f%%%s' % (
+            name, before * 1e6, after * 1e6, change * 100, flag)
+    return regressions
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-o', '--output', help='write the results as JSON to this file')
+    parser.add_option('-c', '--compare', help='compare with the results in this JSON file')
+    parser.add_option('-t', '--threshold', type='float', default=0.1,
+                      help='slowdown reported as a regression [default: %default]')
+    parser.add_option('-r', '--rounds', type='int', default=20,
+                      help='rounds per benchmark [default: %default]')
+    parser.add_option('-n', '--number', type='int', default=20,
+                      help='operations per round [default: %default]')
+    parser.add_option('-k', '--filter', default='',
+                      help='only run benchmarks whose name contains this')
+    options, args = parser.parse_args()
+
+    app = Flask('benchmarks')
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        with app.app_context():
+            smtp_port, http_port = start_servers()
+            results = {}
+            for name, setup in get_benchmarks(tmp_dir, smtp_port, http_port):
+                if options.filter not in name:
+                    continue
+                result = results[name] = run_benchmark(setup, options.rounds, options.number)
+                print '%-40s %10.1fus median %10.1fus p95 %10.0f ops/s' % (
+                    name, result['median'] * 1e6, result['p95'] * 1e6, result['ops'])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({
+                'meta': {
+                    'version': flask_email.__version__,
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'time': time.time(),
+                    'rounds': options.rounds,
+                    'number': options.number,
+                },
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, options.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Sink servers standing in for an SMTP relay and for the Mailgun REST API,
+discarding the messages they receive, with injected faults.
+
+Both servers are threaded, so slow replies only hold up the connection
+they are on. Faults are:
+
+- latency: delay before accepting a message (the reply to the end of
+  ``DATA``, or the HTTP response), plus a uniform random jitter, and a
+  delay before every other SMTP reply
+- rate: messages accepted per second. The SMTP sink delays its replies
+  to stay under the rate; the REST sink answers 429, like Mailgun.
+- temporary and permanent errors: SMTP recipients are refused with 451
+  or 550, REST requests answered with 503 or 400
+- disconnects: the connection is closed instead of accepting a message
+
+The servers can be run in-process with :func:`start_sinks`, as
+``benchmarks/load.py`` does, or on their own::
+
+    python benchmarks/sink.py --smtp-port 2525 --http-port 8025 --temp-errors 0.05
+
+and sent to with ``EMAIL_HOST = 'localhost'``, ``EMAIL_PORT = 2525`` or
+the Mailgun backend with ``api_url='http://localhost:8025/v2'``.
+"""
+from __future__ import with_statement
+
+import base64
+import BaseHTTPServer
+import json
+import os
+import random
+import re
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+from optparse import OptionGroup, OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask_email.ratelimit import TokenBucket
+
+
+class Faults(object):
+    """
+    Faults injected by the sinks, and counts of what they did. The random
+    choices are made with a generator seeded with seed, for repeatable
+    runs.
+    """
+
+    def __init__(self, latency=0, jitter=0, command_latency=0, rate=None,
+                 temp_errors=0, perm_errors=0, disconnects=0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.command_latency = command_latency
+        self.bucket = TokenBucket(rate) if rate else None
+        self.temp_errors = temp_errors
+        self.perm_errors = perm_errors
+        self.disconnects = disconnects
+        self.random = random.Random(seed)
+        self.counts = dict.fromkeys(('accepted', 'temp_errors', 'perm_errors',
+                                     'disconnects', 'throttled', 'bytes'), 0)
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counts[name] += value
+
+    def get_counts(self):
+        with self._lock:
+            return dict(self.counts)
+
+    def choose_error(self):
+        """Returns ``'temp'``, ``'perm'`` or None, for a recipient or request."""
+        with self._lock:
+            value = self.random.random()
+        if value < self.temp_errors:
+            return 'temp'
+        if value < self.temp_errors + self.perm_errors:
+            return 'perm'
+        return None
+
+    def choose_disconnect(self):
+        with self._lock:
+            return self.random.random() < self.disconnects
+
+    def wait(self):
+        """Waits for the latency of accepting a message."""
+        delay = self.latency
+        if self.jitter:
+            with self._lock:
+                delay += self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+
+class SMTPHandler(SocketServer.StreamRequestHandler):
+    """Minimal SMTP server side, accepting any sender and recipient."""
+
+    def reply(self, line, latency=True):
+        if latency and self.server.faults.command_latency:
+            time.sleep(self.server.faults.command_latency)
+        self.wfile.write(line + '\r\n')
+        self.wfile.flush()
+
+    def handle(self):
+        faults = self.server.faults
+        self.reply('220 %s ESMTP sink' % socket.gethostname())
+        recipients = None
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb, _, arg = line.strip().partition(' ')
+            verb = verb.upper()
+            if verb == 'EHLO':
+                self.wfile.write('250-%s\r\n250-PIPELINING\r\n' % socket.gethostname())
+                self.reply('250 8BITMIME')
+            elif verb == 'HELO':
+                self.reply('250 %s' % socket.gethostname())
+            elif verb == 'MAIL':
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                if recipients is None:
+                    self.reply('503 Need MAIL command')
+                    continue
+                error = faults.choose_error()
+                if error == 'temp':
+                    faults.count('temp_errors')
+                    self.reply('451 Try again later')
+                elif error == 'perm':
+                    faults.count('perm_errors')
+                    self.reply('550 No such user')
+                else:
+                    recipients.append(arg)
+                    self.reply('250 OK')
+            elif verb == 'DATA':
+                if not recipients:
+                    self.reply('503 Need RCPT command')
+                    continue
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                size = 0
+                for line in iter(self.rfile.readline, ''):
+                    if line == '.\r\n':
+                        break
+                    size += len(line)
+                else:
+                    return
+                if faults.choose_disconnect():
+                    faults.count('disconnects')
+                    return
+                if faults.bucket is not None and not faults.bucket.acquire(blocking=False):
+                    faults.count('throttled')
+                    faults.bucket.acquire()
+                faults.wait()
+                faults.count('accepted')
+                faults.count('bytes', size)
+                recipients = None
+                self.reply('250 OK queued', latency=False)
+            elif verb == 'RSET':
+                recipients = None
+                self.reply('250 OK')
+            elif verb == 'NOOP':
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class SMTPSink(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, faults):
+        SocketServer.TCPServer.__init__(self, address, SMTPHandler)
+        self.faults = faults
+
+
+class MailgunHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handler answering like the messages endpoint of the Mailgun API."""
+    protocol_version = 'HTTP/1.1'
+    path_re = re.compile(r'^/v\d+/[^/]+/messages$')
+
+    def respond(self, code, body):
+        data = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        faults = self.server.faults
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self.path_re.match(self.path):
+            return self.respond(404, {'message': 'Not found'})
+        api_key = self.server.api_key
+        if api_key is not None:
+            expected = 'Basic %s' % base64.b64encode('api:%s' % api_key)
+            if self.headers.get('Authorization') != expected:
+                return self.respond(401, {'message': 'Forbidden'})
+        form = urlparse.parse_qs(data)
+        if not form.get('from') or not form.get('to'):
+            return self.respond(400, {'message': "'from' and 'to' parameters are missing"})
+        if faults.choose_disconnect():
+            faults.count('disconnects')
+            self.close_connection = 1
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        error = faults.choose_error()
+        if error == 'temp':
+            faults.count('temp_errors')
+            return self.respond(503, {'message': 'Service unavailable'})
+        if error == 'perm':
+            faults.count('perm_errors')
+            return self.respond(400, {'message': "'to' parameter is not a valid address"})
+        if faults.bucket is not None and not faults.bucket.acquire(blocking=False):
+            faults.count('throttled')
+            return self.respond(429, {'message': 'Too many requests'})
+        faults.wait()
+        faults.count('accepted')
+        faults.count('bytes', len(data))
+        self.respond(200, {'id': '<%d.%d@sink>' % (time.time() * 1e6, os.getpid()),
+                           'message': 'Queued. Thank you.'})
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPSink(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, faults, api_key=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MailgunHandler)
+        self.faults = faults
+        self.api_key = api_key
+
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def start_sinks(faults=None, host='127.0.0.1', smtp_port=0, http_port=0, api_key=None):
+    """
+    Starts the SMTP and REST sinks in threads, sharing faults. Ports left
+    to 0 are picked by the system. Returns the two servers; their ports
+    are ``server.server_address[1]``.
+    """
+    faults = faults or Faults()
+    return (serve(SMTPSink((host, smtp_port), faults)),
+            serve(HTTPSink((host, http_port), faults, api_key)))
+
+
+def add_fault_options(parser):
+    """Adds the options of :class:`Faults` to an OptionParser."""
+    group = OptionGroup(parser, 'Faults')
+    group.add_option('--latency', type='float', default=0,
+                     help='seconds before accepting a message [default: %default]')
+    group.add_option('--jitter', type='float', default=0,
+                     help='random seconds added to the latency [default: %default]')
+    group.add_option('--command-latency', type='float', default=0,
+                     help='seconds before other SMTP replies [default: %default]')
+    group.add_option('--rate', type='float',
+                     help='messages accepted per second [default: unlimited]')
+    group.add_option('--temp-errors', type='float', default=0,
+                     help='share of 451 recipients / 503 requests [default: %default]')
+    group.add_option('--perm-errors', type='float', default=0,
+                     help='share of 550 recipients / 400 requests [default: %default]')
+    group.add_option('--disconnects', type='float', default=0,
+                     help='share of messages answered by a disconnect [default: %default]')
+    group.add_option('--seed', type='int', help='seed of the random faults')
+    parser.add_option_group(group)
+
+
+def get_faults(options):
+    return Faults(latency=options.latency, jitter=options.jitter,
+                  command_latency=options.command_latency, rate=options.rate,
+                  temp_errors=options.temp_errors, perm_errors=options.perm_errors,
+                  disconnects=options.disconnects, seed=options.seed)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--host', default='127.0.0.1', help='address to listen on [default: %default]')
+    parser.add_option('--smtp-port', type='int', default=2525, help='[default: %default]')
+    parser.add_option('--http-port', type='int', default=8025, help='[default: %default]')
+    parser.add_option('--api-key', help='Mailgun API key to require')
+    parser.add_option('--interval', type='float', default=10,
+                      help='seconds between printing counts [default: %default]')
+    add_fault_options(parser)
+    options, args = parser.parse_args()
+
+    faults = get_faults(options)
+    smtp, http = start_sinks(faults, options.host, options.smtp_port, options.http_port,
+                             options.api_key)
+    print 'SMTP sink on %s:%d, Mailgun sink on http://%s:%d/v2' % (
+        options.host, smtp.server_address[1], options.host, http.server_address[1])
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(options.interval)
+            print json.dumps(faults.get_counts(), sort_keys=True)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
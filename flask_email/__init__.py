@@ -12,6 +12,8 @@ __version__ = '1.4.3'
 Tools for sending email.
 """
 
+from itertools import islice
+
 from flask import current_app as app
 from .utils import import_module
 
@@ -25,6 +27,10 @@ from .message import (
     SafeMIMEText, SafeMIMEMultipart,
     DEFAULT_ATTACHMENT_MIME_TYPE, make_msgid,
     BadHeaderError, forbid_multi_line_headers)
+from .render import render_messages, create_pool
+from .templating import render_email
+from .batching import batch, dispatch, init_batching
+from .results import count_sent
 from .backends.console import Mail as ConsoleMail
 from .backends.dummy import Mail as DummyMail
 from .backends.filebased import Mail as FilebasedMail
@@ -96,7 +102,64 @@ def send_mass_mail(datatuple, fail_silently=False, auth_user=None,
                                     fail_silently=fail_silently)
     messages = [EmailMessage(subject, message, sender, recipient)
                 for subject, message, sender, recipient in datatuple]
-    return connection.send_messages(messages)
+    return dispatch(connection, messages)
+
+
+def stream_mass_mail(datatuple, batch_size=100, progress=None,
+                     fail_silently=False, auth_user=None, auth_password=None,
+                     connection=None, processes=None):
+    """
+    Streaming version of :func:`send_mass_mail` for large datasets.
+
+    datatuple can be any iterable (e.g. a generator) of (subject, message,
+    from_email, recipient_list) tuples or of EmailMessage instances. It is
+    consumed in chunks of batch_size messages, so only one chunk is held in
+    memory at a time, and the connection is kept open across chunks.
+
+    If progress is given, it is called after every chunk as
+    ``progress(chunk_sent, num_sent)``; returning False stops the run before
+    the next chunk is read.
+
+    If processes is set, every chunk is rendered in that many worker
+    processes (see :func:`render_messages`).
+
+    Returns a tuple of the total number of emails sent and the list of
+    per-chunk counts.
+    """
+    connection = connection or get_connection(username=auth_user,
+                                    password=auth_password,
+                                    fail_silently=fail_silently)
+    iterator = iter(datatuple)
+    pool = processes and create_pool(processes) or None
+    num_sent = 0
+    chunk_counts = []
+    new_conn_created = connection.open()
+    try:
+        while True:
+            chunk = [_to_message(item) for item in islice(iterator, batch_size)]
+            if not chunk:
+                break
+            if pool is not None:
+                render_messages(chunk, processes, pool=pool)
+            chunk_sent = count_sent(connection.send_messages(chunk))
+            num_sent += chunk_sent
+            chunk_counts.append(chunk_sent)
+            if progress is not None and progress(chunk_sent, num_sent) is False:
+                break
+    finally:
+        if new_conn_created:
+            connection.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return num_sent, chunk_counts
+
+
+def _to_message(item):
+    if isinstance(item, EmailMessage):
+        return item
+    subject, message, sender, recipient = item
+    return EmailMessage(subject, message, sender, recipient)
 
 
 def mail_admins(subject, message, fail_silently=False, connection=None,
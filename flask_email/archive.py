@@ -0,0 +1,289 @@
+"""
+Reading messages written by the file email backend.
+
+An :class:`Archive` indexes the log files or the Maildir of a directory
+in an SQLite database, with the Message-ID, sender, recipients, subject
+and date of every message and where it is stored. The index is updated
+incrementally: only what was appended since the last update is parsed.
+Messages are then read with a single seek instead of a scan::
+
+    archive = Archive('/var/log/mail')
+    archive.update()
+    message = archive.get('<20130109.1234.5678@example.com>')
+"""
+from __future__ import with_statement
+
+import bz2
+import gzip
+import os
+import sqlite3
+import threading
+from email import message_from_string
+from email.parser import HeaderParser
+from email.utils import getaddresses, mktime_tz, parsedate_tz
+
+SEPARATOR = '-' * 79 + '\n'
+
+# Openers of the log files, by extension.
+OPENERS = {
+    '.log': open,
+    '.gz': gzip.open,
+    '.bz2': bz2.BZ2File,
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    offset INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    message_id TEXT,
+    sender TEXT,
+    subject TEXT,
+    timestamp REAL,
+    path TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_message_id ON messages (message_id);
+CREATE INDEX IF NOT EXISTS messages_timestamp ON messages (timestamp);
+CREATE TABLE IF NOT EXISTS recipients (
+    address TEXT NOT NULL,
+    message INTEGER NOT NULL REFERENCES messages (id)
+);
+CREATE INDEX IF NOT EXISTS recipients_address ON recipients (address);
+"""
+
+
+class Entry(object):
+    """
+    An indexed message.
+
+    :ivar message_id: Message-ID header
+    :ivar sender: Address of the From header
+    :ivar subject: Subject header
+    :ivar timestamp: Date header, as a timestamp
+    :ivar path: File the message is stored in, relative to the archive
+    :ivar offset: Offset of the message in the (uncompressed) file
+    :ivar length: Length of the message
+    """
+
+    def __init__(self, id, message_id, sender, subject, timestamp, path, offset,
+                 length):
+        self.id = id
+        self.message_id = message_id
+        self.sender = sender
+        self.subject = subject
+        self.timestamp = timestamp
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+    def __repr__(self):
+        return '<Entry %s %s:%d>' % (self.message_id, self.path, self.offset)
+
+
+class Archive(object):
+    """
+    Index of the messages stored by the file email backend in a directory.
+
+    :param path: Directory of the log files or Maildir
+    :param index_path: SQLite database of the index. Default: ``.index.db``
+        in the directory
+    """
+
+    def __init__(self, path, index_path=None):
+        self.path = os.path.abspath(path)
+        self.index_path = index_path or os.path.join(self.path, '.index.db')
+        self._local = threading.local()
+        self._get_db().executescript(SCHEMA)
+
+    def _get_db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.index_path, timeout=30)
+        return db
+
+    def _open(self, path):
+        root, ext = os.path.splitext(path)
+        opener = OPENERS.get(ext, open)
+        return opener(os.path.join(self.path, path), 'rb')
+
+    def get_files(self):
+        """
+        Returns the paths of the files holding messages, relative to the
+        archive: its log files, or the messages of a Maildir.
+        """
+        if os.path.isdir(os.path.join(self.path, 'new')):
+            paths = []
+            for subdir in ('cur', 'new'):
+                paths.extend(os.path.join(subdir, name) for name in
+                             sorted(os.listdir(os.path.join(self.path, subdir))))
+            return paths
+        return sorted(name for name in os.listdir(self.path)
+                      if name.endswith(('.log', '.log.gz', '.log.bz2')))
+
+    def update(self):
+        """
+        Indexes the messages written since the last update. Returns the
+        number of messages indexed.
+        """
+        db = self._get_db()
+        with db:
+            offsets = dict(db.execute('SELECT path, offset FROM files'))
+            paths = self.get_files()
+            existing = set(paths)
+            # Maildir messages in cur by their name in new, without the
+            # ":2,<flags>" info suffix.
+            in_cur = dict((os.path.basename(path).split(':')[0], path)
+                          for path in paths if path.startswith('cur'))
+            for path in list(offsets):
+                if path not in existing:
+                    offset = offsets.pop(path)
+                    moved = self._moved(db, path, offset, existing, in_cur)
+                    if moved is not None:
+                        offsets[moved] = offset
+            count = 0
+            for path in paths:
+                if path in offsets and path.startswith(('cur', 'new')):
+                    continue
+                if path.endswith(('.gz', '.bz2')) and os.path.splitext(path)[0] in existing:
+                    # Being compressed: its log file is indexed until removed.
+                    continue
+                offset, entries = self._parse(path, offsets.get(path, 0))
+                for entry in entries:
+                    self._insert(db, path, *entry)
+                count += len(entries)
+                db.execute('INSERT OR REPLACE INTO files (path, offset) VALUES (?, ?)',
+                           (path, offset))
+        return count
+
+    def _moved(self, db, path, offset, existing, in_cur):
+        """
+        Follows a file that is no longer there: a rotated log file that was
+        compressed, or a Maildir message moved from new to cur. Returns the
+        new path of the file, or None if it was removed.
+        """
+        candidates = [path + '.gz', path + '.bz2']
+        if path.startswith('new'):
+            name = os.path.basename(path)
+            if name in in_cur:
+                candidates.append(in_cur[name])
+        for candidate in candidates:
+            if candidate in existing:
+                db.execute('UPDATE messages SET path = ? WHERE path = ?', (candidate, path))
+                db.execute('INSERT OR REPLACE INTO files (path, offset) VALUES (?, ?)',
+                           (candidate, offset))
+                db.execute('DELETE FROM files WHERE path = ?', (path,))
+                return candidate
+        db.execute('DELETE FROM recipients WHERE message IN '
+                   '(SELECT id FROM messages WHERE path = ?)', (path,))
+        db.execute('DELETE FROM messages WHERE path = ?', (path,))
+        db.execute('DELETE FROM files WHERE path = ?', (path,))
+        return None
+
+    def _parse(self, path, offset):
+        """
+        Parses the complete messages of a file from offset on. Returns the
+        offset to resume from, and a list of (headers, offset, length) of
+        the messages found.
+        """
+        f = self._open(path)
+        try:
+            f.seek(offset)
+            if path.startswith(('cur', 'new')):
+                data = f.read()
+                return len(data), [(HeaderParser().parsestr(data, True), 0, len(data))]
+            entries = []
+            start = position = offset
+            headers = []
+            in_headers = True
+            for line in f:
+                position += len(line)
+                if line == SEPARATOR:
+                    # The message ends with a newline before the separator.
+                    length = position - len(line) - 1 - start
+                    entries.append((HeaderParser().parsestr(''.join(headers), True),
+                                    start, length))
+                    start = position
+                    headers = []
+                    in_headers = True
+                elif in_headers:
+                    if line.strip():
+                        headers.append(line)
+                    else:
+                        in_headers = False
+            # A message still being written is parsed on the next update.
+            return start, entries
+        finally:
+            f.close()
+
+    def _insert(self, db, path, headers, offset, length):
+        date = parsedate_tz(headers.get('Date', ''))
+        sender = getaddresses(headers.get_all('From', []))
+        cursor = db.execute(
+            'INSERT INTO messages (message_id, sender, subject, timestamp, path, offset, length) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (headers.get('Message-ID'), sender[0][1] if sender else None,
+             headers.get('Subject'), date and mktime_tz(date), path, offset, length))
+        fields = headers.get_all('To', []) + headers.get_all('Cc', [])
+        addresses = set(addr.lower() for name, addr in getaddresses(fields) if addr)
+        db.executemany('INSERT INTO recipients (address, message) VALUES (?, ?)',
+                       [(addr, cursor.lastrowid) for addr in addresses])
+
+    def find(self, message_id=None, recipient=None, subject=None, since=None,
+             until=None):
+        """
+        Returns the :class:`Entry` of the indexed messages matching all the
+        given criteria, in the order they were indexed.
+
+        :param message_id: Message-ID header
+        :param recipient: Address in the To or Cc headers. Bcc recipients are
+            not written to the files, so they are not indexed.
+        :param subject: Subject header
+        :param since: Earliest timestamp of the Date header
+        :param until: Latest timestamp of the Date header
+        """
+        query = ('SELECT id, message_id, sender, subject, timestamp, path, offset, length '
+                 'FROM messages')
+        conditions = []
+        params = []
+        if message_id is not None:
+            conditions.append('message_id = ?')
+            params.append(message_id)
+        if recipient is not None:
+            conditions.append('id IN (SELECT message FROM recipients WHERE address = ?)')
+            params.append(recipient.lower())
+        if subject is not None:
+            conditions.append('subject = ?')
+            params.append(subject)
+        if since is not None:
+            conditions.append('timestamp >= ?')
+            params.append(since)
+        if until is not None:
+            conditions.append('timestamp <= ?')
+            params.append(until)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY id'
+        return [Entry(*row) for row in self._get_db().execute(query, params)]
+
+    def read(self, entry):
+        """Returns the serialized message of an :class:`Entry`."""
+        f = self._open(entry.path)
+        try:
+            f.seek(entry.offset)
+            return f.read(entry.length)
+        finally:
+            f.close()
+
+    def get(self, message_id):
+        """
+        Returns the message with the given Message-ID, as an
+        :class:`email.message.Message`, or None if it is not indexed.
+        """
+        entries = self.find(message_id=message_id)
+        if not entries:
+            return None
+        return message_from_string(self.read(entries[-1]))
@@ -1,4 +1,42 @@
 """Base email backend class."""
+from __future__ import with_statement
+
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app
+
+from ..metrics import get_registry, null_timer
+from ..signals import (email_dispatched, before_send, send_failed, get_dispatcher,
+                       has_receivers, send_signals)
+from ..signing import get_signer
+from ..tracing import get_tracer
+
+SIGNAL_DISPATCH = ('sync', 'batch', 'async')
+
+
+def instrumented(send_messages):
+    """
+    Decorates the ``send_messages`` method of a backend so that a call is
+    traced in an ``email.send_messages`` span, and the signals sent during
+    the call are batched, see :meth:`BaseMail.signal_batch`.
+    """
+    @wraps(send_messages)
+    def wrapper(self, email_messages):
+        with self.signal_batch():
+            if self.tracer is None or getattr(self._local, 'traced', False):
+                return send_messages(self, email_messages)
+            self._local.traced = True
+            try:
+                with self.tracer.start_as_current_span('email.send_messages', attributes={
+                        'email.backend': self.get_metrics_name(),
+                        'email.messages': len(email_messages or ())}):
+                    return send_messages(self, email_messages)
+            finally:
+                self._local.traced = False
+    return wrapper
+
 
 class BaseMail(object):
     """
@@ -7,12 +45,19 @@ class BaseMail(object):
     Subclasses must at least overwrite :meth:`send_messages`.
     """
     # TODO: Add threadsafe warning
+    spool_threshold = None
+    signer = None
+    metrics = None
+    signal_dispatch = 'sync'
+    tracer = None
+    _local = None
     
     def __init__(self, app=None, **kwargs):
         if app is not None: 
             self.init_app(app, **kwargs)
 
-    def init_app(self, app, fail_silently=False, **kwargs):
+    def init_app(self, app, fail_silently=False, spool_threshold=None, metrics=None,
+                 signal_dispatch=None, tracer=None, slow_send_threshold=None, **kwargs):
         """
         Initializes your mail settings from the application
         settings.
@@ -22,8 +67,35 @@ class BaseMail(object):
 
         :param app: Flask application instance
         :param bool fail_silently: Email fails silently on errors
+        :param spool_threshold: Size in bytes above which serialized messages
+            are written to a temporary file instead of being kept in memory.
+            Default: ``EMAIL_SPOOL_THRESHOLD``
+        :param metrics: Record timings and counts in the
+            :class:`~flask.ext.email.metrics.Registry` of the app.
+            Default: ``EMAIL_METRICS``
+        :param signal_dispatch: How signals are sent: ``'sync'`` as messages
+            are sent, ``'batch'`` together once ``send_messages`` is done, or
+            ``'async'`` from a thread. Default: ``EMAIL_SIGNAL_DISPATCH``
+        :param tracer: Tracer of the sends, see :mod:`~flask.ext.email.tracing`.
+            Default: ``EMAIL_TRACER``
+        :param slow_send_threshold: Log the spans of sends slower than this
+            many seconds. Default: ``EMAIL_SLOW_SEND_THRESHOLD``
         """
         self.fail_silently = fail_silently
+        if spool_threshold is None:
+            spool_threshold = app.config.get('EMAIL_SPOOL_THRESHOLD')
+        self.spool_threshold = spool_threshold
+        self.signer = get_signer(app)
+        if metrics is None:
+            metrics = app.config.get('EMAIL_METRICS', False)
+        self.metrics = get_registry(app) if metrics else None
+        if signal_dispatch is None:
+            signal_dispatch = app.config.get('EMAIL_SIGNAL_DISPATCH', 'sync')
+        if signal_dispatch not in SIGNAL_DISPATCH:
+            raise Exception('Invalid signal dispatch: %r' % signal_dispatch)
+        self.signal_dispatch = signal_dispatch
+        self.tracer = get_tracer(app, tracer, slow_send_threshold)
+        self._local = threading.local()
 
         self.app = app
 
@@ -50,6 +122,186 @@ class BaseMail(object):
         """Close a network connection."""
         pass
 
+    def render(self, email_message):
+        """
+        Returns the serialized message: a string, or a file-like object
+        spooled to disk beyond :attr:`spool_threshold` bytes. Messages are
+        DKIM signed when ``EMAIL_DKIM_DOMAIN`` is set.
+        """
+        if email_message.rendered is not None:
+            data = email_message.rendered
+        elif self.spool_threshold is None:
+            with self.timed('render'):
+                msg = email_message.message()
+            with self.timed('serialize'):
+                data = msg.as_string()
+        else:
+            with self.timed('serialize'):
+                data = email_message.spool(self.spool_threshold)
+        if self.signer is not None:
+            with self.timed('sign'):
+                if not isinstance(data, basestring):
+                    data = self.signer.sign_file(data, self.spool_threshold)
+                elif not data.startswith('DKIM-Signature:'):
+                    # Payloads kept for retries are signed already.
+                    data = self.signer.sign(data)
+        if self.metrics is not None:
+            if isinstance(data, basestring):
+                size = len(data)
+            else:
+                data.seek(0, 2)
+                size = data.tell()
+                data.seek(0)
+            self.count('bytes', size)
+        return data
+
+    def get_metrics_name(self):
+        """Returns the backend label of the metrics, e.g. ``'smtp'``."""
+        return type(self).__module__.rsplit('.', 1)[-1]
+
+    def timed(self, phase):
+        """
+        Returns a context manager recording the time spent in its block as
+        the given phase of sending, e.g. ``'connect'``, in the metrics and
+        in an ``email.<phase>`` span.
+        """
+        if self.tracer is None:
+            if self.metrics is None:
+                return null_timer
+            return self.metrics.timer('email_phase_seconds',
+                                      backend=self.get_metrics_name(), phase=phase)
+        return self._traced_phase(phase)
+
+    @contextmanager
+    def _traced_phase(self, phase):
+        with self.tracer.start_as_current_span('email.%s' % phase):
+            if self.metrics is None:
+                yield
+            else:
+                with self.metrics.timer('email_phase_seconds',
+                                        backend=self.get_metrics_name(), phase=phase):
+                    yield
+
+    def span(self, name, attributes=None):
+        """
+        Returns a context manager tracing its block in a span, or doing
+        nothing if sends are not traced.
+        """
+        if self.tracer is None:
+            return null_timer
+        return self.tracer.start_as_current_span(name, attributes=attributes)
+
+    def message_span(self, email_message):
+        """Returns a context manager tracing the send of a message."""
+        if self.tracer is None:
+            return null_timer
+        return self.span('email.message', {
+            'email.recipients': len(email_message.recipients()),
+            'email.attempts': getattr(email_message, 'attempts', 0)})
+
+    def count(self, name, value=1, **labels):
+        """Adds value to the ``email_<name>_total`` counter of the metrics."""
+        if self.metrics is not None:
+            self.metrics.inc('email_%s_total' % name, value,
+                             backend=self.get_metrics_name(), **labels)
+
+    def count_messages(self, email_messages, status='sent'):
+        """
+        Counts messages as sent or failed in the metrics, and those sent
+        again to retry a previous send.
+        """
+        if self.metrics is None or not email_messages:
+            return
+        self.count('messages', len(email_messages), status=status)
+        retried = len([message for message in email_messages
+                       if getattr(message, 'attempts', 0)])
+        if retried:
+            self.count('retries', retried)
+
+    def send_signal(self, signal, email_message, **kwargs):
+        """
+        Sends signal for a message, or queues it if signals are batched or
+        asynchronous. The errors of receivers are logged in every mode, so
+        that they do not fail a send that already happened.
+        """
+        if not has_receivers(signal):
+            return
+        kwargs.update(message=email_message, backend=self)
+        batch = getattr(self._local, 'signals', None)
+        if batch is not None:
+            batch.append((signal, kwargs))
+        elif self.signal_dispatch == 'async':
+            get_dispatcher().put([(signal, kwargs)])
+        else:
+            send_signals(current_app._get_current_object(), [(signal, kwargs)])
+
+    @contextmanager
+    def signal_batch(self):
+        """
+        Collects the signals sent in its block to send them together on
+        exit, from the dispatcher thread if they are asynchronous. Does
+        nothing if signals are sent synchronously.
+        """
+        if (self.signal_dispatch == 'sync' or
+                getattr(self._local, 'signals', None) is not None):
+            yield
+            return
+        self._local.signals = batch = []
+        try:
+            yield
+        finally:
+            self._local.signals = None
+            if batch:
+                if self.signal_dispatch == 'async':
+                    get_dispatcher().put(batch)
+                else:
+                    send_signals(current_app._get_current_object(), batch)
+
+    def record_sending(self, email_messages):
+        """Sends the :data:`before_send` signal for messages."""
+        if has_receivers(before_send):
+            for message in email_messages:
+                self.send_signal(before_send, message)
+
+    def record_sent(self, email_messages):
+        """
+        Counts messages as sent and sends the :data:`email_dispatched`
+        signal for them.
+        """
+        self.count_messages(email_messages)
+        if has_receivers(email_dispatched):
+            for message in email_messages:
+                self.send_signal(email_dispatched, message)
+
+    def record_failed(self, email_messages, error=None):
+        """
+        Counts messages as failed and sends the :data:`send_failed` signal
+        for them.
+        """
+        self.count_messages(email_messages, 'failed')
+        if has_receivers(send_failed):
+            for message in email_messages:
+                self.send_signal(send_failed, message, error=error)
+
+    def record_results(self, results):
+        """
+        Records the messages of a list of
+        :class:`~flask.ext.email.results.SendResult` as sent or failed.
+        """
+        for result in results:
+            if result.sent:
+                self.record_sent([result.message])
+            else:
+                self.record_failed([result.message], result.error)
+
+    def get_batch_key(self):
+        """
+        Returns a hashable key describing where this backend delivers to.
+        Messages queued in a batch for backends with equal keys are sent
+        over a single connection.
+        """
+        return (type(self), self.fail_silently)
+
     def send_messages(self, email_messages):
         """
         Sends one or more EmailMessage objects and returns the number of email
@@ -1,7 +1,86 @@
+from __future__ import with_statement
+
+import atexit
+import Queue
+import shutil
 import sys
 import threading
+from collections import OrderedDict
+
+from flask import current_app
+
+from .base import BaseMail, instrumented
+
+_writers_lock = threading.Lock()
+
+
+class Writer(object):
+    """
+    Thread writing the messages queued by console and file backends, so
+    that a slow disk or a blocked pipe does not hold up the threads
+    sending them. Messages queued together are written with a single
+    flush per backend. The queue is bounded: when it is full, sending
+    blocks until the writer catches up.
+    """
+    # Most messages taken from the queue at once.
+    max_batch = 100
+
+    def __init__(self, app, maxsize=1000):
+        self.app = app
+        self.queue = Queue.Queue(maxsize)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def put(self, backend, data):
+        """Queues serialized data to be written by backend."""
+        self.queue.put((backend, data))
+
+    def flush(self):
+        """Waits until every queued message is written."""
+        self.queue.join()
+
+    def stop(self):
+        """Writes the queued messages and stops the thread."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _run(self):
+        with self.app.app_context():
+            stop = False
+            while not stop:
+                items = [self.queue.get()]
+                try:
+                    while len(items) < self.max_batch:
+                        items.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    pass
+                groups = OrderedDict()
+                for item in items:
+                    if item is None:
+                        stop = True
+                    else:
+                        groups.setdefault(item[0], []).append(item[1])
+                for backend, datas in groups.items():
+                    try:
+                        backend._write_batch(datas)
+                    except Exception:
+                        self.app.logger.exception('Error writing email messages')
+                for item in items:
+                    self.queue.task_done()
+
+
+def get_writer(maxsize=1000):
+    """Returns the writer thread of the app, starting it if needed."""
+    app = current_app._get_current_object()
+    with _writers_lock:
+        writer = app.extensions.get('email_writer')
+        if writer is None or not writer.thread.is_alive():
+            writer = app.extensions['email_writer'] = Writer(app, maxsize)
+        return writer
 
-from .base import BaseMail
 
 class Mail(BaseMail):
     """
@@ -11,39 +90,113 @@ class Mail(BaseMail):
     :param \*\*kwargs: Options to be passed to :meth:`init_app`
     """
 
-    def init_app(self, app, **kwargs):
+    def init_app(self, app, background=None, queue_size=None,
+                 summary_threshold=None, **kwargs):
         """
         :arg app: Flask application instance
         :keyword stream: Stream to write to
         :type stream: file-like object, default ``sys.stdout``
+        :param background: Write messages from a :class:`Writer` thread.
+            Default: ``EMAIL_WRITER_BACKGROUND``
+        :param queue_size: Messages queued for the writer thread at most.
+            Default: ``EMAIL_WRITER_QUEUE_SIZE``
+        :param summary_threshold: Size in bytes above which only the headers
+            of a message are written. Default: ``EMAIL_WRITER_SUMMARY_THRESHOLD``
         :param \*\*kwargs: Ignorable options
         """
         self.stream = kwargs.pop('stream', sys.stdout)
         self._lock = threading.RLock()
+        if background is None:
+            background = app.config.get('EMAIL_WRITER_BACKGROUND', False)
+        self.background = background
+        self.queue_size = queue_size or app.config.get('EMAIL_WRITER_QUEUE_SIZE', 1000)
+        self.summary_threshold = summary_threshold or app.config.get('EMAIL_WRITER_SUMMARY_THRESHOLD')
         super(Mail, self).init_app(app, **kwargs)
 
+    def get_batch_key(self):
+        return (super(Mail, self).get_batch_key(), id(self.stream))
+
+    @instrumented
     def send_messages(self, email_messages):
         """
-        Write all messages to the stream in a thread-safe way.
+        Write all messages to the stream in a thread-safe way. In
+        background mode, the messages are only serialized and queued for
+        the writer thread.
 
         :returns: Number of messages sent
         :rtype: int
         """
         if not email_messages:
             return
+        self.record_sending(email_messages)
+        if self.background:
+            try:
+                writer = get_writer(self.queue_size)
+                for message in email_messages:
+                    writer.put(self, self._render(message))
+            except:
+                self.record_failed(email_messages, sys.exc_info()[1])
+                if not self.fail_silently:
+                    raise
+            else:
+                self.record_sent(email_messages)
+            return len(email_messages)
+        try:
+            self._write_batch(self._render(message) for message in email_messages)
+        except:
+            self.record_failed(email_messages, sys.exc_info()[1])
+            if not self.fail_silently:
+                raise
+        else:
+            self.record_sent(email_messages)
+        return len(email_messages)
+
+    def flush(self):
+        """Waits until messages queued for the writer thread are written."""
+        if self.background:
+            get_writer(self.queue_size).flush()
+
+    def _write_batch(self, datas):
+        """
+        Writes serialized messages in a thread-safe way, flushing the stream
+        once.
+        """
         self._lock.acquire()
         try:
             stream_created = self.open()
-            for message in email_messages:
-                self.stream.write('%s\n' % message.message().as_string())
-                self.stream.write('-'*79)
-                self.stream.write('\n')
-                self.stream.flush()  # flush after each message
+            for data in datas:
+                with self.timed('transmit'):
+                    self._write(data)
+            with self.timed('transmit'):
+                self.stream.flush()  # flush once per batch
             if stream_created:
                 self.close()
-        except:
-            if not self.fail_silently:
-                raise
         finally:
             self._lock.release()
-        return len(email_messages)
+
+    def _render(self, email_message):
+        """
+        Returns the serialized message, or only its headers if it is larger
+        than :attr:`summary_threshold`.
+        """
+        with self.message_span(email_message):
+            if self.summary_threshold is not None:
+                size = email_message.estimate_size()
+                if size > self.summary_threshold:
+                    msg = email_message.message()
+                    headers = ''.join('%s: %s\n' % item for item in msg.items())
+                    return '%s\n[%d bytes not shown]' % (headers, size)
+            return self.render(email_message)
+
+    def _write(self, data):
+        """Writes a serialized message and the separator following it."""
+        if isinstance(data, basestring):
+            self.stream.write('%s\n' % data)
+        else:
+            try:
+                shutil.copyfileobj(data, self.stream)
+            finally:
+                data.close()
+            self.stream.write('\n')
+        self.stream.write('-' * 79)
+        self.stream.write('\n')
@@ -0,0 +1,152 @@
+"""
+Email backend that skips messages which were already delivered.
+
+Every message is identified by :meth:`EmailMessage.get_idempotency_key`.
+Keys of delivered messages are remembered in a bounded in-memory LRU
+store, optionally backed by an SQLite file so that they survive restarts
+and are shared between processes. A message whose key is known is not
+handed to the wrapped backend again, which makes retrying a batch after a
+timeout safe.
+"""
+from __future__ import with_statement
+
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+
+from ..results import count_sent
+from .proxy import Mail as ProxyMail
+
+_stores_lock = threading.Lock()
+
+
+class MemoryStore(object):
+    """
+    Least recently used set of keys, holding at most maxsize keys.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key not in self.keys:
+                return False
+            # Move the key to the most recently used end.
+            del self.keys[key]
+            self.keys[key] = True
+            return True
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        with self._lock:
+            self.keys.pop(key, None)
+            self.keys[key] = True
+            if len(self.keys) > self.maxsize:
+                self.keys.popitem(last=False)
+
+
+class SQLiteStore(object):
+    """
+    Set of keys persisted in an SQLite database, with a :class:`MemoryStore`
+    in front of it.
+    """
+
+    def __init__(self, path, maxsize=10000):
+        self.path = path
+        self.memory = MemoryStore(maxsize)
+        self._local = threading.local()
+        self._get_db().execute('CREATE TABLE IF NOT EXISTS delivered '
+                               '(key TEXT PRIMARY KEY)')
+
+    def _get_db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30)
+        return db
+
+    def __contains__(self, key):
+        if key in self.memory:
+            return True
+        row = self._get_db().execute('SELECT 1 FROM delivered WHERE key = ?',
+                                     (key,)).fetchone()
+        if row is None:
+            return False
+        self.memory.add(key)
+        return True
+
+    def add(self, key):
+        self.memory.add(key)
+        db = self._get_db()
+        with db:
+            db.execute('INSERT OR IGNORE INTO delivered (key) VALUES (?)', (key,))
+
+
+class Mail(ProxyMail):
+    """
+    Email backend that sends every message at most once.
+
+    Configure the wrapped backend with ``EMAIL_DEDUP_BACKEND``. Messages that
+    were skipped by the last :meth:`send_messages` call are listed in
+    :attr:`duplicates`.
+    """
+    backend_setting = 'EMAIL_DEDUP_BACKEND'
+
+    def init_app(self, app, max_keys=None, store_path=None, **kwargs):
+        """
+        :param app: Flask application instance
+        :param max_keys: Number of keys kept in memory. Default:
+            ``EMAIL_DEDUP_MAX_KEYS``
+        :param store_path: SQLite database keeping the keys on disk. Default:
+            ``EMAIL_DEDUP_PATH``
+        :param \*\*kwargs: Options passed to :class:`~.proxy.Mail`
+        """
+        self.max_keys = max_keys or app.config.get('EMAIL_DEDUP_MAX_KEYS', 10000)
+        if store_path is None:
+            store_path = app.config.get('EMAIL_DEDUP_PATH')
+        self.store_path = store_path
+        self.duplicates = []
+        super(Mail, self).init_app(app, **kwargs)
+
+    def get_store(self):
+        """Returns the key store shared by all connections of the app."""
+        app = current_app._get_current_object()
+        with _stores_lock:
+            stores = app.extensions.setdefault('email_dedup', {})
+            if self.store_path not in stores:
+                if self.store_path is None:
+                    stores[None] = MemoryStore(self.max_keys)
+                else:
+                    stores[self.store_path] = SQLiteStore(self.store_path, self.max_keys)
+            return stores[self.store_path]
+
+    def send_messages(self, email_messages):
+        """
+        Sends the messages that were not delivered before and returns the
+        number of messages sent.
+        """
+        self.duplicates = []
+        if not email_messages:
+            return
+        store = self.get_store()
+        new_conn_created = self.open()
+        try:
+            num_sent = 0
+            for message in email_messages:
+                key = message.get_idempotency_key()
+                if key in store:
+                    self.duplicates.append(message)
+                    continue
+                if count_sent(self.connection.send_messages([message])):
+                    store.add(key)
+                    num_sent += 1
+        finally:
+            if new_conn_created:
+                self.close()
+        return num_sent
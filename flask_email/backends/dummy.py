@@ -1,8 +1,11 @@
-from .base import BaseMail
+from .base import BaseMail, instrumented
 
 class Mail(BaseMail):
     """
     Dummy email backend that does nothing.
     """
+    @instrumented
     def send_messages(self, email_messages):
+        self.record_sending(email_messages)
+        self.record_sent(email_messages)
         return len(email_messages)
@@ -1,20 +1,162 @@
+from __future__ import with_statement
+
+import atexit
+import bz2
 import datetime
+import gzip
+import itertools
 import os
+import Queue
+import shutil
+import socket
+import sys
+import threading
+import time
+
+from flask import current_app
 
+from .base import instrumented
 from .console import Mail as ConsoleMail
 
+FSYNC_POLICIES = (None, 'batch', 'message')
+
+# Compressed file openers and extensions by name.
+COMPRESSORS = {
+    'gzip': (gzip.open, '.gz'),
+    'bz2': (bz2.BZ2File, '.bz2'),
+}
+
+# Maildir file names are unique by time, process, counter and host.
+_counter = itertools.count()
+_hostname = socket.gethostname().replace('/', r'\057').replace(':', r'\072')
+
+_compressors_lock = threading.Lock()
+
+
+def compress_file(path, compress):
+    """
+    Compresses a file with the named compressor, streaming it in chunks,
+    and removes it. The compressed file is written under a temporary name
+    and renamed once complete.
+    """
+    opener, extension = COMPRESSORS[compress]
+    tmp_path = path + extension + '.tmp'
+    src = open(path, 'rb')
+    try:
+        dst = opener(tmp_path, 'wb')
+        try:
+            shutil.copyfileobj(src, dst)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+    os.rename(tmp_path, path + extension)
+    os.unlink(path)
+
+
+class Compressor(object):
+    """
+    Thread compressing rotated log files, so that a rotation does not hold
+    up the thread sending the message that triggered it for a whole pass
+    over the file.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def put(self, path, compress):
+        """Queues the file at path to be compressed and removed."""
+        self.queue.put((path, compress))
+
+    def flush(self):
+        """Waits until every queued file is compressed."""
+        self.queue.join()
+
+    def stop(self):
+        """Compresses the queued files and stops the thread."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                compress_file(*item)
+            except Exception:
+                self.app.logger.exception('Error compressing %s' % item[0])
+            finally:
+                self.queue.task_done()
+
+
+def get_compressor():
+    """Returns the compressor thread of the app, starting it if needed."""
+    app = current_app._get_current_object()
+    with _compressors_lock:
+        compressor = app.extensions.get('email_compressor')
+        if compressor is None or not compressor.thread.is_alive():
+            compressor = app.extensions['email_compressor'] = Compressor(app)
+        return compressor
+
+
 class Mail(ConsoleMail):
     """
     Email backend that writes messages to a file.
+
+    Log files can be rotated by size or age. Every rotated file is
+    compressed if a compressor is configured, by a :class:`Compressor`
+    thread.
+
+    In Maildir mode, every message is written to its own file in the
+    ``tmp`` directory and then renamed into ``new``, so that any number of
+    processes can write to the same directory without locking, and readers
+    only ever see complete messages.
     """
+    # Files kept open for syncing a batch at once.
+    max_pending = 256
 
-    def init_app(self, app, **kwargs):
+    def init_app(self, app, max_bytes=None, max_age=None, compress=None,
+                 maildir=None, fsync=None, **kwargs):
         """
         :param app: Flask application instance
         :param file_path: File like object. Default: `  `EMAIL_FILE_PATH``
+        :param max_bytes: Size in bytes at which log files are rotated.
+            Default: ``EMAIL_FILE_MAX_BYTES``
+        :param max_age: Age in seconds at which log files are rotated.
+            Default: ``EMAIL_FILE_MAX_AGE``
+        :param compress: Compress rotated log files with ``'gzip'`` or
+            ``'bz2'``. Default: ``EMAIL_FILE_COMPRESS``
+        :param maildir: Write a Maildir instead of log files. Messages are
+            then always written by the sending thread, whatever
+            ``background`` is. Default: ``EMAIL_FILE_MAILDIR``
+        :param fsync: When to sync messages to disk in Maildir mode: ``None``,
+            once per ``'batch'`` or for every ``'message'``. Default:
+            ``EMAIL_FILE_FSYNC``
         :param \*\*kwargs: Ignorable options
         """
         self._fname = None
+        self._segment = 0
+        self._segment_started = None
+        self.max_bytes = max_bytes or app.config.get('EMAIL_FILE_MAX_BYTES')
+        self.max_age = max_age or app.config.get('EMAIL_FILE_MAX_AGE')
+        self.compress = compress or app.config.get('EMAIL_FILE_COMPRESS')
+        if self.compress is not None and self.compress not in COMPRESSORS:
+            raise Exception('Invalid compressor: %r' % self.compress)
+        if maildir is None:
+            maildir = app.config.get('EMAIL_FILE_MAILDIR', False)
+        self.maildir = maildir
+        if fsync is None:
+            fsync = app.config.get('EMAIL_FILE_FSYNC')
+        if fsync not in FSYNC_POLICIES:
+            raise Exception('Invalid fsync policy: %r' % fsync)
+        self.fsync = fsync
         if 'file_path' in kwargs:
             self.file_path = kwargs.pop('file_path')
         else:
@@ -35,23 +177,77 @@ class Mail(ConsoleMail):
         # Make sure that self.file_path is writable.
         if not os.access(self.file_path, os.W_OK):
             raise Exception('Could not write to directory: %s' % self.file_path)
+        if self.maildir:
+            for subdir in ('tmp', 'new', 'cur'):
+                path = os.path.join(self.file_path, subdir)
+                if not os.path.isdir(path):
+                    os.mkdir(path)
         # Finally, call super().
         # Since we're using the console-based backend as a base,
         # force the stream to be None, so we don't default to stdout
         kwargs['stream'] = None
         super(Mail, self).init_app(app, **kwargs)
 
+    def get_batch_key(self):
+        return (super(Mail, self).get_batch_key(), self.file_path)
+
     def _get_filename(self):
         """Return a unique file name."""
         if self._fname is None:
             timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-            fname = "%s-%s.log" % (timestamp, abs(id(self)))
+            if self._segment:
+                fname = "%s-%s-%d.log" % (timestamp, abs(id(self)), self._segment)
+            else:
+                fname = "%s-%s.log" % (timestamp, abs(id(self)))
             self._fname = os.path.join(self.file_path, fname)
+            self._segment_started = time.time()
         return self._fname
 
+    def _write(self, data):
+        if self._should_rotate():
+            self.rotate()
+        super(Mail, self)._write(data)
+
+    def _should_rotate(self):
+        """Whether the log file is due for rotation, if it is not empty."""
+        if not self.stream.tell():
+            return False
+        if self.max_bytes and self.stream.tell() >= self.max_bytes:
+            return True
+        return bool(self.max_age and time.time() - self._segment_started >= self.max_age)
+
+    def rotate(self):
+        """
+        Closes the current log file, queuing it to be compressed if a
+        compressor is configured, and continues in a new file. Log files
+        are rotated before a message is written to them once they are over
+        :attr:`max_bytes` or :attr:`max_age`.
+        """
+        reopen = self.stream is not None
+        self.close()
+        if self.compress:
+            get_compressor().put(self._fname, self.compress)
+        self._fname = None
+        self._segment += 1
+        if reopen:
+            self.open()
+
+    def flush(self):
+        """
+        Waits until queued messages are written and rotated log files are
+        compressed.
+        """
+        super(Mail, self).flush()
+        if self.compress:
+            get_compressor().flush()
+
     def open(self):
+        if self.maildir:
+            return False
         if self.stream is None:
             self.stream = open(self._get_filename(), 'a')
+            # Move to the end, for tell() to be the size of the file.
+            self.stream.seek(0, 2)
             return True
         return False
 
@@ -62,3 +258,99 @@ class Mail(ConsoleMail):
         finally:
             self.stream = None
 
+    @instrumented
+    def send_messages(self, email_messages):
+        """
+        Writes the messages to the log file, or to the Maildir. When writing
+        to the Maildir fails, the messages already moved to ``new`` are
+        still counted as sent.
+
+        :returns: Number of messages sent
+        :rtype: int
+        """
+        if not self.maildir:
+            return super(Mail, self).send_messages(email_messages)
+        if not email_messages:
+            return
+        self.record_sending(email_messages)
+        delivered = []
+        try:
+            pending = []
+            try:
+                for message in email_messages:
+                    with self.message_span(message):
+                        pending.append((message,) + self._write_maildir(message))
+                    if self.fsync != 'batch' or len(pending) >= self.max_pending:
+                        batch, pending = pending, []
+                        self._deliver(batch, delivered)
+            finally:
+                self._deliver(pending, delivered)
+        except:
+            error = sys.exc_info()
+            self.record_sent(delivered)
+            # Messages are delivered in order.
+            self.record_failed(email_messages[len(delivered):], error[1])
+            if not self.fail_silently:
+                raise error[0], error[1], error[2]
+        else:
+            self.record_sent(email_messages)
+        return len(delivered)
+
+    def _get_maildir_name(self):
+        """Return a unique Maildir file name."""
+        now = time.time()
+        return '%d.M%dP%dQ%d.%s' % (now, (now % 1) * 1e6, os.getpid(),
+                                    _counter.next(), _hostname)
+
+    def _write_maildir(self, message):
+        """
+        Writes message to a new file in ``tmp``. Returns the file, still
+        open, and its name.
+        """
+        name = self._get_maildir_name()
+        path = os.path.join(self.file_path, 'tmp', name)
+        f = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666), 'wb')
+        try:
+            data = self.render(message)
+            with self.timed('transmit'):
+                if isinstance(data, basestring):
+                    f.write(data)
+                else:
+                    try:
+                        shutil.copyfileobj(data, f)
+                    finally:
+                        data.close()
+                f.flush()
+        except:
+            f.close()
+            os.unlink(path)
+            raise
+        return f, name
+
+    def _deliver(self, pending, delivered):
+        """
+        Moves files written to ``tmp`` to ``new``, given as a list of the
+        messages, their open files and their names, and appends the messages
+        moved to delivered. With an fsync policy, the files are synced before
+        they are moved, and the directory after.
+        """
+        if not pending:
+            return
+        with self.timed('transmit'):
+            try:
+                if self.fsync:
+                    for message, f, name in pending:
+                        os.fsync(f.fileno())
+            finally:
+                for message, f, name in pending:
+                    f.close()
+            for message, f, name in pending:
+                os.rename(os.path.join(self.file_path, 'tmp', name),
+                          os.path.join(self.file_path, 'new', name))
+                delivered.append(message)
+            if self.fsync:
+                fd = os.open(os.path.join(self.file_path, 'new'), os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
@@ -1,8 +1,142 @@
 """
 Backend for test environment.
+
+Messages are stored in the outbox of the application, see
+:func:`get_outbox`, and for backwards compatibility in the module level
+``outbox`` list shared by all applications.
 """
+from __future__ import with_statement
+
+import threading
+from collections import deque
+from email.utils import parseaddr
+
+from flask import current_app
+
 import flask.ext.email.backends.locmem as mail
-from .base import BaseMail
+from .base import BaseMail, instrumented
+
+_outboxes_lock = threading.Lock()
+
+
+class Outbox(object):
+    """
+    Messages sent by an application, indexed by recipient, subject and
+    Message-ID header, so that looking them up does not scan the outbox.
+
+    With a capacity, only the last capacity messages are kept.
+    """
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        # (message, keys) pairs: the keys a message was indexed under are
+        # kept, as the message may be changed after it was sent.
+        self._entries = deque(maxlen=capacity)
+        self._indexes = {'to': {}, 'subject': {}, 'message_id': {}}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        with self._lock:
+            return iter([message for message, keys in self._entries])
+
+    def __getitem__(self, index):
+        return self._entries[index][0]
+
+    def _get_keys(self, message):
+        """Returns the keys of a message in each index."""
+        keys = {
+            'to': set(parseaddr(addr)[1].lower() for addr in message.recipients()),
+            'subject': [message.subject],
+            'message_id': [],
+        }
+        for name, value in message.extra_headers.items():
+            if name.lower() == 'message-id':
+                keys['message_id'].append(value)
+        return keys
+
+    def append(self, message):
+        with self._lock:
+            if self.capacity and len(self._entries) == self.capacity:
+                self._unindex(self._entries[0][1])
+            message_keys = self._get_keys(message)
+            self._entries.append((message, message_keys))
+            for name, keys in message_keys.items():
+                index = self._indexes[name]
+                for key in keys:
+                    index.setdefault(key, deque()).append(message)
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def _unindex(self, message_keys):
+        # The oldest message is first in each of its index entries.
+        for name, keys in message_keys.items():
+            index = self._indexes[name]
+            for key in keys:
+                entries = index[key]
+                entries.popleft()
+                if not entries:
+                    del index[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for index in self._indexes.values():
+                index.clear()
+
+    def filter(self, to=None, subject=None, message_id=None):
+        """
+        Returns the messages, oldest first, sent to the given recipient
+        address (in To, Cc or Bcc), with the given subject and Message-ID
+        header. Criteria left to None match any message.
+        """
+        criteria = dict((name, key) for name, key in (
+            ('to', to and parseaddr(to)[1].lower()),
+            ('subject', subject),
+            ('message_id', message_id)) if key is not None)
+        with self._lock:
+            if not criteria:
+                return [message for message, keys in self._entries]
+            candidates = []
+            for name, key in criteria.items():
+                entries = self._indexes[name].get(key)
+                if not entries:
+                    return []
+                candidates.append(entries)
+            candidates.sort(key=len)
+            if len(candidates) == 1:
+                return list(candidates[0])
+            others = [set(map(id, entries)) for entries in candidates[1:]]
+            return [message for message in candidates[0]
+                    if all(id(message) in ids for ids in others)]
+
+    def get(self, message_id):
+        """
+        Returns the last message sent with the given Message-ID header, or
+        None.
+        """
+        with self._lock:
+            entries = self._indexes['message_id'].get(message_id)
+            return entries[-1] if entries else None
+
+
+def get_outbox(app=None):
+    """
+    Returns the :class:`Outbox` of the app, holding at most
+    ``EMAIL_LOCMEM_CAPACITY`` messages.
+    """
+    app = app or current_app
+    with _outboxes_lock:
+        outbox = app.extensions.get('email_outbox')
+        if outbox is None:
+            outbox = app.extensions['email_outbox'] = Outbox(
+                app.config.get('EMAIL_LOCMEM_CAPACITY'))
+        return outbox
+
 
 class Mail(BaseMail):
     """A email backend for use during test sessions.
@@ -12,12 +146,27 @@ class Mail(BaseMail):
 
     The dummy outbox is accessible through the outbox instance attribute.
     """
-    def init_app(self, app, **kwargs):
+    def init_app(self, app, global_outbox=None, **kwargs):
+        """
+        :param app: Flask application instance
+        :param global_outbox: Also store messages in the module level
+            ``outbox`` list. Default: ``EMAIL_LOCMEM_GLOBAL_OUTBOX``
+        :param \*\*kwargs: Ignorable options
+        """
         super(Mail, self).init_app(app, **kwargs)
+        if global_outbox is None:
+            global_outbox = app.config.get('EMAIL_LOCMEM_GLOBAL_OUTBOX', True)
+        self.global_outbox = global_outbox
         if not hasattr(mail, 'outbox'):
             mail.outbox = []
 
+    @instrumented
     def send_messages(self, messages):
         """Redirect messages to the dummy outbox"""
-        mail.outbox.extend(messages)
+        self.record_sending(messages)
+        if getattr(self, 'global_outbox', True):
+            mail.outbox.extend(messages)
+        if current_app:
+            get_outbox().extend(messages)
+        self.record_sent(messages)
         return len(messages)
@@ -0,0 +1,275 @@
+"""
+Email backend that schedules messages through weighted priority lanes.
+
+Each message is queued in the lane named by its ``priority`` attribute.
+A pool of worker threads, shared by all connections of an application,
+takes messages from the lanes in proportion to their weights, runs at most
+``concurrency`` messages of a lane at a time and sends them through the
+wrapped backend. When the total number of queued messages reaches a lane's
+``shed_at`` depth, new messages for that lane are dropped instead of queued.
+"""
+from __future__ import with_statement
+
+import atexit
+import sys
+import threading
+import time
+from collections import deque
+
+from flask import current_app
+
+from ..results import count_sent
+from .proxy import Mail as ProxyMail
+
+DEFAULT_LANES = {
+    'high': {'weight': 8, 'concurrency': 4},
+    'normal': {'weight': 4, 'concurrency': 2},
+    'low': {'weight': 1, 'concurrency': 1, 'shed_at': 10000},
+}
+
+_schedulers_lock = threading.Lock()
+
+
+class Job(object):
+    """A message waiting in, or taken from, a lane."""
+
+    def __init__(self, message, lane):
+        self.message = message
+        self.lane = lane
+        self.sent = 0
+        self.exc_info = None
+        self.done = threading.Event()
+
+
+class Lane(object):
+    """A queue of jobs sharing a weight and a concurrency limit."""
+
+    def __init__(self, name, weight=1, concurrency=1, shed_at=None):
+        self.name = name
+        self.weight = weight
+        self.concurrency = concurrency
+        self.shed_at = shed_at
+        self.queue = deque()
+        self.in_flight = 0
+        self.current_weight = 0
+
+    def is_ready(self):
+        return bool(self.queue) and self.in_flight < self.concurrency
+
+
+class Scheduler(object):
+    """
+    Hands jobs from the lanes to worker threads, picking lanes by smooth
+    weighted round robin among the lanes that have jobs queued and are
+    below their concurrency limit.
+    """
+
+    def __init__(self, lanes=None, default_lane='normal'):
+        lanes = lanes or DEFAULT_LANES
+        self.lanes = sorted([Lane(name, **options) for name, options in lanes.items()],
+                            key=lambda lane: -lane.weight)
+        self.default_lane = default_lane
+        self.depth = 0
+        self.condition = threading.Condition()
+        self.workers = []
+        self.stopped = False
+
+    def get_lane(self, priority):
+        name = priority or self.default_lane
+        for lane in self.lanes:
+            if lane.name == name:
+                return lane
+        raise Exception('Unknown email priority: %r' % name)
+
+    def submit(self, message):
+        """
+        Queue a message. Returns its :class:`Job`, or None if the message
+        was shed.
+        """
+        lane = self.get_lane(message.priority)
+        with self.condition:
+            if lane.shed_at is not None and self.depth >= lane.shed_at:
+                return None
+            job = Job(message, lane)
+            lane.queue.append(job)
+            self.depth += 1
+            self.condition.notify()
+        return job
+
+    def cancel(self, job):
+        """
+        Remove a job from its lane. Returns False if the job was already
+        taken by a worker.
+        """
+        with self.condition:
+            try:
+                job.lane.queue.remove(job)
+            except ValueError:
+                return False
+            self.depth -= 1
+            return True
+
+    def next_job(self, block=True):
+        """
+        Take the next job to send. Returns None if nothing can be sent and
+        block is False, or once the scheduler is stopped and drained.
+        """
+        with self.condition:
+            job = self._select()
+            while job is None and block and not self.stopped:
+                self.condition.wait()
+                job = self._select()
+            return job
+
+    def _select(self):
+        best = None
+        total = 0
+        for lane in self.lanes:
+            if not lane.is_ready():
+                continue
+            lane.current_weight += lane.weight
+            total += lane.weight
+            if best is None or lane.current_weight > best.current_weight:
+                best = lane
+        if best is None:
+            return None
+        best.current_weight -= total
+        best.in_flight += 1
+        self.depth -= 1
+        return best.queue.popleft()
+
+    def task_done(self, job):
+        with self.condition:
+            job.lane.in_flight -= 1
+            self.condition.notify_all()
+        job.done.set()
+
+    def start(self, app, get_backend, workers):
+        """Start worker threads sending through backends from get_backend."""
+        for i in range(workers):
+            worker = threading.Thread(target=self._work, args=(app, get_backend))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Sends the queued messages and stops the worker threads."""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+    def _work(self, app, get_backend):
+        with app.app_context():
+            connection = None
+            while True:
+                job = self.next_job(block=False)
+                if job is None:
+                    # Idle: don't hold on to the connection.
+                    connection = _close(connection)
+                    job = self.next_job()
+                    if job is None:
+                        return
+                try:
+                    if connection is None:
+                        connection = get_backend()
+                        connection.open()
+                    job.sent = count_sent(connection.send_messages([job.message]))
+                except Exception:
+                    job.exc_info = sys.exc_info()
+                    connection = _close(connection)
+                finally:
+                    self.task_done(job)
+
+
+def _close(connection):
+    if connection is not None:
+        try:
+            connection.close()
+        except Exception:
+            pass
+    return None
+
+
+class Mail(ProxyMail):
+    """
+    Email backend that sends messages through priority lanes.
+
+    Configure the wrapped backend with ``EMAIL_PRIORITY_BACKEND`` and set
+    ``priority`` on messages to pick a lane.
+    """
+    backend_setting = 'EMAIL_PRIORITY_BACKEND'
+
+    def init_app(self, app, lanes=None, default_priority=None, workers=None,
+                 timeout=None, **kwargs):
+        """
+        :param app: Flask application instance
+        :param lanes: Lane options by name. Default: ``EMAIL_PRIORITY_LANES``
+        :param default_priority: Lane for messages without a priority.
+            Default: ``EMAIL_PRIORITY_DEFAULT``
+        :param workers: Number of worker threads. Default:
+            ``EMAIL_PRIORITY_WORKERS`` or the sum of the lane concurrencies
+        :param timeout: Seconds to wait for messages to be sent, after which
+            they fail. Default: ``EMAIL_PRIORITY_TIMEOUT`` or no limit
+        :param \*\*kwargs: Options passed to :class:`~.proxy.Mail`
+        """
+        self.lanes = lanes or app.config.get('EMAIL_PRIORITY_LANES', DEFAULT_LANES)
+        self.default_priority = (default_priority or
+                                 app.config.get('EMAIL_PRIORITY_DEFAULT', 'normal'))
+        self.workers = workers or app.config.get('EMAIL_PRIORITY_WORKERS') or \
+            sum(options.get('concurrency', 1) for options in self.lanes.values())
+        self.timeout = timeout or app.config.get('EMAIL_PRIORITY_TIMEOUT')
+        super(Mail, self).init_app(app, **kwargs)
+
+    def get_scheduler(self):
+        """Returns the scheduler shared by all connections of the app."""
+        app = current_app._get_current_object()
+        key = (self.backend, self.fail_silently,
+               repr(sorted(self.backend_options.items())))
+        with _schedulers_lock:
+            schedulers = app.extensions.setdefault('email_priority', {})
+            if key not in schedulers or schedulers[key].stopped:
+                scheduler = Scheduler(self.lanes, self.default_priority)
+                scheduler.start(app, self.get_backend, self.workers)
+                schedulers[key] = scheduler
+            return schedulers[key]
+
+    def open(self):
+        """Connections are managed by the scheduler's workers."""
+        return False
+
+    def close(self):
+        pass
+
+    def send_messages(self, email_messages):
+        """
+        Queue messages in their lanes and wait for them to be sent. Shed
+        messages are not counted as sent, nor are messages still queued or
+        sending when the timeout runs out, which are taken off their lanes
+        if they have not been picked up yet.
+        """
+        if not email_messages:
+            return
+        scheduler = self.get_scheduler()
+        jobs = [scheduler.submit(message) for message in email_messages]
+        num_shed = jobs.count(None)
+        if num_shed:
+            current_app.logger.warning('Shed %d low priority email messages', num_shed)
+        deadline = self.timeout and time.time() + self.timeout
+        num_sent = 0
+        num_timed_out = 0
+        for job in jobs:
+            if job is None:
+                continue
+            if not job.done.wait(deadline and max(deadline - time.time(), 0)):
+                scheduler.cancel(job)
+                num_timed_out += 1
+                continue
+            if job.exc_info is not None and not self.fail_silently:
+                raise job.exc_info[0], job.exc_info[1], job.exc_info[2]
+            num_sent += job.sent
+        if num_timed_out and not self.fail_silently:
+            raise Exception('Timed out sending %d email messages' % num_timed_out)
+        return num_sent
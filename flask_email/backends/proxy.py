@@ -0,0 +1,71 @@
+"""
+Base class for backends that hand messages on to another backend.
+"""
+from .base import BaseMail
+
+
+class Mail(BaseMail):
+    """
+    Email backend wrapping another backend.
+
+    The wrapped backend is given by the ``backend`` option, or by the
+    setting named in :attr:`backend_setting`. Remaining options are passed
+    on to the wrapped backend.
+    """
+    #: Setting holding the import path of the wrapped backend
+    backend_setting = None
+
+    def init_app(self, app, backend=None, fail_silently=False, **kwargs):
+        """
+        :param app: Flask application instance
+        :param backend: Import path of the wrapped backend
+        :param bool fail_silently: Email fails silently on errors
+        :param \*\*kwargs: Options for the wrapped backend
+        """
+        if backend is None and self.backend_setting:
+            backend = app.config.get(self.backend_setting)
+        if backend is None:
+            raise Exception('Email backend to wrap required')
+        self.backend = backend
+        self.backend_options = kwargs
+        self.connection = None
+        self._batch_key = None
+        super(Mail, self).init_app(app, fail_silently=fail_silently)
+
+    def get_backend(self):
+        """Returns a new instance of the wrapped backend."""
+        from .. import get_connection
+        return get_connection(self.backend, fail_silently=self.fail_silently,
+                              **self.backend_options)
+
+    def get_batch_key(self):
+        if self._batch_key is None:
+            # The wrapped backend's key only depends on its options, so
+            # build it once rather than for every message batched.
+            self._batch_key = (super(Mail, self).get_batch_key(), self.backend,
+                               self.get_backend().get_batch_key())
+        return self._batch_key
+
+    def open(self):
+        """
+        Opens the wrapped backend, which is then reused until :meth:`close`.
+        """
+        if self.connection is not None:
+            return False
+        self.connection = self.get_backend()
+        self._connection_opened = self.connection.open()
+        return True
+
+    def close(self):
+        if self.connection is None:
+            return
+        try:
+            if self._connection_opened:
+                self.connection.close()
+        finally:
+            self.connection = None
+
+    def send_messages(self, email_messages):
+        if self.connection is None:
+            return self.get_backend().send_messages(email_messages)
+        return self.connection.send_messages(email_messages)
@@ -0,0 +1,89 @@
+"""
+Email backend that caps the rate of messages handed to another backend.
+
+With ``EMAIL_RATE_LIMIT_PATH`` set, the token bucket is kept in that file
+and shared by every process on the host using the same path, e.g. all
+gunicorn workers, so together they stay under the relay's limit. Without
+it, the bucket is shared by the connections of the application only.
+"""
+from __future__ import with_statement
+
+import threading
+
+from flask import current_app
+
+from ..ratelimit import TokenBucket, SharedTokenBucket
+from ..results import count_sent
+from .proxy import Mail as ProxyMail
+
+_buckets_lock = threading.Lock()
+
+
+class Mail(ProxyMail):
+    """
+    Email backend that sends at most ``EMAIL_RATE_LIMIT`` messages per second.
+
+    Configure the wrapped backend with ``EMAIL_RATE_LIMIT_BACKEND``. In
+    non-blocking mode, messages that would exceed the rate are not sent and
+    are listed in :attr:`throttled`.
+    """
+    backend_setting = 'EMAIL_RATE_LIMIT_BACKEND'
+
+    def init_app(self, app, rate=None, burst=None, path=None, blocking=None,
+                 **kwargs):
+        """
+        :param app: Flask application instance
+        :param rate: Messages per second. Default: ``EMAIL_RATE_LIMIT``
+        :param burst: Maximum burst of messages. Default:
+            ``EMAIL_RATE_LIMIT_BURST`` or the rate
+        :param path: File shared with other processes. Default:
+            ``EMAIL_RATE_LIMIT_PATH``
+        :param blocking: Wait for the rate instead of skipping messages.
+            Default: ``EMAIL_RATE_LIMIT_BLOCKING``
+        :param \*\*kwargs: Options passed to :class:`~.proxy.Mail`
+        """
+        self.rate = rate or app.config.get('EMAIL_RATE_LIMIT')
+        if not self.rate:
+            raise Exception('EMAIL_RATE_LIMIT required')
+        self.burst = burst or app.config.get('EMAIL_RATE_LIMIT_BURST')
+        self.path = path or app.config.get('EMAIL_RATE_LIMIT_PATH')
+        if blocking is None:
+            blocking = app.config.get('EMAIL_RATE_LIMIT_BLOCKING', True)
+        self.blocking = blocking
+        self.throttled = []
+        super(Mail, self).init_app(app, **kwargs)
+
+    def get_bucket(self):
+        """Returns the token bucket shared by all connections of the app."""
+        app = current_app._get_current_object()
+        key = (self.path, self.rate, self.burst)
+        with _buckets_lock:
+            buckets = app.extensions.setdefault('email_rate_limit', {})
+            if key not in buckets:
+                if self.path is None:
+                    buckets[key] = TokenBucket(self.rate, self.burst)
+                else:
+                    buckets[key] = SharedTokenBucket(self.path, self.rate, self.burst)
+            return buckets[key]
+
+    def send_messages(self, email_messages):
+        """
+        Sends one or more EmailMessage objects and returns the number of email
+        messages sent.
+        """
+        self.throttled = []
+        if not email_messages:
+            return
+        bucket = self.get_bucket()
+        new_conn_created = self.open()
+        try:
+            num_sent = 0
+            for i, message in enumerate(email_messages):
+                if not bucket.acquire(blocking=self.blocking):
+                    self.throttled = list(email_messages[i:])
+                    break
+                num_sent += count_sent(self.connection.send_messages([message]))
+        finally:
+            if new_conn_created:
+                self.close()
+        return num_sent
@@ -1,61 +1,108 @@
 """
 REST email backend class via requests.
 """
-from flask.ext.email.backends.base import BaseMail
+from __future__ import with_statement
+
+from flask.ext.email.backends.base import BaseMail, instrumented
 from flask.ext.email.message import sanitize_address
+from flask.ext.email.results import SendResult, count_sent
 
+import sys
 import threading
 import requests
 
 
 class Mail(BaseMail):
-    def init_app(self, app, endpoint=None, **kwargs):
+    def init_app(self, app, endpoint=None, return_results=False, **kwargs):
         if endpoint is None:
             raise Exception('API endpoint required')
         else:
             self.endpoint = endpoint
+        self.return_results = return_results
+        self.last_results = []
 
         self._lock = threading.RLock()
         super(Mail, self).init_app(app, **kwargs)
 
+    def get_batch_key(self):
+        return (super(Mail, self).get_batch_key(), self.endpoint)
+
+    @instrumented
     def send_messages(self, email_messages):
         """
         Sends one or more EmailMessage objects and returns the number of email
         messages sent.
+
+        The :class:`~flask.ext.email.results.SendResult` of every message
+        are kept in :attr:`last_results`, and returned instead of the number
+        if the backend was created with ``return_results=True``.
         """
+        self.last_results = []
         if not email_messages:
             return
         self._lock.acquire()
         try:
             new_conn_created = self.open()
-            num_sent = 0
+            results = []
             for message in email_messages:
                 if not message.recipients():
+                    results.append(SendResult(message))
                     continue
-                sent = self._send(message)
-                if sent:
-                    num_sent += 1
+                with self.message_span(message):
+                    results.append(self._send(message))
             if new_conn_created:
                 self.close()
         finally:
             self._lock.release()
-        return num_sent
+        self.last_results = results
+        if self.return_results:
+            return results
+        return count_sent(results)
 
     def _send(self, email_message):
-        """A helper method that does the actual sending."""
+        """
+        A helper method that does the actual sending. Returns a
+        :class:`~flask.ext.email.results.SendResult`.
+        """
+        recipients = email_message.recipients()
+        self.record_sending([email_message])
         try:
-            response = requests.post(self.endpoint, 
-                **self._prepare_request_kwargs(email_message)
-            )
-            if response.status_code != requests.codes.ok:
-                if not self.fail_silently:
-                    raise Exception(response.text)
-                return False
-            return True
+            with self.timed('serialize'):
+                kwargs = self._prepare_request_kwargs(email_message)
+            with self.timed('response'):
+                response = requests.post(self.endpoint, **kwargs)
         except:
+            error = sys.exc_info()[1]
+            self.record_failed([email_message], error)
             if not self.fail_silently:
                 raise
-        return False
+            return SendResult(email_message, recipients, error=error)
+        return self._get_result(email_message, response)
+
+    def _get_result(self, email_message, response):
+        """
+        Records the outcome of the response to a message and returns its
+        :class:`~flask.ext.email.results.SendResult`.
+        """
+        recipients = email_message.recipients()
+        if response.status_code != requests.codes.ok:
+            self.record_failed([email_message])
+            if not self.fail_silently:
+                raise Exception(response.text)
+            return SendResult(email_message, recipients, refused=dict(
+                (addr, self._get_code(response)) for addr in recipients))
+        self.record_sent([email_message])
+        return SendResult(email_message, recipients)
+
+    def _get_code(self, response):
+        """
+        Maps an error response to an SMTP-like (code, response) pair:
+        rate limiting and server errors are temporary, other errors are
+        permanent.
+        """
+        if response.status_code == 429 or response.status_code >= 500:
+            return (450, response.text)
+        return (550, response.text)
 
     def _prepare_request_kwargs(self, email_message):
         from_email = sanitize_address(email_message.from_email, email_message.encoding)
@@ -1,12 +1,15 @@
 """
 Asynchronous REST email backend class via grequests.
 """
+from __future__ import with_statement
+
 import warnings
-import requests
 import grequests
 warnings.warn('grequests has a problem running with Flask with the following \
     error gevent is only usable from a single thread', RuntimeWarning)
 
+from ..base import instrumented
+from ...results import SendResult, count_sent
 from . import Mail as RESTMail
 
 
@@ -15,32 +18,50 @@ class Mail(RESTMail):
         self.concurrency = concurrency
         super(Mail, self).init_app(app, **kwargs)
 
+    @instrumented
     def send_messages(self, email_messages):
         """
         Sends one or more EmailMessage objects and returns the number of email
         messages sent.
+
+        Like :meth:`.rest.Mail.send_messages`, the
+        :class:`~flask.ext.email.results.SendResult` of every message are
+        kept in :attr:`last_results`, and returned instead of the number if
+        the backend was created with ``return_results=True``.
         """
+        self.last_results = []
         if not email_messages:
             return
         self._lock.acquire()
         try:
             new_conn_created = self.open()
-            num_sent = 0
 
-            reqs = [grequests.post(self.endpoint, 
-                **self._prepare_request_kwargs(msg)
-            ) for msg in email_messages if msg.recipients()]
+            messages = [msg for msg in email_messages if msg.recipients()]
+            self.record_sending(messages)
+            with self.timed('serialize'):
+                reqs = [grequests.post(self.endpoint,
+                    **self._prepare_request_kwargs(msg)
+                ) for msg in messages]
 
-            responses = grequests.map(reqs, size=self.concurrency)
+            with self.timed('response'):
+                responses = grequests.map(reqs, size=self.concurrency)
 
-            for response in responses:
-                if response.status_code != requests.codes.ok:
+            sent = {}
+            for msg, req, response in zip(messages, reqs, responses):
+                if response is None:
+                    # The request failed before the server answered.
+                    self.record_failed([msg], req.exception)
                     if not self.fail_silently:
-                        raise Exception(response.text)
+                        raise req.exception
+                    sent[id(msg)] = SendResult(msg, msg.recipients(), error=req.exception)
                 else:
-                    num_sent += 1
+                    sent[id(msg)] = self._get_result(msg, response)
+            results = [sent.get(id(msg)) or SendResult(msg) for msg in email_messages]
             if new_conn_created:
                 self.close()
         finally:
             self._lock.release()
-        return num_sent
\ No newline at end of file
+        self.last_results = results
+        if self.return_results:
+            return results
+        return count_sent(results)
\ No newline at end of file
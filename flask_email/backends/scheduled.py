@@ -0,0 +1,246 @@
+"""
+Email backend that holds messages until their ``send_at`` time.
+
+Pending messages are kept in a binary heap ordered by due time, shared by
+all connections of an application. A timer thread wakes up when the
+earliest message is due and sends all due messages through the wrapped
+backend in batches. Cancelled messages are only marked and skipped when
+they reach the top of the heap, and the heap is compacted when most of it
+is cancelled, so both scheduling and cancelling are cheap.
+
+The heap lives in memory: pending messages are lost when the process
+exits.
+"""
+from __future__ import with_statement
+
+import calendar
+import datetime
+import heapq
+import itertools
+import threading
+import time
+
+from flask import current_app
+
+from ..results import count_sent
+from .proxy import Mail as ProxyMail
+
+_timers_lock = threading.Lock()
+
+
+def get_due_time(email_message):
+    """
+    Returns the time (in seconds since the epoch) a message is due, from
+    its ``send_at`` and ``delay`` attributes, or None to send it right away.
+
+    ``send_at`` is a timestamp or a datetime. Naive datetimes are taken as
+    local time; aware datetimes can express any timezone, such as the
+    recipient's. ``delay`` is a number of seconds or a timedelta, counted
+    from ``send_at`` if both are given and from now otherwise.
+    """
+    send_at = getattr(email_message, 'send_at', None)
+    delay = getattr(email_message, 'delay', None)
+    if send_at is None and delay is None:
+        return None
+    if send_at is None:
+        due = time.time()
+    elif isinstance(send_at, datetime.datetime):
+        if send_at.utcoffset() is not None:
+            due = calendar.timegm(send_at.utctimetuple())
+        else:
+            due = time.mktime(send_at.timetuple())
+        due += send_at.microsecond / 1e6
+    else:
+        due = float(send_at)
+    if isinstance(delay, datetime.timedelta):
+        delay = delay.days * 86400 + delay.seconds + delay.microseconds / 1e6
+    return due + (delay or 0)
+
+
+class Handle(object):
+    """A scheduled message, which can be cancelled until it is sent."""
+    __slots__ = ('due', 'message', 'cancelled', 'timer')
+
+    def __init__(self, due, message, timer):
+        self.due = due
+        self.message = message
+        self.cancelled = False
+        self.timer = timer
+
+    def cancel(self):
+        """
+        Cancel the message. Returns False if it was already sent or
+        cancelled.
+        """
+        timer = self.timer
+        if timer is None:
+            return False
+        return timer.cancel(self)
+
+
+class TimerHeap(object):
+    """
+    Pending messages ordered by due time, and the thread sending them.
+    """
+
+    def __init__(self, app, get_backend, batch_size=100):
+        self.app = app
+        self.get_backend = get_backend
+        self.batch_size = batch_size
+        self.heap = []
+        self.counter = itertools.count()
+        self.num_cancelled = 0
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        """Start the thread sending due messages."""
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.heap) - self.num_cancelled
+
+    def schedule(self, message, due):
+        """Add a message to the heap. Returns its :class:`Handle`."""
+        handle = Handle(due, message, self)
+        with self.condition:
+            heapq.heappush(self.heap, (due, next(self.counter), handle))
+            if self.heap[0][2] is handle:
+                # New earliest message: the timer has to wake up sooner.
+                self.condition.notify()
+        return handle
+
+    def cancel(self, handle):
+        with self.condition:
+            if handle.cancelled or handle.timer is None:
+                return False
+            handle.cancelled = True
+            handle.message = None
+            self.num_cancelled += 1
+            if self.num_cancelled > 1024 and self.num_cancelled * 2 > len(self.heap):
+                self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+                heapq.heapify(self.heap)
+                self.num_cancelled = 0
+            return True
+
+    def pop_due(self, now=None):
+        """
+        Remove and return up to batch_size messages due at now. Must be
+        called with the condition held.
+        """
+        if now is None:
+            now = time.time()
+        messages = []
+        while self.heap and len(messages) < self.batch_size:
+            due, count, handle = self.heap[0]
+            if handle.cancelled:
+                heapq.heappop(self.heap)
+                self.num_cancelled -= 1
+                continue
+            if due > now:
+                break
+            heapq.heappop(self.heap)
+            handle.timer = None
+            messages.append(handle.message)
+            handle.message = None
+        return messages
+
+    def _wait(self):
+        with self.condition:
+            while True:
+                messages = self.pop_due()
+                if messages:
+                    return messages
+                timeout = None
+                if self.heap:
+                    timeout = max(self.heap[0][0] - time.time(), 0.01)
+                self.condition.wait(timeout)
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                messages = self._wait()
+                try:
+                    self.get_backend().send_messages(messages)
+                except Exception:
+                    self.app.logger.exception('Error sending scheduled email messages')
+
+
+class Mail(ProxyMail):
+    """
+    Email backend that delays messages with a ``send_at`` or ``delay``.
+
+    Configure the wrapped backend with ``EMAIL_SCHEDULED_BACKEND``. Messages
+    without a due time, or already due, are sent right away.
+
+    Scheduled messages get the :class:`Handle` cancelling them as their
+    ``handle`` attribute, so that messages sent with
+    :meth:`EmailMessage.send` can be cancelled too::
+
+        message = EmailMessage(..., delay=3600)
+        message.send()
+        message.handle.cancel()
+
+    The handles of the messages scheduled by the last :meth:`send_messages`
+    call are also listed in :attr:`handles`.
+    """
+    backend_setting = 'EMAIL_SCHEDULED_BACKEND'
+
+    def init_app(self, app, batch_size=None, **kwargs):
+        """
+        :param app: Flask application instance
+        :param batch_size: Maximum number of due messages sent at once.
+            Default: ``EMAIL_SCHEDULED_BATCH_SIZE``
+        :param \*\*kwargs: Options passed to :class:`~.proxy.Mail`
+        """
+        self.batch_size = batch_size or app.config.get('EMAIL_SCHEDULED_BATCH_SIZE', 100)
+        self.handles = []
+        super(Mail, self).init_app(app, **kwargs)
+
+    def get_timer(self):
+        """Returns the timer heap shared by all connections of the app."""
+        app = current_app._get_current_object()
+        key = (self.backend, self.fail_silently,
+               repr(sorted(self.backend_options.items())))
+        with _timers_lock:
+            timers = app.extensions.setdefault('email_scheduled', {})
+            if key not in timers:
+                timers[key] = TimerHeap(app, self.get_backend, self.batch_size)
+                timers[key].start()
+            return timers[key]
+
+    def schedule(self, email_message, due=None):
+        """
+        Schedule a message for its due time, or for the timestamp due.
+        Returns a :class:`Handle` that can be used to cancel it, also set
+        as the ``handle`` attribute of the message.
+        """
+        if due is None:
+            due = get_due_time(email_message)
+            if due is None:
+                due = time.time()
+        email_message.handle = self.get_timer().schedule(email_message, due)
+        return email_message.handle
+
+    def send_messages(self, email_messages):
+        """
+        Send due messages and schedule the others. Returns the number of
+        messages sent or scheduled.
+        """
+        self.handles = []
+        if not email_messages:
+            return
+        now = time.time()
+        immediate = []
+        for message in email_messages:
+            due = get_due_time(message)
+            if due is None or due <= now:
+                immediate.append(message)
+            else:
+                self.handles.append(self.schedule(message, due))
+        num_sent = 0
+        if immediate:
+            num_sent = count_sent(super(Mail, self).send_messages(immediate))
+        return num_sent + len(self.handles)
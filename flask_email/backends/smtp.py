@@ -1,22 +1,57 @@
 """
 Send email via SMTP
 """
+from __future__ import with_statement
+
+import copy
 import smtplib
 import socket
+import sys
 import threading
+import time
 
 from ..utils import DNS_NAME
 from ..message import sanitize_address
-from ..signals import email_dispatched
-from .base import BaseMail
+from ..results import SendResult, count_sent
+from ..tracing import get_context, use_context
+from .base import BaseMail, instrumented
+
+# Recipient limits learned from servers answering 452, by (host, port), as
+# (limit, time learned) pairs. They are forgotten after LEARNED_LIMIT_TTL
+# seconds, in case the server's limit was raised.
+_learned_max_recipients = {}
+LEARNED_LIMIT_TTL = 3600
+
+# Room for a DKIM-Signature header, which estimate_size() does not count.
+DKIM_SIGNATURE_SIZE = 1024
+
+
+def get_wire_size(data):
+    """
+    Returns the size in bytes of serialized data, a string or a file, sent
+    with CRLF line endings.
+    """
+    if isinstance(data, basestring):
+        return len(data) + data.count('\n') - data.count('\r\n')
+    size = 0
+    for chunk in iter(lambda: data.read(65536), ''):
+        size += len(chunk) + chunk.count('\n') - chunk.count('\r\n')
+    data.seek(0)
+    return size
 
 
 class Mail(BaseMail):
     """
     A wrapper that manages the SMTP network connection.
     """ 
+    # Share of the size limit within which estimated sizes are not trusted:
+    # such messages are rendered and measured before deciding.
+    size_margin = 0.1
+
     def init_app(self, app, host=None, port=None, username=None, password=None,
-                 use_tls=None, use_ssl=None, fail_silently=False, **kwargs):
+                 use_tls=None, use_ssl=None, coalesce=None, max_recipients=None,
+                 parallel=None, return_results=False, max_size=None,
+                 oversize_backend=None, fail_silently=False, **kwargs):
         self.host = host or app.config.get('EMAIL_HOST', 'localhost')
         self.port = int(port or app.config.get('EMAIL_PORT', 25))
         if username is None:
@@ -35,6 +70,17 @@ class Mail(BaseMail):
             self.use_ssl = bool(app.config.get('EMAIL_USE_SSL', False))
         else:
             self.use_ssl = use_ssl
+        if coalesce is None:
+            self.coalesce = app.config.get('EMAIL_SMTP_COALESCE', False)
+        else:
+            self.coalesce = coalesce
+        self.max_recipients = max_recipients or app.config.get('EMAIL_SMTP_MAX_RECIPIENTS')
+        self.parallel = parallel or app.config.get('EMAIL_SMTP_PARALLEL', 1)
+        self.return_results = return_results
+        self.max_size = max_size or app.config.get('EMAIL_SMTP_MAX_SIZE')
+        self.oversize_backend = oversize_backend or app.config.get('EMAIL_SMTP_OVERSIZE_BACKEND')
+        self.refused = {}
+        self.last_results = []
         self.connection = None
         self._lock = threading.RLock()
         super(Mail, self).init_app(app, fail_silently=fail_silently, **kwargs)
@@ -48,23 +94,64 @@ class Mail(BaseMail):
             # Nothing to do if the connection is already open.
             return False
         try:
-            # If local_hostname is not specified, socket.getfqdn() gets used.
-            # For performance, we use the cached FQDN for local_hostname.
-            SMTP = (smtplib.SMTP_SSL if self.use_ssl else smtplib.SMTP)
-            self.connection = SMTP(self.host, self.port,
-                                           local_hostname=DNS_NAME.get_fqdn())
-
-            if self.use_tls:
-                self.connection.ehlo()
-                self.connection.starttls()
-                self.connection.ehlo()
-            if self.username and self.password:
-                self.connection.login(self.username, self.password)
+            self.connection = self._connect()
             return True
         except:
+            self.count('connections', status='failed')
             if not self.fail_silently:
                 raise
 
+    def _connect(self):
+        """Returns a new, authenticated connection to the email server."""
+        # If local_hostname is not specified, socket.getfqdn() gets used.
+        # For performance, we use the cached FQDN for local_hostname.
+        SMTP = (smtplib.SMTP_SSL if self.use_ssl else smtplib.SMTP)
+        with self.timed('connect'):
+            connection = SMTP(self.host, self.port,
+                              local_hostname=DNS_NAME.get_fqdn())
+
+        if self.use_tls:
+            with self.timed('tls'):
+                connection.ehlo()
+                connection.starttls()
+                connection.ehlo()
+        if self.username and self.password:
+            with self.timed('auth'):
+                connection.login(self.username, self.password)
+        self.count('connections', status='opened')
+        if self.tracer is not None:
+            self._trace_commands(connection)
+        return connection
+
+    def _trace_commands(self, connection):
+        """
+        Traces every command sent over connection in a ``smtp.<command>``
+        span, lasting until the server's reply, and the message content
+        sent after ``DATA`` in a ``smtp.content`` span.
+        """
+        putcmd, getreply = connection.putcmd, connection.getreply
+        spans = []
+        def traced_putcmd(cmd, args=''):
+            spans.append(self.tracer.start_span('smtp.%s' % cmd.lower()))
+            putcmd(cmd, args)
+        def traced_getreply():
+            span = spans.pop() if spans else None
+            try:
+                code, msg = getreply()
+            except Exception:
+                if span is not None:
+                    span.record_exception(sys.exc_info()[1])
+                    span.end()
+                raise
+            if span is not None:
+                span.set_attribute('smtp.reply_code', code)
+                span.end()
+                if code == 354:
+                    spans.append(self.tracer.start_span('smtp.content'))
+            return code, msg
+        connection.putcmd = traced_putcmd
+        connection.getreply = traced_getreply
+
     def close(self):
         """Closes the connection to the email server."""
         try:
@@ -81,13 +168,31 @@ class Mail(BaseMail):
         finally:
             self.connection = None
 
+    def get_batch_key(self):
+        return (super(Mail, self).get_batch_key(), self.host, self.port,
+                self.username, self.password, self.use_tls, self.use_ssl)
+
+    @instrumented
     def send_messages(self, email_messages):
         """
         Sends one or more EmailMessage objects and returns the number of email
         messages sent.
+
+        Recipients refused by the server are listed in :attr:`refused`, as a
+        dict mapping them to the server's (code, response).
+
+        The :class:`~flask.ext.email.results.SendResult` of every message
+        are kept in :attr:`last_results`, and returned instead of the number
+        if the backend was created with ``return_results=True``.
+
+        Messages larger than :meth:`get_max_size` are not transmitted: they
+        are handed to the oversize backend if there is one, and refused with
+        a 552 otherwise. See :meth:`_measure` for how sizes are found.
         """
         if not email_messages:
             return
+        self.refused = {}
+        self.last_results = []
         self._lock.acquire()
         try:
             new_conn_created = self.open()
@@ -95,31 +200,362 @@ class Mail(BaseMail):
                 # We failed silently on open().
                 # Trying to send would be pointless.
                 return
-            num_sent = 0
-            for message in email_messages:
-                sent = self._send(message)
-                if sent:
-                    num_sent += 1
+            max_size = self.get_max_size()
+            slots = []
+            oversized = []
+            for message, merged in self._coalesce(email_messages):
+                size = data = None
+                if max_size:
+                    size, data = self._measure(message, max_size)
+                if size is None or size <= max_size:
+                    with self.message_span(message):
+                        slots.append((merged, self._send(message, merged, data)))
+                    continue
+                if data is not None and not isinstance(data, basestring):
+                    data.close()
+                if self.oversize_backend:
+                    # Sent once the connection is released, see below.
+                    slots.append((merged, None))
+                    oversized.extend(merged)
+                else:
+                    slots.append((merged, self._refuse(message, merged, max_size)))
             if new_conn_created:
                 self.close()
         finally:
             self._lock.release()
-        return num_sent
+        if oversized:
+            rerouted = iter(self._reroute(oversized))
+        results = []
+        for merged, merged_results in slots:
+            if merged_results is None:
+                merged_results = [rerouted.next() for message in merged]
+            results.extend(merged_results)
+        self.last_results = results
+        if self.return_results:
+            return results
+        return count_sent(results)
+
+    def _coalesce(self, email_messages):
+        """
+        Merges messages that only differ in their recipients into a single
+        message, so that it is rendered and transmitted once. Returns a list
+        of (message, messages merged into it) pairs.
+
+        With coalesce set to ``'bcc'`` only messages differing in their Bcc
+        recipients are merged. With ``'all'``, messages differing in any
+        recipients are merged, and the merged message is sent with an
+        ``undisclosed-recipients`` To header.
+        """
+        if not self.coalesce:
+            return [(message, [message]) for message in email_messages]
+        groups = {}
+        order = []
+        for message in email_messages:
+            if message.rendered is not None or not message.recipients():
+                order.append([message])
+                continue
+            key = (type(message), message.encoding, message.get_content_hash(recipients=False))
+            if self.coalesce != 'all':
+                key += (tuple(message.to), tuple(message.cc))
+            if key not in groups:
+                groups[key] = []
+                order.append(groups[key])
+            groups[key].append(message)
+        return [(self._merge(group), group) for group in order]
 
-    def _send(self, email_message):
-        """A helper method that does the actual sending."""
+    def _merge(self, email_messages):
+        if len(email_messages) == 1:
+            return email_messages[0]
+        message = copy.copy(email_messages[0])
+        recipients = []
+        seen = set()
+        for other in email_messages:
+            fields = other.recipients() if self.coalesce == 'all' else other.bcc
+            for addr in fields:
+                if addr not in seen:
+                    seen.add(addr)
+                    recipients.append(addr)
+        message.bcc = recipients
+        if self.coalesce == 'all':
+            message.to = []
+            message.cc = []
+            if not [name for name in message.extra_headers if name.lower() == 'to']:
+                message.extra_headers = dict(message.extra_headers,
+                                             To='undisclosed-recipients:;')
+        return message
+
+    def get_max_size(self):
+        """
+        Returns the largest message size in bytes to transmit: the lowest of
+        the configured limit and the ``SIZE`` advertised by the server, or
+        None if there is no limit.
+        """
+        sizes = []
+        if self.max_size:
+            sizes.append(self.max_size)
+        if self.connection is not None:
+            self.connection.ehlo_or_helo_if_needed()
+            advertised = self.connection.esmtp_features.get('size', '')
+            if advertised.isdigit() and int(advertised):
+                sizes.append(int(advertised))
+        return min(sizes) if sizes else None
+
+    def _measure(self, email_message, max_size):
+        """
+        Returns the size of a message to compare with max_size, and its
+        serialized data if it was rendered to find it, or None.
+
+        The size is estimated with :meth:`EmailMessage.estimate_size`, which
+        is only accurate to a few percent and leaves out the DKIM signature.
+        Messages estimated within :attr:`size_margin` of the limit are
+        rendered and measured exactly, so that the server's limit is
+        neither exceeded nor enforced on messages under it.
+        """
+        estimate = email_message.estimate_size()
+        margin = max_size * self.size_margin
+        signature = DKIM_SIGNATURE_SIZE if self.signer is not None else 0
+        if estimate + signature <= max_size - margin or estimate > max_size + margin:
+            return estimate, None
+        try:
+            data = self.render(email_message)
+        except Exception:
+            # Left to _send, which reports the error.
+            return estimate, None
+        return get_wire_size(data), data
+
+    def _refuse(self, email_message, merged, max_size):
+        """Refuses all recipients of a message larger than max_size."""
+        response = 'Message size exceeds fixed maximum message size of %d bytes' % max_size
+        refused = dict((addr, (552, response))
+                       for addr in self._get_recipients(email_message))
+        self.refused.update(refused)
+        results = [SendResult(message, self._get_recipients(message), refused=refused)
+                   for message in merged]
+        self.record_results(results)
+        if refused and not self.fail_silently:
+            raise smtplib.SMTPRecipientsRefused(refused)
+        return results
+
+    def _reroute(self, email_messages):
+        """
+        Sends messages through the oversize backend. Returns a
+        :class:`~flask.ext.email.results.SendResult` for every message.
+        """
+        from .. import get_connection
+        connection = get_connection(self.oversize_backend, fail_silently=self.fail_silently,
+                                    return_results=True)
+        results = connection.send_messages(email_messages)
+        if isinstance(results, list):
+            return results
+        sent = count_sent(results) == len(email_messages)
+        return [SendResult(message, self._get_recipients(message) if sent else [])
+                for message in email_messages]
+
+    def _send(self, email_message, merged=None, data=None):
+        """
+        A helper method that does the actual sending. Returns a
+        :class:`~flask.ext.email.results.SendResult` for every message
+        email_message was merged from. data is the serialized message if
+        it was rendered already.
+        """
+        merged = merged or [email_message]
         if not email_message.recipients():
-            return False
+            return [SendResult(message) for message in merged]
         # if not email_message.from_email:
         #     return False
         from_email = sanitize_address(email_message.from_email, email_message.encoding)
-        recipients = [sanitize_address(addr, email_message.encoding)
-                      for addr in email_message.recipients()]
+        recipients = self._get_recipients(email_message)
+        self.record_sending(merged)
         try:
-            self.connection.sendmail(from_email, recipients,
-                    email_message.message().as_string())
+            if data is None:
+                data = self.render(email_message)
+            try:
+                refused = self._send_envelope(from_email, recipients, data)
+            finally:
+                if not isinstance(data, basestring):
+                    # Spooled data is not kept for retries.
+                    data.close()
+                    data = None
         except:
+            error = sys.exc_info()[1]
+            self.record_failed(merged, error)
             if not self.fail_silently:
                 raise
-            return False
-        return True
\ No newline at end of file
+            return [SendResult(message, self._get_recipients(message), data, error=error)
+                    for message in merged]
+        self.refused.update(refused)
+        results = [SendResult(message, self._get_recipients(message), data, refused)
+                   for message in merged]
+        self.record_results(results)
+        if len(refused) == len(recipients) and not self.fail_silently:
+            raise smtplib.SMTPRecipientsRefused(refused)
+        return results
+
+    def _get_recipients(self, email_message):
+        return [sanitize_address(addr, email_message.encoding)
+                for addr in email_message.recipients()]
+
+    def get_max_recipients(self):
+        """
+        Returns the number of recipients per transaction: the configured
+        limit, or the limit learned from the server.
+        """
+        learned = self._get_learned_max_recipients()
+        if self.max_recipients and learned:
+            return min(self.max_recipients, learned)
+        return self.max_recipients or learned
+
+    def _get_learned_max_recipients(self):
+        learned, learned_at = _learned_max_recipients.get((self.host, self.port), (None, 0))
+        if time.time() - learned_at > LEARNED_LIMIT_TTL:
+            return None
+        return learned
+
+    def _learn_max_recipients(self, accepted):
+        learned = self._get_learned_max_recipients()
+        _learned_max_recipients[(self.host, self.port)] = (
+            min(learned or accepted, accepted), time.time())
+
+    def _chunk_recipients(self, recipients):
+        """Splits recipients into chunks accepted in one transaction."""
+        max_recipients = self.get_max_recipients()
+        if not max_recipients:
+            return [recipients]
+        return [recipients[i:i + max_recipients]
+                for i in range(0, len(recipients), max_recipients)]
+
+    def _send_envelope(self, from_email, recipients, data):
+        """
+        Sends data to recipients in as many transactions as the server's
+        recipient limit requires, spread over up to :attr:`parallel`
+        connections. Returns the refused recipients.
+        """
+        chunks = self._chunk_recipients(recipients)
+        if self.parallel <= 1 or len(chunks) <= 1 or not isinstance(data, basestring):
+            # Spooled data can only be read by one connection at a time.
+            return self._send_chunks(self.connection, from_email, chunks, data)
+        refused = {}
+        errors = []
+        # Tracing contexts are per thread: the spans of the workers are
+        # children of the span sending the message.
+        context = get_context(self.tracer)
+        def work(chunks):
+            try:
+                with use_context(self.tracer, context):
+                    connection = self._connect()
+                    try:
+                        refused.update(self._send_chunks(connection, from_email, chunks, data))
+                    finally:
+                        connection.quit()
+            except Exception:
+                errors.append(sys.exc_info())
+        threads = [threading.Thread(target=work, args=(chunks[i::self.parallel],))
+                   for i in range(min(self.parallel, len(chunks)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return refused
+
+    def _send_chunks(self, connection, from_email, chunks, data):
+        """
+        Sends data in one transaction per chunk of recipients. When the
+        server refuses part of a chunk because of too many recipients, the
+        number it accepted is remembered as its limit and the rest is sent
+        in further transactions. See :meth:`_get_too_many` for which 452
+        replies count; other 452s (e.g. a full mailbox) are deferred.
+        """
+        refused = {}
+        pending = list(chunks)
+        while pending:
+            chunk = pending.pop(0)
+            try:
+                with self.timed('transmit'):
+                    if isinstance(data, basestring):
+                        chunk_refused = connection.sendmail(from_email, chunk, data)
+                    else:
+                        data.seek(0)
+                        chunk_refused = self._sendfile(connection, from_email, chunk, data)
+            except smtplib.SMTPRecipientsRefused, e:
+                chunk_refused = e.recipients
+            too_many = self._get_too_many(chunk, chunk_refused)
+            if too_many and len(too_many) < len(chunk):
+                accepted = len(chunk) - len(too_many)
+                self._learn_max_recipients(accepted)
+                for addr in too_many:
+                    del chunk_refused[addr]
+                pending[0:0] = [too_many[i:i + accepted]
+                                for i in range(0, len(too_many), accepted)]
+            refused.update(chunk_refused)
+        return refused
+
+    def _get_too_many(self, chunk, refused):
+        """
+        Returns the recipients of chunk refused for being over the server's
+        recipient limit: those answered with a 452 saying so (``4.5.3`` or
+        "too many recipients"), and the trailing run of 452s of a server
+        that stopped accepting recipients after some number.
+        """
+        codes = [refused.get(addr, (None, ''))[0] for addr in chunk]
+        trailing = len(chunk)
+        while trailing and codes[trailing - 1] == 452:
+            trailing -= 1
+        too_many = []
+        for i, addr in enumerate(chunk):
+            if codes[i] != 452:
+                continue
+            response = str(refused[addr][1] or '').lower()
+            if i >= trailing or '4.5.3' in response or 'too many recipients' in response:
+                too_many.append(addr)
+        return too_many
+
+    def _sendfile(self, connection, from_email, recipients, fp):
+        """
+        Same as :meth:`smtplib.SMTP.sendmail`, streaming the message from
+        the file-like object fp instead of holding it in a string.
+        """
+        connection.ehlo_or_helo_if_needed()
+        esmtp_opts = []
+        if connection.does_esmtp and connection.has_extn('size'):
+            fp.seek(0, 2)
+            esmtp_opts.append('size=%d' % fp.tell())
+            fp.seek(0)
+        code, resp = connection.mail(from_email, esmtp_opts)
+        if code != 250:
+            connection.rset()
+            raise smtplib.SMTPSenderRefused(code, resp, from_email)
+        refused = {}
+        for addr in recipients:
+            code, resp = connection.rcpt(addr)
+            if code not in (250, 251):
+                refused[addr] = (code, resp)
+        if len(refused) == len(recipients):
+            connection.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+        connection.putcmd('data')
+        code, resp = connection.getreply()
+        if code != 354:
+            connection.rset()
+            raise smtplib.SMTPDataError(code, resp)
+        buf = []
+        size = 0
+        line = ''
+        for line in fp:
+            line = line.rstrip('\r\n') + smtplib.CRLF
+            if line.startswith('.'):
+                line = '.' + line
+            buf.append(line)
+            size += len(line)
+            if size >= 65536:
+                connection.send(''.join(buf))
+                buf = []
+                size = 0
+        buf.append('.' + smtplib.CRLF)
+        connection.send(''.join(buf))
+        code, resp = connection.getreply()
+        if code != 250:
+            connection.rset()
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
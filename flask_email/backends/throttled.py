@@ -0,0 +1,220 @@
+"""
+Email backend that throttles messages per recipient domain.
+
+Messages are grouped by the domains of their recipients. Worker threads
+take messages from the groups in turn, skipping groups whose domains are
+out of tokens or at their concurrency cap, so a slow or throttled domain
+does not hold up the rest of the batch. Token buckets and concurrency
+counts are shared by all connections of an application.
+
+Limits are given per domain, with ``'*'`` matching any other domain::
+
+    EMAIL_THROTTLE_LIMITS = {
+        'gmail.com': {'rate': 5, 'burst': 20, 'concurrency': 2},
+        '*': {'rate': 20},
+    }
+"""
+from __future__ import with_statement
+
+import sys
+import threading
+from collections import deque
+from email.utils import parseaddr
+
+from flask import current_app
+
+from ..ratelimit import TokenBucket
+from ..results import count_sent
+from .proxy import Mail as ProxyMail
+
+_limiters_lock = threading.Lock()
+
+
+def get_domains(email_message):
+    """Returns the sorted tuple of the recipient domains of a message."""
+    domains = set()
+    for addr in email_message.recipients():
+        domains.add(parseaddr(addr)[1].rpartition('@')[2].lower())
+    return tuple(sorted(domains))
+
+
+class DomainLimiter(object):
+    """
+    Token buckets and in-flight counts for each recipient domain.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.buckets = {}
+        self.in_flight = {}
+        self._lock = threading.Lock()
+
+    def get_limit(self, domain):
+        if domain in self.limits:
+            return self.limits[domain]
+        return self.limits.get('*', {})
+
+    def _get_bucket(self, domain, limit):
+        if 'rate' not in limit:
+            return None
+        if domain not in self.buckets:
+            self.buckets[domain] = TokenBucket(limit['rate'], limit.get('burst'))
+        return self.buckets[domain]
+
+    def acquire(self, domains):
+        """
+        Take a token and a concurrency slot for each domain. Returns 0 on
+        success, otherwise the number of seconds until tokens are available,
+        or None when waiting for a slot to be released.
+        """
+        with self._lock:
+            wait = 0
+            for domain in domains:
+                limit = self.get_limit(domain)
+                concurrency = limit.get('concurrency')
+                if concurrency is not None and self.in_flight.get(domain, 0) >= concurrency:
+                    return None
+                bucket = self._get_bucket(domain, limit)
+                if bucket is not None:
+                    wait = max(wait, bucket.delay())
+            if wait:
+                return wait
+            for domain in domains:
+                bucket = self._get_bucket(domain, self.get_limit(domain))
+                if bucket is not None:
+                    bucket.consume()
+                self.in_flight[domain] = self.in_flight.get(domain, 0) + 1
+            return 0
+
+    def release(self, domains):
+        with self._lock:
+            for domain in domains:
+                self.in_flight[domain] -= 1
+
+
+class Mail(ProxyMail):
+    """
+    Email backend that interleaves and throttles messages by recipient
+    domain.
+
+    Configure the wrapped backend with ``EMAIL_THROTTLE_BACKEND``. Messages
+    that were left unsent by the last :meth:`send_messages` call because no
+    connection could be opened are listed in :attr:`unsent`.
+    """
+    backend_setting = 'EMAIL_THROTTLE_BACKEND'
+
+    # Longest wait before looking at the domains again, in case slots are
+    # released by another connection.
+    poll_interval = 0.1
+
+    def init_app(self, app, limits=None, workers=None, **kwargs):
+        """
+        :param app: Flask application instance
+        :param limits: Limits by domain. Default: ``EMAIL_THROTTLE_LIMITS``
+        :param workers: Number of messages sent in parallel, each over its
+            own connection. Default: ``EMAIL_THROTTLE_WORKERS``
+        :param \*\*kwargs: Options passed to :class:`~.proxy.Mail`
+        """
+        self.limits = limits or app.config.get('EMAIL_THROTTLE_LIMITS', {})
+        for domain, limit in self.limits.items():
+            # Limits that can never be met would hold messages forever.
+            if limit.get('concurrency', 1) < 1 or limit.get('rate', 1) <= 0 or \
+                    limit.get('burst', 1) < 1:
+                raise Exception('Invalid email throttle limit for %r: %r' % (domain, limit))
+        self.workers = workers or app.config.get('EMAIL_THROTTLE_WORKERS', 4)
+        self.unsent = []
+        super(Mail, self).init_app(app, **kwargs)
+
+    def get_limiter(self):
+        """Returns the domain limiter shared by all connections of the app."""
+        app = current_app._get_current_object()
+        with _limiters_lock:
+            limiters = app.extensions.setdefault('email_throttle', {})
+            key = repr(sorted(self.limits.items()))
+            if key not in limiters:
+                limiters[key] = DomainLimiter(self.limits)
+            return limiters[key]
+
+    def send_messages(self, email_messages):
+        """
+        Sends one or more EmailMessage objects and returns the number of email
+        messages sent.
+        """
+        self.unsent = []
+        if not email_messages:
+            return
+        groups = {}
+        pending = deque()
+        for message in email_messages:
+            domains = get_domains(message)
+            if domains not in groups:
+                groups[domains] = deque()
+                pending.append(domains)
+            groups[domains].append(message)
+
+        limiter = self.get_limiter()
+        condition = threading.Condition()
+        results = []
+
+        def next_message():
+            with condition:
+                while pending:
+                    min_wait = self.poll_interval
+                    for i in range(len(pending)):
+                        domains = pending.popleft()
+                        wait = limiter.acquire(domains)
+                        if wait == 0:
+                            message = groups[domains].popleft()
+                            if groups[domains]:
+                                pending.append(domains)
+                            return domains, message
+                        pending.append(domains)
+                        if wait is not None:
+                            min_wait = min(min_wait, wait)
+                    condition.wait(min_wait)
+                return None, None
+
+        def work(app):
+            with app.app_context():
+                try:
+                    connection = self.get_backend()
+                    new_conn_created = connection.open()
+                except Exception:
+                    # The messages are left to the other workers, or to
+                    # unsent if none of them could connect either.
+                    results.append(sys.exc_info())
+                    return
+                try:
+                    while True:
+                        domains, message = next_message()
+                        if message is None:
+                            break
+                        try:
+                            results.append(count_sent(connection.send_messages([message])))
+                        except Exception:
+                            results.append(sys.exc_info())
+                        finally:
+                            limiter.release(domains)
+                            with condition:
+                                condition.notify_all()
+                finally:
+                    if new_conn_created:
+                        connection.close()
+
+        app = current_app._get_current_object()
+        threads = [threading.Thread(target=work, args=(app,))
+                   for i in range(min(self.workers, len(email_messages)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.unsent = [message for domains in pending for message in groups[domains]]
+
+        num_sent = 0
+        for result in results:
+            if isinstance(result, tuple):
+                if not self.fail_silently:
+                    raise result[0], result[1], result[2]
+            else:
+                num_sent += result
+        return num_sent
@@ -0,0 +1,187 @@
+"""
+Coalesce messages sent within a block or a request into a single flush.
+
+Every :meth:`EmailMessage.send` and :func:`send_mass_mail` call normally
+opens, uses and closes its own connection. Inside a batch the messages are
+queued instead and sent when the batch ends, over one connection per
+backend configuration.
+"""
+from __future__ import with_statement
+
+import sys
+from contextlib import contextmanager
+
+from flask import _app_ctx_stack, _request_ctx_stack, current_app
+
+from .results import count_sent
+
+
+class Batch(object):
+    """
+    A queue of messages grouped by the connection they were sent with.
+    """
+
+    def __init__(self):
+        self.queue = []
+
+    def add(self, connection, email_messages):
+        """
+        Queue messages for sending. Returns the number of messages queued.
+        """
+        self.queue.append((connection, list(email_messages)))
+        return len(email_messages)
+
+    def flush(self):
+        """
+        Send all queued messages, using one connection for all messages
+        whose connections share a :meth:`~BaseMail.get_batch_key`. Returns
+        the number of messages sent.
+
+        An error sending one group does not stop the others: it is raised
+        once all groups were sent, the first one if there were several,
+        the others being logged.
+        """
+        groups = {}
+        order = []
+        for connection, email_messages in self.queue:
+            key = connection.get_batch_key()
+            if key not in groups:
+                groups[key] = (connection, [])
+                order.append(key)
+            groups[key][1].extend(email_messages)
+        self.queue = []
+        num_sent = 0
+        errors = []
+        for key in order:
+            connection, email_messages = groups[key]
+            try:
+                new_conn_created = connection.open()
+                try:
+                    num_sent += count_sent(connection.send_messages(email_messages))
+                finally:
+                    if new_conn_created:
+                        connection.close()
+            except Exception:
+                errors.append(sys.exc_info())
+        if errors:
+            for exc_info in errors[1:]:
+                current_app.logger.error('Error sending batched email messages',
+                                         exc_info=exc_info)
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return num_sent
+
+
+def _get_stack():
+    ctx = _app_ctx_stack.top
+    if ctx is None:
+        return None
+    if not hasattr(ctx, 'email_batches'):
+        ctx.email_batches = []
+    return ctx.email_batches
+
+
+def current_batch():
+    """Returns the active :class:`Batch` or None."""
+    stack = _get_stack()
+    if stack:
+        return stack[-1]
+    return None
+
+
+def dispatch(connection, email_messages):
+    """
+    Send messages through connection, or queue them if a batch is active.
+    """
+    batch = current_batch()
+    if batch is None:
+        return connection.send_messages(email_messages)
+    return batch.add(connection, email_messages)
+
+
+@contextmanager
+def batch():
+    """
+    Queue all messages sent inside the block and send them on exit::
+
+        with batch():
+            send_mail(...)
+            mail_admins(...)
+
+    Nested blocks join the outermost batch. If the block raises, the
+    messages queued so far are still sent, and an error sending them is
+    logged rather than raised in place of the error of the block. Batches
+    are kept on the application context, so one has to be pushed.
+    """
+    stack = _get_stack()
+    if stack is None:
+        raise RuntimeError('Email batches require an application context')
+    if stack:
+        yield stack[-1]
+        return
+    current = Batch()
+    stack.append(current)
+    try:
+        yield current
+    except:
+        exc_info = sys.exc_info()
+        stack.remove(current)
+        try:
+            current.flush()
+        except Exception:
+            current_app.logger.exception('Error sending batched email messages')
+        raise exc_info[0], exc_info[1], exc_info[2]
+    stack.remove(current)
+    current.flush()
+
+
+def init_batching(app, after_response=None):
+    """
+    Batch all messages sent while handling a request.
+
+    The batch is flushed when the request is torn down. With after_response
+    (or the ``EMAIL_BATCH_AFTER_RESPONSE`` setting), it is flushed once the
+    response has been sent to the client instead, so mail I/O does not add
+    to the response time.
+    """
+    if after_response is None:
+        after_response = app.config.get('EMAIL_BATCH_AFTER_RESPONSE', False)
+
+    def start_batch():
+        _request_ctx_stack.top.email_batch = current = Batch()
+        _get_stack().append(current)
+
+    def end_batch():
+        current = getattr(_request_ctx_stack.top, 'email_batch', None)
+        if current is None:
+            return None
+        _request_ctx_stack.top.email_batch = None
+        stack = _get_stack()
+        if current in stack:
+            stack.remove(current)
+        return current
+
+    def flush_after_response(response):
+        current = end_batch()
+        if current is not None and current.queue:
+            def flush():
+                with app.app_context():
+                    _flush(app, current)
+            response.call_on_close(flush)
+        return response
+
+    def flush_on_teardown(exc):
+        current = end_batch()
+        if current is not None:
+            _flush(app, current)
+
+    app.before_request(start_batch)
+    if after_response:
+        app.after_request(flush_after_response)
+    app.teardown_request(flush_on_teardown)
+
+
+def _flush(app, current):
+    try:
+        current.flush()
+    except Exception:
+        app.logger.exception('Error sending batched email messages')
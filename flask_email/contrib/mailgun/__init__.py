@@ -1,15 +1,21 @@
 from flask.ext.email.backends import rest
 
+API_URL = 'https://api.mailgun.net/v2'
+
 
 class BaseMail(object):
-    def init_app(self, app, api_key=None, mailgun_domain=None, **kwargs):
+    def init_app(self, app, api_key=None, mailgun_domain=None, api_url=None, **kwargs):
         if api_key is None:
             raise Exception('API Key required for Mailgun')
         else:
             self.api_key = api_key
-        kwargs['endpoint'] = 'https://api.mailgun.net/v2/{domain}/messages'.format(domain=mailgun_domain)
+        kwargs['endpoint'] = '{api_url}/{domain}/messages'.format(
+            api_url=api_url or API_URL, domain=mailgun_domain)
         super(BaseMail, self).init_app(app, **kwargs)
 
+    def get_batch_key(self):
+        return (super(BaseMail, self).get_batch_key(), self.api_key)
+
     def _prepare_request_kwargs(self, email_message):
         kwargs = super(BaseMail, self)._prepare_request_kwargs(email_message)
         kwargs.update({
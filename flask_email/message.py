@@ -1,6 +1,8 @@
+import hashlib
 import mimetypes
 import os
 import random
+import tempfile
 import time
 from email import charset as Charset, encoders as Encoders
 from email.generator import Generator
@@ -11,6 +13,7 @@ from email.header import Header
 from email.utils import formatdate, getaddresses, formataddr, parseaddr
 
 from .utils import DNS_NAME
+from .batching import dispatch
 from .encoding import smart_str, force_unicode
 
 try:
@@ -28,11 +31,53 @@ Charset.add_charset('utf-8', Charset.SHORTEST, None, 'utf-8')
 # and cannot be guessed).
 DEFAULT_ATTACHMENT_MIME_TYPE = 'application/octet-stream'
 
+# Estimated size of the headers and boundary lines of a MIME part, and of
+# the generated headers (Date, Message-ID, MIME-Version...) of a message.
+PART_OVERHEAD = 160
+MESSAGE_OVERHEAD = 150
+
+# Bytes that quoted-printable leaves as they are.
+QP_SAFE = ''.join(chr(c) for c in range(33, 127) if chr(c) != '=') + ' \n'
+
 
 class BadHeaderError(ValueError):
     pass
 
 
+def base64_size(length):
+    """Returns the size of length bytes encoded in lines of base64."""
+    encoded = (length + 2) // 3 * 4
+    return encoded + 2 * ((encoded + 75) // 76)
+
+
+def encoded_size(content, encoding):
+    """
+    Returns the size of the bytestring content once encoded as the body of
+    a text part in the given charset, with CRLF line endings.
+    """
+    lines = content.count('\n') + 1
+    body_encoding = Charset.Charset(encoding).body_encoding
+    if body_encoding == Charset.BASE64:
+        return base64_size(len(content))
+    if body_encoding == Charset.QP:
+        escaped = len(content.translate(None, QP_SAFE))
+        size = len(content) + 2 * escaped
+        return size + 3 * (size // 76) + lines
+    return len(content) + lines
+
+
+def header_size(name, value, encoding):
+    """Returns the size of a header line, RFC 2047 encoded if needed."""
+    value = force_unicode(value)
+    try:
+        size = len(value.encode('ascii'))
+    except UnicodeEncodeError:
+        value = value.encode(encoding)
+        # One encoded word (=?charset?b?...?=) per 45 bytes.
+        size = base64_size(len(value)) + (len(value) // 45 + 1) * (len(encoding) + 8)
+    return len(name) + size + 4
+
+
 # Copied from Python standard library, with the following modifications:
 # * Used cached hostname for performance.
 # * Added try/except to support lack of getpid() in Jython (#5496).
@@ -177,13 +222,23 @@ class EmailMessage(object):
     :param attachments: Attachments to the email
     :param headers: Headers for the email message
     :param cc: Carbon copy email addresses
+    :param priority: Name of the priority lane used by
+        :mod:`~flask.ext.email.backends.priority`
+    :param send_at: Time to send the email at, as a datetime or timestamp
+    :param delay: Seconds (or a timedelta) to wait before sending the email
+    :param idempotency_key: Key identifying the email when it is sent again,
+        defaults to a hash of its content
     """
     content_subtype = 'plain'
     mixed_subtype = 'mixed'
     encoding = None     # None => use settings default
+    rendered = None     # Pre-serialized payload, see render_messages()
+    attempts = 0        # Previous sends, see SendResult.get_retry_message()
+    handle = None       # Handle of a scheduled send, see backends.scheduled
 
     def __init__(self, subject='', body='', from_email=None, to=None, bcc=None,
-                 connection=None, attachments=None, headers=None, cc=None):
+                 connection=None, attachments=None, headers=None, cc=None,
+                 priority=None, send_at=None, delay=None, idempotency_key=None):
         """
         Initialize a single email message (which can be sent to multiple
         recipients).
@@ -213,6 +268,10 @@ class EmailMessage(object):
         self.attachments = attachments or []
         self.extra_headers = headers or {}
         self.connection = connection
+        self.priority = priority
+        self.send_at = send_at
+        self.delay = delay
+        self.idempotency_key = idempotency_key
 
     def get_connection(self, fail_silently=False):
         from . import get_connection
@@ -244,6 +303,121 @@ class EmailMessage(object):
             msg[name] = value
         return msg
 
+    def render(self):
+        """
+        Returns the serialized message. A payload already rendered by
+        :func:`~flask.ext.email.render.render_messages` is reused as is.
+        """
+        if self.rendered is not None:
+            return self.rendered
+        return self.message().as_string()
+
+    def spool(self, max_size=0):
+        """
+        Returns the serialized message in a rewound
+        :class:`~tempfile.SpooledTemporaryFile`, which is kept in memory up
+        to max_size bytes and rolled over to a temporary file beyond that.
+        The message is flattened straight into the file, without building
+        the whole string in memory.
+        """
+        fp = tempfile.SpooledTemporaryFile(max_size)
+        if self.rendered is not None:
+            fp.write(self.rendered)
+        else:
+            g = Generator(fp, mangle_from_=False)
+            g.flatten(self.message(), unixfrom=False)
+        fp.seek(0)
+        return fp
+
+    def estimate_size(self):
+        """
+        Returns the size in bytes of the message on the wire, with CRLF line
+        endings, estimated from the sizes of its parts and the overhead of
+        their transfer encodings, without serializing it. The estimate is
+        usually within a few percent of the real size; a payload already
+        rendered is measured exactly.
+        """
+        if self.rendered is not None:
+            return len(self.rendered) + self.rendered.count('\n')
+        encoding = self.encoding or app.config.get('DEFAULT_CHARSET', 'utf-8')
+        size = MESSAGE_OVERHEAD
+        headers = dict(self.extra_headers)
+        headers.setdefault('From', self.from_email)
+        headers.setdefault('To', ', '.join(self.to))
+        headers['Subject'] = self.subject
+        if self.cc:
+            headers['Cc'] = ', '.join(self.cc)
+        for name, value in headers.items():
+            size += header_size(name, value, encoding)
+        parts = self._get_body_parts()
+        for content, mimetype in parts:
+            if len(parts) > 1:
+                size += PART_OVERHEAD
+            if isinstance(content, MIMEBase):
+                size += len(content.as_string())
+            elif mimetype.startswith('text/'):
+                size += encoded_size(smart_str(content, encoding), encoding)
+            else:
+                size += base64_size(len(content))
+        return size
+
+    def _get_body_parts(self):
+        """
+        Returns the (content, mimetype) pairs of the parts of the message,
+        a MIME attachment standing for both.
+        """
+        parts = [(self.body, 'text/%s' % self.content_subtype)]
+        for attachment in self.attachments:
+            if isinstance(attachment, MIMEBase):
+                parts.append((attachment, None))
+            else:
+                filename, content, mimetype = attachment
+                if mimetype is None:
+                    mimetype = mimetypes.guess_type(filename)[0] or DEFAULT_ATTACHMENT_MIME_TYPE
+                parts.append((content, mimetype))
+        return parts
+
+    def get_idempotency_key(self):
+        """
+        Returns the idempotency key of the message: the key it was given,
+        or else its :meth:`get_content_hash`.
+        """
+        if self.idempotency_key is not None:
+            return self.idempotency_key
+        return self.get_content_hash()
+
+    def get_content_hash(self, recipients=True):
+        """
+        Returns a hash of the sender, headers and content of the message, and
+        of its recipients unless recipients is False. The Date header is left
+        out, so the hash is stable across retries. A Message-ID given in the
+        headers is hashed, while a generated one is not.
+        """
+        encoding = self.encoding or app.config.get('DEFAULT_CHARSET', 'utf-8')
+        digest = hashlib.sha1()
+        for part in self._get_content_parts(recipients):
+            if isinstance(part, MIMEBase):
+                part = part.as_string()
+            digest.update(smart_str(part, encoding))
+            digest.update('\0')
+        return digest.hexdigest()
+
+    def _get_content_parts(self, recipients=True):
+        parts = [self.__class__.__name__, self.from_email, self.subject, self.body]
+        if recipients:
+            for addresses in (self.to, self.cc, self.bcc):
+                parts.append(len(addresses))
+                parts.extend(addresses)
+        for name, value in sorted(self.extra_headers.items()):
+            if name.lower() != 'date':
+                parts.extend((name, value))
+        for attachment in self.attachments:
+            if isinstance(attachment, MIMEBase):
+                parts.append(attachment)
+            else:
+                parts.extend(attachment)
+        return parts
+
     def recipients(self):
         """
         Returns a list of all recipients of the email (includes direct
@@ -257,7 +431,7 @@ class EmailMessage(object):
             # Don't bother creating the network connection if there's nobody to
             # send to.
             return 0
-        return self.get_connection(fail_silently).send_messages([self])
+        return dispatch(self.get_connection(fail_silently), [self])
 
     def attach(self, filename=None, content=None, mimetype=None):
         """
@@ -342,7 +516,7 @@ class EmailMultiAlternatives(EmailMessage):
 
     def __init__(self, subject='', body='', from_email=None, to=None, bcc=None,
             connection=None, attachments=None, headers=None, alternatives=None,
-            cc=None):
+            cc=None, priority=None, send_at=None, delay=None, idempotency_key=None):
         """
         Initialize a single email message (which can be sent to multiple
         recipients).
@@ -351,9 +525,21 @@ class EmailMultiAlternatives(EmailMessage):
         bytestrings). The SafeMIMEText class will handle any necessary encoding
         conversions.
         """
-        super(EmailMultiAlternatives, self).__init__(subject, body, from_email, to, bcc, connection, attachments, headers, cc)
+        super(EmailMultiAlternatives, self).__init__(subject, body, from_email, to, bcc, connection, attachments, headers, cc,
+                                                     priority=priority, send_at=send_at, delay=delay,
+                                                     idempotency_key=idempotency_key)
         self.alternatives = alternatives or []
 
+    def _get_content_parts(self, recipients=True):
+        parts = super(EmailMultiAlternatives, self)._get_content_parts(recipients)
+        for alternative in self.alternatives:
+            parts.extend(alternative)
+        return parts
+
+    def _get_body_parts(self):
+        parts = super(EmailMultiAlternatives, self)._get_body_parts()
+        return parts[:1] + list(self.alternatives) + parts[1:]
+
     def attach_alternative(self, content, mimetype):
         """Attach an alternative content representation."""
         assert content is not None
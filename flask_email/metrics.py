@@ -0,0 +1,184 @@
+"""
+In-process metrics of email backends.
+
+With ``EMAIL_METRICS`` set, backends record the time spent in each phase
+of a send (render, serialize, sign, connect, tls, auth, transmit,
+response) in histograms, and count messages, bytes, connections and
+retries, in a :class:`Registry` shared by all connections of an
+application. The registry can be exported in the Prometheus text format,
+e.g. by registering :func:`create_blueprint`::
+
+    app.register_blueprint(create_blueprint(), url_prefix='/email')
+"""
+from __future__ import with_statement
+
+import bisect
+import threading
+import time
+
+from flask import Blueprint, Response, current_app
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+_registries_lock = threading.Lock()
+
+
+class Histogram(object):
+    """
+    Counts of observed values by bucket upper bound, with their sum.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_cumulative_counts(self):
+        """Returns (upper bound, count) pairs, ending with ``+Inf``."""
+        counts = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            counts.append((bound, total))
+        return counts
+
+
+class Timer(object):
+    """Context manager observing the time spent in its block."""
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.registry.observe(self.name, time.time() - self.start, **self.labels)
+
+
+class NullTimer(object):
+    """Timer of backends without metrics."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+null_timer = NullTimer()
+
+
+class Registry(object):
+    """
+    Counters and histograms by name and labels. Thread-safe.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        """Adds value to a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Records a value in a histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        """Returns a context manager recording the time of its block."""
+        return Timer(self, name, labels)
+
+    def get_counter(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def get_histogram(self, name, **labels):
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def clear(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def to_prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+            histograms = [(key, histogram.get_cumulative_counts(), histogram.sum,
+                           histogram.count) for key, histogram in histograms]
+        name = None
+        for (metric, labels), value in counters:
+            if metric != name:
+                name = metric
+                lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+        name = None
+        for (metric, labels), counts, total, count in histograms:
+            if metric != name:
+                name = metric
+                lines.append('# TYPE %s histogram' % name)
+            for bound, value in counts:
+                le = '+Inf' if bound == float('inf') else _format_value(bound)
+                lines.append('%s_bucket%s %d' % (name, _format_labels(labels + (('le', le),)), value))
+            lines.append('%s_sum%s %s' % (name, _format_labels(labels), _format_value(total)))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', r'\\')
+                                          .replace('"', r'\"').replace('\n', r'\n'))
+                             for name, value in labels)
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def get_registry(app=None):
+    """Returns the :class:`Registry` of the app."""
+    app = app or current_app
+    with _registries_lock:
+        registry = app.extensions.get('email_metrics')
+        if registry is None:
+            registry = app.extensions['email_metrics'] = Registry(
+                app.config.get('EMAIL_METRICS_BUCKETS', DEFAULT_BUCKETS))
+        return registry
+
+
+def create_blueprint(name='email_metrics'):
+    """
+    Returns a blueprint serving the metrics of the app at ``/metrics`` in
+    the Prometheus text format.
+    """
+    blueprint = Blueprint(name, __name__)
+
+    @blueprint.route('/metrics')
+    def metrics():
+        return Response(get_registry().to_prometheus(),
+                        mimetype='text/plain; version=0.0.4')
+
+    return blueprint
@@ -0,0 +1,151 @@
+"""
+Rate limiting helpers for email backends.
+"""
+from __future__ import with_statement
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+
+_reopen_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """
+    Token bucket refilled with rate tokens per second, holding at most
+    capacity tokens. Thread-safe.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.tokens = self.capacity
+        self.timestamp = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def delay(self, tokens=1):
+        """Returns the number of seconds until tokens are available."""
+        with self._lock:
+            self._refill()
+            if self.tokens >= tokens:
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+    def consume(self, tokens=1):
+        """Take tokens, even if that leaves the bucket in debt."""
+        with self._lock:
+            self._refill()
+            self.tokens -= tokens
+
+    def acquire(self, tokens=1, blocking=True):
+        """
+        Take tokens, waiting for them if blocking. Returns whether the tokens
+        were taken.
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return True
+                wait = (tokens - self.tokens) / self.rate
+            if not blocking:
+                return False
+            time.sleep(wait)
+
+
+class SharedTokenBucket(object):
+    """
+    Token bucket whose state lives in a memory-mapped file, so that every
+    process on the host opening the same path shares it. Updates are
+    serialized with an exclusive ``flock`` on the file, held only while
+    the two counters are read and written. A forked process reopens the
+    file, as locks taken through the inherited descriptor would not
+    exclude the parent.
+    """
+    _format = 'dd'  # tokens, timestamp
+    _size = struct.calcsize(_format)
+
+    def __init__(self, path, rate, capacity=None):
+        self.path = path
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self._open()
+
+    def _open(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < self._size:
+                os.ftruncate(self._fd, self._size)
+                os.write(self._fd, struct.pack(self._format, self.capacity, time.time()))
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, self._size)
+
+    def _reopen(self):
+        with _reopen_lock:
+            if self._pid == os.getpid():
+                return
+            self._map.close()
+            os.close(self._fd)
+            self._open()
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    def _update(self, tokens, take):
+        """
+        Refill the bucket, then take tokens if take is True and enough are
+        available, or if take is None. Returns the tokens left before taking.
+        """
+        if self._pid != os.getpid():
+            self._reopen()
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                available, timestamp = struct.unpack(self._format, self._map[:self._size])
+                now = time.time()
+                available = min(self.capacity, available + max(now - timestamp, 0) * self.rate)
+                left = available
+                if take is None or (take and available >= tokens):
+                    left = available - tokens
+                self._map[:self._size] = struct.pack(self._format, left, now)
+                return available
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def delay(self, tokens=1):
+        """Returns the number of seconds until tokens are available."""
+        available = self._update(tokens, False)
+        if available >= tokens:
+            return 0
+        return (tokens - available) / self.rate
+
+    def consume(self, tokens=1):
+        """Take tokens, even if that leaves the bucket in debt."""
+        self._update(tokens, None)
+
+    def acquire(self, tokens=1, blocking=True):
+        """
+        Take tokens, waiting for them if blocking. Returns whether the tokens
+        were taken.
+        """
+        while True:
+            available = self._update(tokens, True)
+            if available >= tokens:
+                return True
+            if not blocking:
+                return False
+            time.sleep((tokens - available) / self.rate)
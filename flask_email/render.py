@@ -0,0 +1,89 @@
+"""
+Render email messages in a pool of worker processes.
+
+Building the MIME tree and flattening it is CPU bound, so for bulk sends
+the messages can be serialized in parallel and handed to a backend as
+ready payloads. Only the message attributes are shipped to the workers;
+the serialized strings come back and are stored on
+:attr:`EmailMessage.rendered`, where backends pick them up through
+:meth:`EmailMessage.render`.
+"""
+from __future__ import with_statement
+
+import multiprocessing
+
+from flask import Flask, current_app as app
+
+# Settings read while building a message, copied into the workers.
+RENDER_SETTINGS = ('DEFAULT_CHARSET', 'DEFAULT_FROM_EMAIL')
+
+# Attributes that are not needed (or not picklable) in the workers.
+EXCLUDED_ATTRIBUTES = ('connection', 'rendered')
+
+_worker_app = None
+
+
+def _init_worker(config):
+    global _worker_app
+    _worker_app = Flask(__name__)
+    _worker_app.config.update(config)
+
+
+def _render(spec):
+    klass, state = spec
+    message = klass.__new__(klass)
+    message.__dict__.update(state)
+    with _worker_app.app_context():
+        return message.message().as_string()
+
+
+def _get_spec(message):
+    state = dict((key, value) for key, value in message.__dict__.items()
+                 if key not in EXCLUDED_ATTRIBUTES)
+    return type(message), state
+
+
+def create_pool(processes=None):
+    """
+    Create a process pool set up to render messages for the current
+    application. A pool can be reused across calls to :func:`render_messages`
+    to avoid paying the process startup cost for every batch.
+
+    :param processes: Number of worker processes, defaults to the number of
+        CPUs
+    """
+    config = dict((key, app.config[key]) for key in RENDER_SETTINGS
+                  if key in app.config)
+    return multiprocessing.Pool(processes, _init_worker, (config,))
+
+
+def render_messages(email_messages, processes=None, pool=None, chunksize=None):
+    """
+    Serialize messages in worker processes and store the payloads on the
+    messages. Returns the list of messages, ready to be passed to
+    ``send_messages``.
+
+    :param email_messages: Iterable of :class:`EmailMessage`
+    :param processes: Number of worker processes when no pool is given
+    :param pool: Pool created by :func:`create_pool`
+    :param chunksize: Number of messages shipped to a worker at once
+    """
+    email_messages = list(email_messages)
+    if not email_messages:
+        return email_messages
+    specs = [_get_spec(message) for message in email_messages]
+    own_pool = pool is None
+    if own_pool:
+        pool = create_pool(processes)
+    try:
+        if chunksize is None:
+            workers = processes or multiprocessing.cpu_count()
+            chunksize = max(1, len(specs) // (4 * workers))
+        payloads = pool.map(_render, specs, chunksize)
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+    for message, payload in zip(email_messages, payloads):
+        message.rendered = payload
+    return email_messages
@@ -0,0 +1,95 @@
+"""
+Per-message and per-recipient outcomes of a send.
+"""
+import copy
+
+
+class SendResult(object):
+    """
+    The outcome of sending one message.
+
+    :ivar message: The :class:`EmailMessage` sent
+    :ivar accepted: Recipients accepted by the server
+    :ivar refused: Recipients refused permanently, mapped to the server's
+        (code, response)
+    :ivar deferred: Recipients refused temporarily (4xx codes, or an error
+        before the server answered), mapped to (code, response)
+    :ivar data: The serialized message, if the backend rendered one
+    :ivar error: The exception that stopped the send, if any
+    """
+
+    def __init__(self, message, recipients=(), data=None, refused=None,
+                 error=None):
+        self.message = message
+        self.data = data
+        self.error = error
+        self.accepted = []
+        self.refused = {}
+        self.deferred = {}
+        refused = refused or {}
+        for addr in recipients:
+            if error is not None:
+                self.deferred[addr] = (None, str(error))
+            elif addr in refused:
+                code, response = refused[addr]
+                if code is not None and 400 <= code < 500:
+                    self.deferred[addr] = (code, response)
+                else:
+                    self.refused[addr] = (code, response)
+            else:
+                self.accepted.append(addr)
+
+    def __repr__(self):
+        return '<SendResult accepted=%d refused=%d deferred=%d>' % (
+            len(self.accepted), len(self.refused), len(self.deferred))
+
+    @property
+    def sent(self):
+        """Whether the message was accepted for at least one recipient."""
+        return bool(self.accepted)
+
+    def get_retry_message(self, refused=False):
+        """
+        Returns a copy of the message addressed only to the deferred
+        recipients, and to the refused ones if refused is True, or None if
+        there is nobody to retry. The copy reuses the serialized data, so
+        its headers are not rendered again.
+        """
+        recipients = list(self.deferred)
+        if refused:
+            recipients.extend(self.refused)
+        if not recipients:
+            return None
+        message = copy.copy(self.message)
+        message.to = []
+        message.cc = []
+        message.bcc = recipients
+        message.attempts = getattr(self.message, 'attempts', 0) + 1
+        if self.data is not None:
+            message.rendered = self.data
+        return message
+
+
+def count_sent(value):
+    """
+    Returns the number of messages sent given the return value of
+    ``send_messages``: a number, None, or a list of :class:`SendResult`
+    from a backend created with ``return_results=True``.
+    """
+    if isinstance(value, list):
+        return len([result for result in value if result.sent])
+    return value or 0
+
+
+def requeue(results, refused=False):
+    """
+    Returns the messages to send again to retry the deferred recipients,
+    and the refused ones if refused is True, of a list of
+    :class:`SendResult`.
+    """
+    messages = []
+    for result in results:
+        message = result.get_retry_message(refused)
+        if message is not None:
+            messages.append(message)
+    return messages
@@ -1,3 +1,20 @@
+"""
+Signals sent by the email backends, with the app as sender and the
+message and backend as arguments.
+
+By default receivers are called as the messages are sent. With
+``EMAIL_SIGNAL_DISPATCH`` set to ``'batch'``, the signals of a call to
+``send_messages`` are sent together once it is done, and with
+``'async'`` they are sent by a :class:`Dispatcher` thread, so that slow
+receivers do not hold up sending.
+"""
+from __future__ import with_statement
+
+import atexit
+import Queue
+import threading
+
+from flask import current_app
 from flask.signals import Namespace
 
 signals = Namespace()
@@ -5,4 +22,93 @@ signals = Namespace()
 email_dispatched = signals.signal("email-dispatched", doc="""
 Signal sent when an email is dispatched. This signal will also be sent
 in testing mode, even though the email will not actually be sent.
-""")
\ No newline at end of file
+""")
+
+before_send = signals.signal("email-before-send", doc="""
+Signal sent before an email is handed to the server or the output of the
+backend.
+""")
+
+send_failed = signals.signal("email-send-failed", doc="""
+Signal sent when an email could not be sent, with the exception as
+``error`` if there was one.
+""")
+
+_dispatchers_lock = threading.Lock()
+
+
+def has_receivers(signal):
+    """Whether sending signal would call any receiver."""
+    return bool(getattr(signal, 'receivers', None))
+
+
+def send_signals(app, batch):
+    """
+    Sends a list of (signal, kwargs). The errors of receivers are logged,
+    and do not keep the other receivers from being called.
+    """
+    for signal, kwargs in batch:
+        for receiver in signal.receivers_for(app):
+            try:
+                receiver(app, **kwargs)
+            except Exception:
+                app.logger.exception('Error in %s receiver' % signal.name)
+
+
+class Dispatcher(object):
+    """
+    Thread sending the signals of backends. The queue is bounded: when it
+    is full, batches of signals are dropped rather than holding up the
+    threads sending messages.
+    """
+
+    def __init__(self, app, maxsize=1000):
+        self.app = app
+        self.queue = Queue.Queue(maxsize)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def put(self, batch):
+        """Queues a list of (signal, kwargs) to send."""
+        try:
+            self.queue.put_nowait(batch)
+        except Queue.Full:
+            self.app.logger.warning('Email signal queue full, dropped %d signals'
+                                    % len(batch))
+
+    def flush(self):
+        """Waits until every queued signal is sent."""
+        self.queue.join()
+
+    def stop(self):
+        """Sends the queued signals and stops the thread."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                batch = self.queue.get()
+                try:
+                    if batch is None:
+                        return
+                    send_signals(self.app, batch)
+                finally:
+                    self.queue.task_done()
+
+
+def get_dispatcher():
+    """
+    Returns the signal dispatcher thread of the app, starting it if
+    needed. Its queue holds ``EMAIL_SIGNAL_QUEUE_SIZE`` batches.
+    """
+    app = current_app._get_current_object()
+    with _dispatchers_lock:
+        dispatcher = app.extensions.get('email_signals')
+        if dispatcher is None or not dispatcher.thread.is_alive():
+            dispatcher = app.extensions['email_signals'] = Dispatcher(
+                app, app.config.get('EMAIL_SIGNAL_QUEUE_SIZE', 1000))
+        return dispatcher
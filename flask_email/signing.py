@@ -0,0 +1,172 @@
+"""
+DKIM signing of serialized messages.
+
+Signatures use ``rsa-sha256`` with ``relaxed/relaxed`` canonicalization.
+The RSA primitives come from dkimpy, which has to be installed to sign
+messages. Each signer parses its private key once and is shared by all
+connections of an application.
+"""
+from __future__ import with_statement
+
+import base64
+import hashlib
+import re
+import tempfile
+import threading
+import time
+
+from flask import current_app
+
+try:
+    from dkim.crypto import parse_pem_private_key, RSASSA_PKCS1_v1_5_sign
+except ImportError:
+    parse_pem_private_key = RSASSA_PKCS1_v1_5_sign = None
+
+DEFAULT_HEADERS = (
+    'From', 'Sender', 'Reply-To', 'To', 'Cc', 'Subject', 'Date', 'Message-ID',
+    'MIME-Version', 'Content-Type', 'Content-Transfer-Encoding',
+)
+
+_signers_lock = threading.Lock()
+_wsp_re = re.compile(r'[\t ]+')
+
+
+def canonicalize_header(name, value):
+    """Returns a header line in relaxed canonical form."""
+    value = value.replace('\r', '').replace('\n', '')
+    return '%s:%s\r\n' % (name.strip().lower(), _wsp_re.sub(' ', value).strip())
+
+
+def canonicalize_line(line):
+    """Returns a body line in relaxed canonical form, without its CRLF."""
+    return _wsp_re.sub(' ', line.rstrip('\r\n').rstrip('\t '))
+
+
+def hash_body(lines):
+    """
+    Returns the base64 SHA-256 hash of the body given as an iterable of
+    lines, in relaxed canonical form. The lines are hashed as they come, so
+    a body read from a file is never held in memory.
+    """
+    digest = hashlib.sha256()
+    empty = 0
+    for line in lines:
+        line = canonicalize_line(line)
+        if not line:
+            # Trailing empty lines are ignored, so only count them for now.
+            empty += 1
+            continue
+        digest.update('\r\n' * empty + line + '\r\n')
+        empty = 0
+    return base64.b64encode(digest.digest())
+
+
+def split_headers(lines):
+    """
+    Reads header lines up to the empty line ending them. Returns a list of
+    (name, value) pairs, the value including any folded lines.
+    """
+    headers = []
+    for line in lines:
+        if not line.rstrip('\r\n'):
+            break
+        if line[0] in ' \t' and headers:
+            name, value = headers[-1]
+            headers[-1] = (name, value + line)
+        else:
+            name, sep, value = line.partition(':')
+            headers.append((name, value))
+    return headers
+
+
+class Signer(object):
+    """
+    Signs messages for one domain and selector.
+
+    :param domain: Signing domain (``d=``)
+    :param selector: Selector of the public key in DNS (``s=``)
+    :param private_key: PEM encoded RSA private key
+    :param headers: Names of the headers to sign, when present
+    """
+
+    def __init__(self, domain, selector, private_key, headers=DEFAULT_HEADERS):
+        if parse_pem_private_key is None:
+            raise Exception('dkimpy is required for DKIM signing')
+        self.domain = domain
+        self.selector = selector
+        self.key = parse_pem_private_key(private_key)
+        self.headers = headers
+
+    def get_signature(self, headers, body_hash):
+        """
+        Returns the DKIM-Signature header line for a message with the given
+        (name, value) headers and body hash.
+        """
+        signed = []
+        lines = []
+        names = [name.strip().lower() for name, value in headers]
+        for name in self.headers:
+            if name.lower() in names:
+                # The last occurrence of a header is the one signed.
+                index = len(names) - 1 - names[::-1].index(name.lower())
+                signed.append(name)
+                lines.append(canonicalize_header(*headers[index]))
+        value = ('v=1; a=rsa-sha256; c=relaxed/relaxed; d=%s; s=%s;\n'
+                 '\tt=%d; h=%s;\n\tbh=%s;\n\tb=' % (
+                     self.domain, self.selector, int(time.time()),
+                     ':'.join(signed), body_hash))
+        digest = hashlib.sha256(''.join(lines))
+        digest.update(canonicalize_header('DKIM-Signature', value)[:-2])
+        signature = base64.b64encode(str(RSASSA_PKCS1_v1_5_sign(digest, self.key)))
+        folded = '\n\t'.join(signature[i:i + 72] for i in range(0, len(signature), 72))
+        return 'DKIM-Signature: %s%s\n' % (value, folded)
+
+    def sign(self, data):
+        """Returns the message string data with a DKIM signature."""
+        head, sep, body = data.partition('\n\n')
+        headers = split_headers(head.splitlines(True))
+        return self.get_signature(headers, hash_body(body.splitlines(True))) + data
+
+    def sign_file(self, fp, max_size=0):
+        """
+        Returns a new rewound spooled file holding the message read from the
+        file-like object fp with a DKIM signature. fp is closed.
+        """
+        fp.seek(0)
+        headers = split_headers(fp)
+        body_hash = hash_body(fp)
+        signed = tempfile.SpooledTemporaryFile(max_size)
+        signed.write(self.get_signature(headers, body_hash))
+        fp.seek(0)
+        for line in fp:
+            signed.write(line)
+        fp.close()
+        signed.seek(0)
+        return signed
+
+
+def get_signer(app=None):
+    """
+    Returns the :class:`Signer` configured by the ``EMAIL_DKIM_*`` settings,
+    shared by all connections of the app, or None if ``EMAIL_DKIM_DOMAIN``
+    is not set.
+    """
+    app = app or current_app
+    domain = app.config.get('EMAIL_DKIM_DOMAIN')
+    if not domain:
+        return None
+    selector = app.config.get('EMAIL_DKIM_SELECTOR', 'default')
+    with _signers_lock:
+        signers = app.extensions.setdefault('email_dkim', {})
+        if (domain, selector) not in signers:
+            private_key = app.config.get('EMAIL_DKIM_PRIVATE_KEY')
+            if not private_key:
+                raise Exception('EMAIL_DKIM_PRIVATE_KEY required')
+            if '-----BEGIN' not in private_key:
+                # A path to the key file.
+                with open(private_key, 'rb') as f:
+                    private_key = f.read()
+            signers[(domain, selector)] = Signer(
+                domain, selector, private_key,
+                headers=app.config.get('EMAIL_DKIM_HEADERS', DEFAULT_HEADERS))
+        return signers[(domain, selector)]
@@ -0,0 +1,86 @@
+"""
+Rendering of email messages from Jinja templates.
+
+An email template is made of up to three templates of the application,
+named after it: ``<name>.subject.txt``, ``<name>.txt`` and ``<name>.html``.
+"""
+from jinja2 import TemplateNotFound
+
+from flask import current_app
+
+from .message import EmailMultiAlternatives
+
+TEMPLATE_PARTS = ('subject.txt', 'txt', 'html')
+
+
+def get_templates(template_name, app=None):
+    """
+    Returns the compiled (subject, text, html) templates of an email
+    template, None standing for a missing one. Templates are cached by the
+    app, and loaded again when they change if the Jinja environment auto
+    reloads templates.
+    """
+    app = app or current_app
+    env = app.jinja_env
+    cache = app.extensions.setdefault('email_templates', {})
+    templates = cache.get(template_name)
+    if templates is not None and env.auto_reload:
+        for template in templates:
+            if template is None or not template.is_up_to_date:
+                templates = None
+                break
+    if templates is None:
+        templates = []
+        for part in TEMPLATE_PARTS:
+            try:
+                templates.append(env.get_template('%s.%s' % (template_name, part)))
+            except TemplateNotFound:
+                templates.append(None)
+        if templates[1] is None and templates[2] is None:
+            raise TemplateNotFound('%s.txt' % template_name)
+        templates = cache[template_name] = tuple(templates)
+    return templates
+
+
+def render_email(template_name, contexts, **kwargs):
+    """
+    Renders an email template once for each context, and yields the
+    resulting :class:`EmailMultiAlternatives` as they are rendered.
+
+    The templates are looked up once, and the context of the template
+    context processors is set up once for the whole batch. The recipients
+    of each message are the ``to`` item of its context, which is available
+    to the templates as well. Without a subject template, the subject is
+    the ``subject`` item of the context.
+
+    :param template_name: Name of the email template, e.g. ``'emails/welcome'``
+    :param contexts: Iterable of template contexts, one per message
+    :param \*\*kwargs: Options of every :class:`EmailMultiAlternatives`,
+        e.g. ``from_email`` or ``headers``
+    """
+    app = current_app._get_current_object()
+    subject_template, text_template, html_template = get_templates(template_name, app)
+    base_context = {}
+    app.update_template_context(base_context)
+    for context in contexts:
+        values = base_context.copy()
+        values.update(context)
+        if subject_template is not None:
+            subject = subject_template.render(values)
+        else:
+            subject = values.get('subject', '')
+        # A subject template usually ends with a newline.
+        subject = ' '.join(subject.splitlines()).strip()
+        to = values.get('to')
+        if isinstance(to, basestring):
+            to = [to]
+        html = html_template.render(values) if html_template is not None else None
+        if text_template is None:
+            message = EmailMultiAlternatives(subject, html, to=to, **kwargs)
+            message.content_subtype = 'html'
+        else:
+            message = EmailMultiAlternatives(subject, text_template.render(values),
+                                             to=to, **kwargs)
+            if html is not None:
+                message.attach_alternative(html, 'text/html')
+        yield message
@@ -0,0 +1,248 @@
+"""
+Tracing of email backends.
+
+A tracer is any object with the ``start_as_current_span(name,
+attributes=None)`` and ``start_span(name, attributes=None)`` methods of an
+OpenTelemetry tracer, e.g. ``opentelemetry.trace.get_tracer('flask_email')``,
+set as ``EMAIL_TRACER``. Backends open a span per call to
+``send_messages``, with a child span per message, per phase of sending
+(``email.connect``, ``email.tls``, ``email.render``, ``email.response``...)
+and per SMTP command (``smtp.mail``, ``smtp.rcpt``, ``smtp.data``...).
+Threads sending on behalf of a call, like parallel SMTP connections,
+continue its trace with :func:`get_context` and :func:`use_context`.
+
+With ``EMAIL_SLOW_SEND_THRESHOLD``, a :class:`SlowSendLog` logs the spans
+of any call to ``send_messages`` slower than the threshold as a warning
+of the application logger::
+
+    Slow email send: 8.214s email.send_messages (email.backend=smtp, email.messages=1)
+      0.004s email.connect
+      7.901s email.tls
+      0.307s email.message (email.recipients=2)
+        0.001s email.render
+        0.001s email.serialize
+        0.305s email.transmit
+          0.001s smtp.mail (smtp.reply_code=250)
+          0.302s smtp.rcpt (smtp.reply_code=250)
+"""
+from __future__ import with_statement
+
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from .utils import import_module
+
+try:
+    from opentelemetry import context as otel_context
+except ImportError:
+    otel_context = None
+
+_logs_lock = threading.Lock()
+
+
+class RecordedSpan(object):
+    """
+    A span recorded by :class:`SlowSendLog`, wrapping the span of the
+    tracer it decorates, if any.
+    """
+
+    def __init__(self, log, name, attributes, parent, span=None):
+        self.log = log
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.parent = parent
+        self.root = parent.root if parent is not None else self
+        self.span = span
+        self.children = []
+        self.descendants = 0
+        self.start = time.time()
+        self.duration = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+        if self.span is not None:
+            self.span.set_attribute(key, value)
+
+    def record_exception(self, exception):
+        self.attributes['exception'] = repr(exception)
+        if self.span is not None:
+            self.span.record_exception(exception)
+
+    def end(self):
+        self.duration = time.time() - self.start
+        if self.span is not None:
+            self.span.end()
+        if self.parent is None:
+            self.log._report(self)
+
+
+class SlowSendLog(object):
+    """
+    Tracer recording spans to log those of sends slower than threshold
+    seconds, passing them on to the tracer it decorates if there is one.
+
+    :param threshold: Duration in seconds of the root span beyond which it
+        is logged
+    :param logger: Logger of the warnings
+    :param tracer: Tracer to pass the spans on to
+    """
+    # Most spans kept per send; the others are timed but not logged.
+    max_spans = 200
+
+    def __init__(self, threshold, logger, tracer=None):
+        self.threshold = threshold
+        self.logger = logger
+        self.tracer = tracer
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _get_current(self):
+        return getattr(self._local, 'span', None)
+
+    def get_current_span(self):
+        """Returns the span current in this thread, or None."""
+        return self._get_current()
+
+    @contextmanager
+    def use_span(self, span):
+        """
+        Makes span current in this thread for the block, without ending it,
+        so that spans started by a worker thread are its children.
+        """
+        previous = self._get_current()
+        self._local.span = span
+        try:
+            yield span
+        finally:
+            self._local.span = previous
+
+    def _start(self, name, attributes, span):
+        parent = self._get_current()
+        recorded = RecordedSpan(self, name, attributes, parent, span)
+        if parent is not None:
+            # Worker threads may add spans to the same tree.
+            with self._lock:
+                recorded.root.descendants += 1
+                if recorded.root.descendants <= self.max_spans:
+                    parent.children.append(recorded)
+        return recorded
+
+    def start_span(self, name, attributes=None):
+        span = None
+        if self.tracer is not None:
+            span = self.tracer.start_span(name, attributes=attributes)
+        return self._start(name, attributes, span)
+
+    @contextmanager
+    def start_as_current_span(self, name, attributes=None):
+        if self.tracer is not None:
+            with self.tracer.start_as_current_span(name, attributes=attributes) as span:
+                with self._current(self._start(name, attributes, span)) as recorded:
+                    yield recorded
+        else:
+            with self._current(self._start(name, attributes, None)) as recorded:
+                yield recorded
+
+    @contextmanager
+    def _current(self, span):
+        self._local.span = span
+        try:
+            yield span
+        except:
+            span.attributes['exception'] = repr(sys.exc_info()[1])
+            raise
+        finally:
+            self._local.span = span.parent
+            # The span of the decorated tracer is ended by its context manager.
+            span.span = None
+            span.end()
+
+    def _report(self, root):
+        if root.duration < self.threshold:
+            return
+        lines = ['Slow email send: %s' % self._format(root)]
+        def add(span, depth):
+            for child in span.children:
+                lines.append('%s%s' % ('  ' * depth, self._format(child)))
+                add(child, depth + 1)
+        add(root, 1)
+        dropped = root.descendants - self.max_spans
+        if dropped > 0:
+            lines.append('  (%d more spans)' % dropped)
+        self.logger.warning('\n'.join(lines))
+
+    def _format(self, span):
+        if span.duration is None:
+            text = '(not ended) %s' % span.name
+        else:
+            text = '%.3fs %s' % (span.duration, span.name)
+        if span.attributes:
+            text += ' (%s)' % ', '.join('%s=%s' % item for item in sorted(span.attributes.items()))
+        return text
+
+
+def get_context(tracer):
+    """
+    Returns the tracing context of the current thread, for
+    :func:`use_context` to continue the trace in another thread: the
+    current span of tracer if it has a ``get_current_span`` method, like
+    :class:`SlowSendLog`, and the OpenTelemetry context if it is installed.
+    """
+    if tracer is None:
+        return None
+    span = None
+    if hasattr(tracer, 'get_current_span'):
+        span = tracer.get_current_span()
+    otel = otel_context.get_current() if otel_context is not None else None
+    return span, otel
+
+
+@contextmanager
+def use_context(tracer, context):
+    """
+    Continues the trace of the context returned by :func:`get_context` in
+    the current thread for the block, so that the spans started in it have
+    the same parent.
+    """
+    if context is None:
+        yield
+        return
+    span, otel = context
+    token = otel_context.attach(otel) if otel is not None else None
+    try:
+        if hasattr(tracer, 'use_span'):
+            with tracer.use_span(span):
+                yield
+        else:
+            yield
+    finally:
+        if token is not None:
+            otel_context.detach(token)
+
+
+def get_tracer(app, tracer=None, slow_threshold=None):
+    """
+    Returns the tracer of backends: tracer, or ``EMAIL_TRACER`` (a tracer
+    or its import path), decorated by a :class:`SlowSendLog` if
+    slow_threshold or ``EMAIL_SLOW_SEND_THRESHOLD`` is set. Returns None if
+    sends are not traced.
+    """
+    if tracer is None:
+        tracer = app.config.get('EMAIL_TRACER')
+    if isinstance(tracer, basestring):
+        mod_name, attr = tracer.rsplit('.', 1)
+        tracer = getattr(import_module(mod_name), attr)
+    if slow_threshold is None:
+        slow_threshold = app.config.get('EMAIL_SLOW_SEND_THRESHOLD')
+    if slow_threshold is not None:
+        # Shared by the backends of the app, so that the spans of backends
+        # wrapping each other are logged together.
+        with _logs_lock:
+            logs = app.extensions.setdefault('email_slow_send_logs', {})
+            key = (id(tracer), slow_threshold)
+            if key not in logs:
+                logs[key] = SlowSendLog(slow_threshold, app.logger, tracer)
+            tracer = logs[key]
+    return tracer
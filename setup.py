@@ -34,6 +34,9 @@ setup(
         'Flask',
         'blinker',
     ],
+    extras_require={
+        'dkim': ['dkimpy'],
+    },
     classifiers=[
         'Environment :: Web Environment',
         'Intended Audience :: Developers',
@@ -10,7 +10,8 @@ from flask.ext.email.backends.filebased import Mail as FilebasedMail
 from flask.ext.email.backends.locmem import Mail as LocMemMail
 from flask.ext.email.backends.dummy import Mail as DummyMail
 from flask.ext.email.message import EmailMessage
-from flask.ext.email import get_connection, send_mail, send_mass_mail, mail_managers, mail_admins
+from flask.ext.email import get_connection, send_mail, send_mass_mail, stream_mass_mail, mail_managers, mail_admins
+from flask.ext.email.batching import batch, init_batching
 
 import unittest
 import shutil
@@ -64,6 +65,11 @@ class CustomMail(BaseMail):
         return len(email_messages)
 
 
+class FailingMail(BaseMail):
+    def send_messages(self, email_messages):
+        raise ValueError('Failed to send')
+
+
 class FlaskTestCase(unittest.TestCase):
     TESTING = True
     DEFAULT_FROM_EMAIL = 'support@mysite.com'
@@ -154,6 +160,105 @@ class GeneralEmailBackendTests(FlaskTestCase):
         self.assertEqual(connection.test_outbox[0].subject, '[Flask] Manager message')
 
 
+    def test_stream_mass_mail(self):
+        """Test chunking, progress and cancellation of stream_mass_mail()"""
+        def datatuple():
+            for i in range(5):
+                yield ('Subject%d' % i, 'Content', 'from@example.com', ['to%d@example.com' % i])
+        connection = get_connection('tests.CustomMail')
+        progress = []
+        num_sent, chunks = stream_mass_mail(datatuple(), batch_size=2, connection=connection,
+                                            progress=lambda sent, total: progress.append((sent, total)))
+        self.assertEqual(num_sent, 5)
+        self.assertEqual(chunks, [2, 2, 1])
+        self.assertEqual(progress, [(2, 2), (2, 4), (1, 5)])
+        self.assertEqual([m.subject for m in connection.test_outbox], ['Subject%d' % i for i in range(5)])
+
+        connection = get_connection('tests.CustomMail')
+        email = EmailMessage('Subject', 'Content', 'from@example.com', ['to@example.com'])
+        num_sent, chunks = stream_mass_mail(iter([email] * 5), batch_size=2, connection=connection,
+                                            progress=lambda sent, total: total < 4)
+        self.assertEqual(num_sent, 4)
+        self.assertEqual(chunks, [2, 2])
+        self.assertEqual(connection.test_outbox, [email] * 4)
+
+    def test_batch(self):
+        """Messages sent in a batch share one connection and are sent on exit"""
+        connection1 = get_connection('tests.CustomMail')
+        connection2 = get_connection('tests.CustomMail')
+        with batch():
+            send_mail('Subject1', 'Content', 'from@example.com', ['to@example.com'], connection=connection1)
+            with batch():
+                send_mail('Subject2', 'Content', 'from@example.com', ['to@example.com'], connection=connection2)
+            send_mass_mail([
+                    ('Subject3', 'Content', 'from@example.com', ['to@example.com']),
+                ], connection=connection2)
+            self.assertEqual(connection1.test_outbox, [])
+        self.assertEqual([m.subject for m in connection1.test_outbox], ['Subject1', 'Subject2', 'Subject3'])
+        self.assertEqual(connection2.test_outbox, [])
+
+    def test_batch_errors(self):
+        """Errors sending a batch neither drop other messages nor hide errors of the block"""
+        failing = get_connection('tests.FailingMail')
+        connection = get_connection('tests.CustomMail')
+
+        def send():
+            with batch():
+                send_mail('Subject1', 'Content', 'from@example.com', ['to@example.com'], connection=failing)
+                send_mail('Subject2', 'Content', 'from@example.com', ['to@example.com'], connection=connection)
+        self.assertRaises(ValueError, send)
+        self.assertEqual([m.subject for m in connection.test_outbox], ['Subject2'])
+
+        def send_and_raise():
+            with batch():
+                send_mail('Subject3', 'Content', 'from@example.com', ['to@example.com'], connection=failing)
+                send_mail('Subject4', 'Content', 'from@example.com', ['to@example.com'], connection=connection)
+                raise KeyError('block')
+        self.assertRaises(KeyError, send_and_raise)
+        self.assertEqual([m.subject for m in connection.test_outbox], ['Subject2', 'Subject4'])
+
+    def test_batch_without_context(self):
+        self.ctx.pop()
+        try:
+            with self.assertRaises(RuntimeError):
+                with batch():
+                    pass
+        finally:
+            self.ctx.push()
+
+    @override_settings(EMAIL_BACKEND='flask.ext.email.backends.locmem.Mail')
+    def test_request_batching(self):
+        """Messages sent during a request are flushed at the end of it"""
+        mail.outbox = []
+        init_batching(self.app)
+
+        @self.app.route('/')
+        def index():
+            send_mail('Subject1', 'Content', 'from@example.com', ['to@example.com'])
+            send_mail('Subject2', 'Content', 'from@example.com', ['to@example.com'])
+            self.assertEqual(mail.outbox, [])
+            return 'OK'
+
+        self.app.test_client().get('/')
+        self.assertEqual([m.subject for m in mail.outbox], ['Subject1', 'Subject2'])
+
+    @override_settings(EMAIL_BACKEND='flask.ext.email.backends.locmem.Mail')
+    def test_request_batching_after_response(self):
+        """Batches can be flushed after the response is sent"""
+        mail.outbox = []
+        init_batching(self.app, after_response=True)
+
+        @self.app.route('/')
+        def index():
+            send_mail('Subject', 'Content', 'from@example.com', ['to@example.com'])
+            return 'OK'
+
+        response = self.app.test_client().get('/', buffered=False)
+        self.assertEqual(mail.outbox, [])
+        response.close()
+        self.assertEqual([m.subject for m in mail.outbox], ['Subject'])
+
+
 class BaseEmailBackendTests(object):
     def assertStartsWith(self, first, second):
         if not first.startswith(second):
@@ -183,6 +288,18 @@ class BaseEmailBackendTests(object):
         self.assertEqual(message["from"], "from@example.com")
         self.assertEqual(message.get_all("to"), ["to@example.com"])
 
+    def test_send_spooled(self):
+        """Messages over EMAIL_SPOOL_THRESHOLD are streamed from a temporary file"""
+        email = EmailMessage('Subject', 'Content\n.dot', 'from@example.com', ['to@example.com'])
+        email.attach('data.bin', 'x' * 4096, 'application/octet-stream')
+        with override_settings(EMAIL_SPOOL_THRESHOLD=1024):
+            num_sent = get_connection().send_messages([email])
+        self.assertEqual(num_sent, 1)
+        message = self.get_the_message()
+        self.assertEqual(message["subject"], "Subject")
+        self.assertEqual(message.get_payload(0).get_payload().rstrip('\r\n'), "Content\n.dot")
+        self.assertEqual(message.get_payload(1).get_payload(decode=True), 'x' * 4096)
+
     def test_send_many(self):
         email1 = EmailMessage('Subject', 'Content1', 'from@example.com', ['to@example.com'])
         email2 = EmailMessage('Subject', 'Content2', 'from@example.com', ['to@example.com'])
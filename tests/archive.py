@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+from flask.ext.email import get_connection
+from flask.ext.email.archive import Archive
+from flask.ext.email.message import EmailMessage
+
+import bz2
+import os
+import shutil
+import tempfile
+
+from . import FlaskTestCase
+
+
+class ArchiveTests(FlaskTestCase):
+    EMAIL_BACKEND = 'flask.ext.email.backends.filebased.Mail'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.EMAIL_FILE_PATH = self.tmp_dir
+        super(ArchiveTests, self).setUp()
+
+    def get_message(self, i):
+        return EmailMessage('Subject %d' % i, 'Content %d\n\nMore' % i, 'from@example.com',
+                            ['to%d@example.com' % i], cc=['cc@example.com'],
+                            headers={'Message-ID': '<%d@example.com>' % i})
+
+    def test_index(self):
+        connection = get_connection()
+        connection.send_messages([self.get_message(i) for i in range(3)])
+        archive = Archive(self.tmp_dir)
+        self.assertEqual(archive.update(), 3)
+        self.assertEqual(archive.update(), 0)
+
+        entry, = archive.find(recipient='TO1@example.com')
+        self.assertEqual(entry.message_id, '<1@example.com>')
+        self.assertEqual(entry.sender, 'from@example.com')
+        self.assertEqual(entry.subject, 'Subject 1')
+        self.assertEqual(len(archive.find(recipient='cc@example.com')), 3)
+        self.assertEqual(len(archive.find(subject='Subject 2', recipient='cc@example.com')), 1)
+        self.assertTrue(archive.find(since=entry.timestamp - 60))
+        self.assertEqual(archive.find(until=entry.timestamp - 60), [])
+
+        message = archive.get('<2@example.com>')
+        self.assertEqual(message['Subject'], 'Subject 2')
+        self.assertEqual(message.get_payload(), 'Content 2\n\nMore')
+        self.assertEqual(archive.get('<missing@example.com>'), None)
+
+        # Appended messages are indexed incrementally.
+        connection.send_messages([self.get_message(3)])
+        self.assertEqual(archive.update(), 1)
+        self.assertEqual(archive.get('<3@example.com>')['Subject'], 'Subject 3')
+
+    def test_rotated(self):
+        """Entries follow log files that were rotated and compressed"""
+        connection = get_connection(max_bytes=1, compress='gzip')
+        connection.send_messages([self.get_message(0)])
+        archive = Archive(self.tmp_dir)
+        self.assertEqual(archive.update(), 1)
+        connection.send_messages([self.get_message(1)])
+        connection.flush()
+        self.assertEqual(archive.update(), 1)
+        self.assertTrue(archive.find(message_id='<0@example.com>')[0].path.endswith('.gz'))
+        self.assertEqual(archive.get('<0@example.com>').get_payload(), 'Content 0\n\nMore')
+        self.assertEqual(archive.get('<1@example.com>').get_payload(), 'Content 1\n\nMore')
+
+    def test_compressing(self):
+        """Compressed copies are skipped until their log file is removed"""
+        get_connection().send_messages([self.get_message(0)])
+        archive = Archive(self.tmp_dir)
+        self.assertEqual(archive.update(), 1)
+        (name,) = [name for name in os.listdir(self.tmp_dir) if name.endswith('.log')]
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'rb') as f:
+            compressed = bz2.BZ2File(path + '.bz2', 'wb')
+            compressed.write(f.read())
+            compressed.close()
+        self.assertEqual(archive.update(), 0)
+        self.assertEqual(len(archive.find(message_id='<0@example.com>')), 1)
+
+    def test_maildir(self):
+        connection = get_connection(maildir=True)
+        connection.send_messages([self.get_message(i) for i in range(2)])
+        archive = Archive(self.tmp_dir)
+        self.assertEqual(archive.update(), 2)
+        entry, = archive.find(message_id='<1@example.com>')
+        os.rename(os.path.join(self.tmp_dir, entry.path),
+                  os.path.join(self.tmp_dir, 'cur', os.path.basename(entry.path) + ':2,S'))
+        self.assertEqual(archive.update(), 0)
+        self.assertEqual(archive.get('<1@example.com>').get_payload(), 'Content 1\n\nMore')
@@ -2,6 +2,7 @@
 from __future__ import with_statement
 
 from flask.ext.email import get_connection, send_mail
+from flask.ext.email.backends.console import get_writer
 
 from email import message_from_string
 import sys
@@ -39,3 +40,27 @@ class ConsoleBackendTests(BaseEmailBackendTests, FlaskTestCase):
         connection = get_connection(self.EMAIL_BACKEND, stream=s)
         send_mail('Subject', 'Content', 'from@example.com', ['to@example.com'], connection=connection)
         self.assertTrue(s.getvalue().startswith('Content-Type: text/plain; charset="utf-8"\nMIME-Version: 1.0\nContent-Transfer-Encoding: 7bit\nSubject: Subject\nFrom: from@example.com\nTo: to@example.com\nDate: '))
+
+    def test_background(self):
+        """Messages are written by the writer thread"""
+        s = StringIO()
+        connection = get_connection(self.EMAIL_BACKEND, stream=s, background=True)
+        send_mail('Subject', 'Content', 'from@example.com', ['to@example.com'], connection=connection)
+        send_mail('Subject', 'Content', 'from@example.com', ['to@example.com'], connection=connection)
+        connection.flush()
+        self.assertEqual(len(s.getvalue().split('-' * 79)), 3)
+        writer = get_writer()
+        self.assertTrue(writer is get_writer())
+        writer.stop()
+        self.assertFalse(writer.thread.is_alive())
+        self.assertFalse(get_writer() is writer)
+
+    def test_summary(self):
+        """Only the headers of messages over the summary threshold are written"""
+        s = StringIO()
+        connection = get_connection(self.EMAIL_BACKEND, stream=s, summary_threshold=1000)
+        send_mail('Subject', 'Content' * 1000, 'from@example.com', ['to@example.com'], connection=connection)
+        message = message_from_string(s.getvalue())
+        self.assertEqual(message['Subject'], 'Subject')
+        self.assertTrue(message.get_payload().startswith('[7'))
+        self.assertTrue('bytes not shown]' in message.get_payload())
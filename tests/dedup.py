@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+from flask.ext.email import get_connection
+from flask.ext.email.backends.dedup import MemoryStore, SQLiteStore
+import flask.ext.email.backends.locmem as mail
+from flask.ext.email.message import EmailMessage, EmailMultiAlternatives
+
+import os
+import shutil
+import tempfile
+
+from . import FlaskTestCase, override_settings
+
+
+class DedupBackendTests(FlaskTestCase):
+    EMAIL_BACKEND = 'flask.ext.email.backends.dedup.Mail'
+    EMAIL_DEDUP_BACKEND = 'flask.ext.email.backends.locmem.Mail'
+
+    def setUp(self):
+        super(DedupBackendTests, self).setUp()
+        mail.outbox = []
+
+    def test_idempotency_key(self):
+        email1 = EmailMessage('Subject', 'Content', 'from@example.com', ['to@example.com'])
+        email2 = EmailMessage('Subject', 'Content', 'from@example.com', ['to@example.com'],
+                              headers={'Date': 'Fri, 09 Nov 2001 01:08:47 -0000'})
+        self.assertEqual(email1.get_idempotency_key(), email2.get_idempotency_key())
+        email2.extra_headers['Message-ID'] = 'foo'
+        self.assertNotEqual(email1.get_idempotency_key(), email2.get_idempotency_key())
+        email3 = EmailMessage('Subject', 'Content', 'from@example.com', ['other@example.com'])
+        self.assertNotEqual(email1.get_idempotency_key(), email3.get_idempotency_key())
+        email4 = EmailMultiAlternatives('Subject', 'Content', 'from@example.com', ['to@example.com'])
+        email4.attach_alternative('<p>Content</p>', 'text/html')
+        self.assertNotEqual(email1.get_idempotency_key(), email4.get_idempotency_key())
+        email5 = EmailMessage('Subject', 'Content', 'from@example.com', ['to@example.com'], idempotency_key='order-1')
+        self.assertEqual(email5.get_idempotency_key(), 'order-1')
+
+    def test_send_once(self):
+        connection = get_connection()
+        email1 = EmailMessage('Subject', 'Content1', 'from@example.com', ['to@example.com'])
+        email2 = EmailMessage('Subject', 'Content2', 'from@example.com', ['to@example.com'])
+        self.assertEqual(connection.send_messages([email1]), 1)
+        self.assertEqual(connection.send_messages([email1, email2]), 1)
+        self.assertEqual(connection.duplicates, [email1])
+        self.assertEqual(get_connection().send_messages([email2]), 0)
+        self.assertEqual([m.body for m in mail.outbox], ['Content1', 'Content2'])
+
+    @override_settings(EMAIL_DEDUP_BACKEND='flask.ext.email.backends.rest.Mail')
+    def test_results_backend(self):
+        """Messages not sent by a backend returning results are not remembered"""
+        connection = get_connection(endpoint='http://127.0.0.1:1/messages',
+                                    return_results=True, fail_silently=True)
+        email = EmailMessage('Subject', 'Content', 'from@example.com', ['to@example.com'])
+        self.assertEqual(connection.send_messages([email]), 0)
+        self.assertEqual(connection.send_messages([email]), 0)
+        self.assertEqual(connection.duplicates, [])
+
+    def test_memory_store(self):
+        store = MemoryStore(maxsize=2)
+        store.add('a')
+        store.add('b')
+        self.assertTrue('a' in store)
+        store.add('c')
+        self.assertTrue('a' in store)
+        self.assertFalse('b' in store)
+        self.assertEqual(len(store), 2)
+
+    def test_sqlite_store(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'delivered.db')
+        store = SQLiteStore(path, maxsize=1)
+        store.add('a')
+        store.add('b')
+        self.assertTrue('a' in store)
+        self.assertTrue('a' in SQLiteStore(path))
+        self.assertFalse('c' in SQLiteStore(path))
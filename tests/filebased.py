@@ -3,8 +3,10 @@ from __future__ import with_statement
 
 from flask.ext.email.message import EmailMessage
 from flask.ext.email import get_connection
+from flask.ext.email.signals import email_dispatched, send_failed
 
 from email import message_from_string, message_from_file
+import gzip
 import os
 import shutil
 import tempfile
@@ -62,4 +64,97 @@ class FileBackendTests(BaseEmailBackendTests, FlaskTestCase):
         msg.send()
         self.assertEqual(len(os.listdir(self.tmp_dir)), 3)
         msg.send()
-        self.assertEqual(len(os.listdir(self.tmp_dir)), 3)
\ No newline at end of file
+        self.assertEqual(len(os.listdir(self.tmp_dir)), 3)
+
+    def test_rotate(self):
+        """Log files are rotated by size and compressed"""
+        msg = EmailMessage('Subject', 'Content', 'from@example.com', ['to@example.com'])
+        connection = get_connection(max_bytes=1, compress='gzip')
+        connection.send_messages([msg, msg, msg])
+        connection.flush()
+        filenames = sorted(os.listdir(self.tmp_dir))
+        self.assertEqual(len(filenames), 3)
+        self.assertEqual(len([filename for filename in filenames if filename.endswith('.log.gz')]), 2)
+        message = message_from_string(gzip.open(os.path.join(self.tmp_dir, filenames[0])).read())
+        self.assertEqual(message.get_payload(), 'Content\n' + '-' * 79 + '\n')
+
+        connection = get_connection(max_age=60, compress='bz2')
+        connection.send_messages([msg, msg])
+        self.assertEqual(len(os.listdir(self.tmp_dir)), 4)
+        connection._segment_started -= 60
+        connection.send_messages([msg])
+        connection.flush()
+        self.assertEqual(len([filename for filename in os.listdir(self.tmp_dir)
+                              if filename.endswith('.bz2')]), 1)
+        self.assertRaises(Exception, get_connection, compress='zip')
+
+    def test_background(self):
+        msg = EmailMessage('Subject', 'Content', 'from@example.com', ['to@example.com'])
+        connection = get_connection(background=True)
+        connection.send_messages([msg, msg])
+        connection.flush()
+        self.assertEqual(len(self.get_mailbox_content()), 2)
+
+
+class MaildirBackendTests(FileBackendTests):
+    EMAIL_FILE_MAILDIR = True
+
+    def flush_mailbox(self):
+        for subdir in ('tmp', 'new', 'cur'):
+            if not os.path.exists(os.path.join(self.tmp_dir, subdir)):
+                continue
+            for filename in os.listdir(os.path.join(self.tmp_dir, subdir)):
+                os.unlink(os.path.join(self.tmp_dir, subdir, filename))
+
+    def get_mailbox_content(self):
+        new_dir = os.path.join(self.tmp_dir, 'new')
+        if not os.path.exists(new_dir):
+            return []
+        # Order messages by the delivery counter in their names.
+        filenames = sorted(os.listdir(new_dir), key=lambda name: int(name.split('Q')[1].split('.')[0]))
+        return [message_from_file(open(os.path.join(new_dir, filename)))
+                for filename in filenames]
+
+    def test_file_sessions(self):
+        """Every message is delivered to its own file in new"""
+        msg = EmailMessage('Subject', 'Content', 'bounce@example.com', ['to@example.com'], headers={'From': 'from@example.com'})
+        connection = get_connection()
+        self.assertEqual(connection.send_messages([msg, msg]), 2)
+        connection.send_messages([msg])
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['cur', 'new', 'tmp'])
+        self.assertEqual(os.listdir(os.path.join(self.tmp_dir, 'tmp')), [])
+        self.assertEqual(len(os.listdir(os.path.join(self.tmp_dir, 'new'))), 3)
+        message = self.get_mailbox_content()[0]
+        self.assertEqual(message.get('subject'), 'Subject')
+        self.assertEqual(message.get_payload(), 'Content')
+
+    def test_rotate(self):
+        """Rotation only applies to log files"""
+        msg = EmailMessage('Subject', 'Content', 'from@example.com', ['to@example.com'])
+        get_connection(max_bytes=1, compress='gzip').send_messages([msg, msg])
+        self.assertEqual(len(self.get_mailbox_content()), 2)
+
+    def test_fsync(self):
+        msg = EmailMessage('Subject', 'Content', 'bounce@example.com', ['to@example.com'])
+        for fsync in ('batch', 'message'):
+            connection = get_connection(fsync=fsync)
+            connection.max_pending = 2
+            self.assertEqual(connection.send_messages([msg, msg, msg]), 3)
+        self.assertEqual(len(os.listdir(os.path.join(self.tmp_dir, 'new'))), 6)
+        self.assertRaises(Exception, get_connection, fsync='always')
+
+    def test_partial_failure(self):
+        """Messages delivered before a failure are recorded as sent"""
+        msg = EmailMessage('Subject', 'Content', 'bounce@example.com', ['to@example.com'])
+        bad = EmailMessage('Subject', 'Content', 'bounce@example.com', ['to@example.com'])
+        bad.message = None
+        received = []
+        def receiver(sender, message, **kwargs):
+            received.append((message, 'error' in kwargs))
+        for signal in (email_dispatched, send_failed):
+            signal.connect(receiver)
+            self.addCleanup(signal.disconnect, receiver)
+        connection = get_connection(fsync='message', fail_silently=True)
+        self.assertEqual(connection.send_messages([msg, bad, msg]), 1)
+        self.assertEqual(received, [(msg, False), (bad, True), (msg, True)])
+        self.assertEqual(len(self.get_mailbox_content()), 1)
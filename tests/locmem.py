@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 from __future__ import with_statement
 
-from flask import current_app as app
-from flask.ext.email.backends.locmem import Mail
+from flask import Flask, current_app as app
+from flask.ext.email import get_connection
+from flask.ext.email.backends.locmem import Mail, Outbox, get_outbox
 import flask.ext.email.backends.locmem as mail
 from flask.ext.email.message import EmailMessage
 
@@ -30,4 +31,52 @@ class LocmemBackendTests(BaseEmailBackendTests, FlaskTestCase):
         email = EmailMessage('Subject', 'Content', 'bounce@example.com', ['to@example.com'], headers={'From': 'from@example.com'})
         connection.send_messages([email])
         connection2.send_messages([email])
-        self.assertEqual(len(mail.outbox), 2)
\ No newline at end of file
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_app_outbox(self):
+        """Messages are stored in the outbox of the app, indexed"""
+        email1 = EmailMessage('Subject', 'Content', 'from@example.com', ['To <to@example.com>'],
+                              headers={'Message-ID': '<1@example.com>'})
+        email2 = EmailMessage('Other', 'Content', 'from@example.com', ['other@example.com'],
+                              cc=['TO@example.com'])
+        get_connection().send_messages([email1, email2])
+        outbox = get_outbox()
+        self.assertTrue(outbox is get_outbox())
+        self.assertEqual(list(outbox), [email1, email2])
+        self.assertEqual(outbox.filter(to='to@example.com'), [email1, email2])
+        self.assertEqual(outbox.filter(to='to@example.com', subject='Other'), [email2])
+        self.assertEqual(outbox.filter(subject='Missing'), [])
+        self.assertEqual(outbox.get('<1@example.com>'), email1)
+        self.assertEqual(mail.outbox, [email1, email2])
+
+        self.assertEqual(len(get_outbox(Flask(__name__))), 0)
+
+    def test_capacity(self):
+        """Outboxes with a capacity only keep the last messages"""
+        outbox = Outbox(capacity=2)
+        emails = [EmailMessage('Subject %d' % i, 'Content', 'from@example.com', ['to@example.com'])
+                  for i in range(3)]
+        outbox.extend(emails)
+        self.assertEqual(list(outbox), emails[1:])
+        self.assertEqual(outbox.filter(to='to@example.com'), emails[1:])
+        self.assertEqual(outbox.filter(subject='Subject 0'), [])
+        outbox.clear()
+        self.assertEqual(len(outbox), 0)
+        self.assertEqual(outbox.filter(to='to@example.com'), [])
+
+    def test_capacity_changed_message(self):
+        """Messages changed after they were sent are evicted from their index entries"""
+        outbox = Outbox(capacity=1)
+        email = EmailMessage('A', 'Content', 'from@example.com', ['to@example.com'])
+        outbox.append(email)
+        email.subject = 'B'
+        email.to = ['other@example.com']
+        outbox.append(EmailMessage('C', 'Content', 'from@example.com', ['to@example.com']))
+        self.assertEqual(outbox.filter(subject='A'), [])
+        self.assertEqual([m.subject for m in outbox.filter(to='to@example.com')], ['C'])
+
+    def test_no_global_outbox(self):
+        email = EmailMessage('Subject', 'Content', 'from@example.com', ['to@example.com'])
+        get_connection(global_outbox=False).send_messages([email])
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(list(get_outbox()), [email])
@@ -3,6 +3,7 @@ from __future__ import with_statement
 
 from flask.ext.email.message import EmailMessage, EmailMultiAlternatives
 from flask.ext.email.message import BadHeaderError
+from flask.ext.email.render import render_messages
 
 from email import message_from_string
 
@@ -229,4 +230,35 @@ class MessageTests(FlaskTestCase):
         msg = EmailMessage('Subject', u'Body with non latin characters: А Б В Г Д Е Ж Ѕ З И І К Л М Н О П.', 'bounce@example.com', ['to@example.com'], headers={'From': 'from@example.com'})
         s = msg.message().as_string()
         self.assertFalse('Content-Transfer-Encoding: quoted-printable' in s)
-        self.assertTrue('Content-Transfer-Encoding: 8bit' in s)
\ No newline at end of file
+        self.assertTrue('Content-Transfer-Encoding: 8bit' in s)
+
+    def test_render_messages(self):
+        """
+        Messages rendered in worker processes match the in-process output
+        and are reused by render()
+        """
+        headers = {"Date": "Fri, 09 Nov 2001 01:08:47 -0000", "Message-ID": "foo"}
+        email1 = EmailMessage('Subject', 'Content1', 'from@example.com', ['to@example.com'], headers=headers)
+        email2 = EmailMultiAlternatives('Subject', 'Content2', 'from@example.com', ['to@example.com'], headers=headers)
+        email2.attach_alternative('<p>Content2</p>', 'text/html')
+        email2.attach('file.txt', 'Attachment', 'text/plain')
+        messages = render_messages([email1, email2], processes=2)
+        self.assertEqual(messages, [email1, email2])
+        self.assertEqual(email1.rendered, email1.message().as_string())
+        self.assertEqual(email1.render(), email1.rendered)
+        rendered = message_from_string(email2.render())
+        self.assertEqual(rendered.get_content_type(), 'multipart/mixed')
+        self.assertEqual(rendered.get_payload(0).get_payload(1).get_payload(), '<p>Content2</p>')
+        self.assertEqual(rendered.get_payload(1).get_payload(), 'Attachment')
+
+    def test_estimate_size(self):
+        """Estimated sizes are close to the size of the serialized message"""
+        email1 = EmailMessage(u'Sübject', u'Cöntent\n' * 5000, 'from@example.com', ['to@example.com'])
+        email2 = EmailMultiAlternatives('Subject', 'Content ' * 1000, 'from@example.com', ['to@example.com'])
+        email2.attach_alternative('<p>Content</p>' * 1000, 'text/html')
+        email2.attach('file.bin', '\x00\x01' * 50000, 'application/octet-stream')
+        for email in (email1, email2):
+            size = len(email.message().as_string().replace('\n', '\r\n'))
+            self.assertTrue(abs(email.estimate_size() - size) < size * 0.05)
+        email1.rendered = 'Subject: Subject\n\nContent\n'
+        self.assertEqual(email1.estimate_size(), 29)
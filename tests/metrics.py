@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+from StringIO import StringIO
+
+from flask import current_app as app
+from flask.ext.email.backends.console import Mail as ConsoleMail
+from flask.ext.email.backends.locmem import Mail as LocmemMail
+from flask.ext.email.message import EmailMessage
+from flask.ext.email.metrics import Histogram, Registry, create_blueprint, get_registry
+from flask.ext.email.results import SendResult
+
+from . import FlaskTestCase, override_settings
+
+
+class MetricsTests(FlaskTestCase):
+
+    def test_histogram(self):
+        histogram = Histogram((0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 2.65)
+        self.assertEqual(histogram.get_cumulative_counts(),
+                         [(0.1, 2), (1, 3), (float('inf'), 4)])
+
+    def test_registry(self):
+        registry = Registry((0.1, 1))
+        registry.inc('email_messages_total', 2, backend='smtp', status='sent')
+        registry.inc('email_messages_total', backend='smtp', status='sent')
+        registry.observe('email_phase_seconds', 0.5, backend='smtp', phase='connect')
+        with registry.timer('email_phase_seconds', backend='smtp', phase='connect'):
+            pass
+        self.assertEqual(registry.get_counter('email_messages_total', status='sent',
+                                              backend='smtp'), 3)
+        self.assertEqual(registry.get_counter('email_messages_total', backend='smtp',
+                                              status='failed'), 0)
+        self.assertEqual(registry.get_histogram('email_phase_seconds', backend='smtp',
+                                                phase='connect').count, 2)
+        self.assertEqual(registry.to_prometheus().splitlines(), [
+            '# TYPE email_messages_total counter',
+            'email_messages_total{backend="smtp",status="sent"} 3',
+            '# TYPE email_phase_seconds histogram',
+            'email_phase_seconds_bucket{backend="smtp",phase="connect",le="0.1"} 1',
+            'email_phase_seconds_bucket{backend="smtp",phase="connect",le="1"} 2',
+            'email_phase_seconds_bucket{backend="smtp",phase="connect",le="+Inf"} 2',
+            'email_phase_seconds_sum{backend="smtp",phase="connect"} %r'
+            % registry.get_histogram('email_phase_seconds', backend='smtp', phase='connect').sum,
+            'email_phase_seconds_count{backend="smtp",phase="connect"} 2',
+        ])
+
+    def test_disabled(self):
+        connection = ConsoleMail(app, stream=StringIO())
+        self.assertEqual(connection.metrics, None)
+        connection.send_messages([EmailMessage('Subject', 'Content', 'from@example.com',
+                                               ['to@example.com'])])
+        self.assertFalse('email_metrics' in app.extensions)
+
+    @override_settings(EMAIL_METRICS=True)
+    def test_backend(self):
+        """Backends record their phases, messages and bytes"""
+        connection = ConsoleMail(app, stream=StringIO())
+        self.assertTrue(connection.metrics is get_registry())
+        email = EmailMessage('Subject', 'Content', 'from@example.com', ['to@example.com'],
+                             headers={'Date': 'Sat, 19 Oct 2013 12:00:00 -0000',
+                                      'Message-ID': '<1@example.com>'})
+        connection.send_messages([email, email])
+        registry = get_registry()
+        self.assertEqual(registry.get_counter('email_messages_total', backend='console',
+                                              status='sent'), 2)
+        self.assertEqual(registry.get_counter('email_bytes_total', backend='console'),
+                         2 * len(email.message().as_string()))
+        for phase in ('render', 'serialize'):
+            self.assertEqual(registry.get_histogram('email_phase_seconds', backend='console',
+                                                    phase=phase).count, 2)
+        self.assertTrue(registry.get_histogram('email_phase_seconds', backend='console',
+                                               phase='transmit').count >= 2)
+
+    @override_settings(EMAIL_METRICS=True)
+    def test_retries(self):
+        email = EmailMessage('Subject', 'Content', 'from@example.com', ['to@example.com'])
+        retry = SendResult(email, ['to@example.com'], refused={
+            'to@example.com': (451, 'Try again later')}).get_retry_message()
+        self.assertEqual(retry.attempts, 1)
+        LocmemMail(app, global_outbox=False).send_messages([email, retry])
+        registry = get_registry()
+        self.assertEqual(registry.get_counter('email_messages_total', backend='locmem',
+                                              status='sent'), 2)
+        self.assertEqual(registry.get_counter('email_retries_total', backend='locmem'), 1)
+
+    @override_settings(EMAIL_METRICS=True)
+    def test_blueprint(self):
+        app.register_blueprint(create_blueprint(), url_prefix='/email')
+        LocmemMail(app, global_outbox=False).send_messages(
+            [EmailMessage('Subject', 'Content', 'from@example.com', ['to@example.com'])])
+        response = app.test_client().get('/email/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/plain')
+        self.assertTrue('email_messages_total{backend="locmem",status="sent"} 1\n'
+                        in response.data)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import threading
+
+from flask.ext.email import get_connection, send_mass_mail
+from flask.ext.email.backends.base import BaseMail
+from flask.ext.email.backends.priority import Scheduler
+import flask.ext.email.backends.locmem as mail
+from flask.ext.email.message import EmailMessage
+
+from . import FlaskTestCase, override_settings
+
+release = threading.Event()
+
+
+class BlockingMail(BaseMail):
+    """Backend holding messages until released."""
+
+    def send_messages(self, email_messages):
+        release.wait()
+        return len(email_messages)
+
+
+class PriorityBackendTests(FlaskTestCase):
+    EMAIL_BACKEND = 'flask.ext.email.backends.priority.Mail'
+    EMAIL_PRIORITY_BACKEND = 'flask.ext.email.backends.locmem.Mail'
+
+    def setUp(self):
+        super(PriorityBackendTests, self).setUp()
+        mail.outbox = []
+
+    def test_send(self):
+        high = EmailMessage('High', 'Content', 'from@example.com', ['to@example.com'], priority='high')
+        low = EmailMessage('Low', 'Content', 'from@example.com', ['to@example.com'], priority='low')
+        self.assertEqual(get_connection().send_messages([high, low]), 2)
+        self.assertEqual(sorted(m.subject for m in mail.outbox), ['High', 'Low'])
+        num_sent = send_mass_mail([('Subject', 'Content', 'from@example.com', ['to@example.com'])] * 3)
+        self.assertEqual(num_sent, 3)
+
+    def test_unknown_priority(self):
+        email = EmailMessage('Subject', 'Content', 'from@example.com', ['to@example.com'], priority='urgent')
+        self.assertRaises(Exception, get_connection().send_messages, [email])
+
+    def test_weighted_lanes(self):
+        """Lanes are picked in proportion to their weights"""
+        scheduler = Scheduler({
+            'high': {'weight': 3, 'concurrency': 10},
+            'low': {'weight': 1, 'concurrency': 10},
+        }, 'low')
+        for i in range(8):
+            scheduler.submit(EmailMessage('High', priority='high'))
+            scheduler.submit(EmailMessage('Low', priority='low'))
+        picked = [scheduler.next_job(block=False).message.subject for i in range(8)]
+        self.assertEqual(picked.count('High'), 6)
+        self.assertEqual(picked.count('Low'), 2)
+
+    def test_concurrency_limit(self):
+        scheduler = Scheduler({'normal': {'weight': 1, 'concurrency': 1}})
+        scheduler.submit(EmailMessage('First'))
+        scheduler.submit(EmailMessage('Second'))
+        job = scheduler.next_job(block=False)
+        self.assertEqual(scheduler.next_job(block=False), None)
+        scheduler.task_done(job)
+        self.assertEqual(scheduler.next_job(block=False).message.subject, 'Second')
+
+    def test_load_shedding(self):
+        """Low priority messages are shed once the queue is deep enough"""
+        scheduler = Scheduler({
+            'high': {'weight': 1},
+            'low': {'weight': 1, 'shed_at': 2},
+        })
+        self.assertTrue(scheduler.submit(EmailMessage(priority='low')))
+        self.assertTrue(scheduler.submit(EmailMessage(priority='high')))
+        self.assertEqual(scheduler.submit(EmailMessage(priority='low')), None)
+        self.assertTrue(scheduler.submit(EmailMessage(priority='high')))
+        self.assertEqual(scheduler.depth, 3)
+
+    def test_timeout(self):
+        """Messages not sent in time fail, and are taken off their lane"""
+        release.clear()
+        self.addCleanup(release.set)
+        messages = [EmailMessage('Subject', 'Content', 'from@example.com', ['to@example.com'])
+                    for i in range(2)]
+        with override_settings(EMAIL_PRIORITY_BACKEND='tests.priority.BlockingMail'):
+            connection = get_connection(workers=1, timeout=0.05)
+            self.assertRaises(Exception, connection.send_messages, messages)
+            scheduler = connection.get_scheduler()
+            self.assertEqual(scheduler.depth, 0)
+            connection.fail_silently = True
+            self.assertEqual(connection.send_messages(messages[:1]), 0)
+            release.set()
+            scheduler.stop()
+
+    def test_stop(self):
+        """Stopping sends the queued messages and ends the workers"""
+        connection = get_connection()
+        scheduler = connection.get_scheduler()
+        scheduler.submit(EmailMessage('Subject', 'Content', 'from@example.com', ['to@example.com']))
+        scheduler.stop()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(any(worker.is_alive() for worker in scheduler.workers))
+        self.assertTrue(connection.get_scheduler() is not scheduler)
+
+    def test_batch_key(self):
+        """The wrapped backend is built once for the batch key"""
+        connection = get_connection()
+        self.assertTrue(connection.get_batch_key() is connection.get_batch_key())
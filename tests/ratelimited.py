@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+from flask.ext.email import get_connection
+from flask.ext.email.ratelimit import SharedTokenBucket
+import flask.ext.email.backends.locmem as mail
+from flask.ext.email.message import EmailMessage
+
+import fcntl
+import os
+import shutil
+import tempfile
+import time
+
+from . import FlaskTestCase
+
+
+class RateLimitedBackendTests(FlaskTestCase):
+    EMAIL_BACKEND = 'flask.ext.email.backends.ratelimited.Mail'
+    EMAIL_RATE_LIMIT_BACKEND = 'flask.ext.email.backends.locmem.Mail'
+    EMAIL_RATE_LIMIT = 20
+    EMAIL_RATE_LIMIT_BURST = 2
+
+    def setUp(self):
+        super(RateLimitedBackendTests, self).setUp()
+        mail.outbox = []
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def get_messages(self, count):
+        return [EmailMessage('Subject', 'Content', 'from@example.com', ['to@example.com'])
+                for i in range(count)]
+
+    def test_blocking(self):
+        start = time.time()
+        self.assertEqual(get_connection().send_messages(self.get_messages(4)), 4)
+        self.assertTrue(time.time() - start >= 0.09)
+        self.assertEqual(len(mail.outbox), 4)
+
+    def test_non_blocking(self):
+        connection = get_connection(blocking=False, path=os.path.join(self.tmp_dir, 'bucket'))
+        messages = self.get_messages(3)
+        self.assertEqual(connection.send_messages(messages), 2)
+        self.assertEqual(connection.throttled, messages[2:])
+
+    def test_shared_bucket(self):
+        """Buckets opened on the same file share their tokens"""
+        path = os.path.join(self.tmp_dir, 'bucket')
+        bucket1 = SharedTokenBucket(path, 10, 2)
+        bucket2 = SharedTokenBucket(path, 10, 2)
+        self.assertTrue(bucket1.acquire(blocking=False))
+        self.assertTrue(bucket2.acquire(blocking=False))
+        self.assertFalse(bucket1.acquire(blocking=False))
+        self.assertTrue(0 < bucket2.delay() <= 0.1)
+        bucket1.consume()
+        self.assertTrue(0.1 < bucket2.delay() <= 0.2)
+        self.assertTrue(bucket2.acquire())
+        bucket1.close()
+        bucket2.close()
+
+    def test_shared_bucket_fork(self):
+        """Forked processes lock the bucket against their parent"""
+        bucket = SharedTokenBucket(os.path.join(self.tmp_dir, 'bucket'), 10, 2)
+        self.addCleanup(bucket.close)
+        fcntl.flock(bucket._fd, fcntl.LOCK_EX)
+        pid = os.fork()
+        if not pid:
+            try:
+                bucket.consume()
+            finally:
+                os._exit(0)
+        time.sleep(0.1)
+        self.assertEqual(os.waitpid(pid, os.WNOHANG), (0, 0))
+        fcntl.flock(bucket._fd, fcntl.LOCK_UN)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertTrue(bucket.acquire(blocking=False))
+        self.assertFalse(bucket.acquire(blocking=False))
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import unittest
+
+from flask.ext.email import get_connection
+from flask.ext.email.message import EmailMessage
+
+from . import FlaskTestCase
+
+try:
+    import grequests
+except ImportError:
+    grequests = None
+
+
+class RESTBackendTests(FlaskTestCase):
+    EMAIL_BACKEND = 'flask.ext.email.backends.rest.Mail'
+
+    def test_results(self):
+        """Results are kept in last_results, and returned on request"""
+        messages = [
+            EmailMessage('Subject', 'Content', 'from@example.com', ['to@example.com']),
+            EmailMessage('Subject', 'Content', 'from@example.com', []),
+        ]
+        connection = get_connection(endpoint='http://127.0.0.1:1/messages',
+                                    return_results=True, fail_silently=True)
+        results = connection.send_messages(messages)
+        self.assertEqual([result.message for result in results], messages)
+        self.assertEqual(results[0].deferred.keys(), ['to@example.com'])
+        self.assertTrue(results[0].error is not None)
+        self.assertFalse(results[1].sent)
+        self.assertEqual(connection.last_results, results)
+        connection.return_results = False
+        self.assertEqual(connection.send_messages(messages), 0)
+        self.assertEqual(len(connection.last_results), 2)
+
+
+@unittest.skipIf(grequests is None, 'grequests is not installed')
+class ConcurrentRESTBackendTests(RESTBackendTests):
+    EMAIL_BACKEND = 'flask.ext.email.backends.rest.concurrent.Mail'
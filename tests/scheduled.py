@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+from flask.ext.email import get_connection
+from flask.ext.email.backends.scheduled import TimerHeap, get_due_time
+import flask.ext.email.backends.locmem as mail
+from flask.ext.email.message import EmailMessage
+
+import datetime
+import time
+
+from . import FlaskTestCase
+
+
+class UTC(datetime.tzinfo):
+    def utcoffset(self, dt):
+        return datetime.timedelta(0)
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+
+class ScheduledBackendTests(FlaskTestCase):
+    EMAIL_BACKEND = 'flask.ext.email.backends.scheduled.Mail'
+    EMAIL_SCHEDULED_BACKEND = 'flask.ext.email.backends.locmem.Mail'
+
+    def setUp(self):
+        super(ScheduledBackendTests, self).setUp()
+        mail.outbox = []
+
+    def test_due_time(self):
+        self.assertEqual(get_due_time(EmailMessage()), None)
+        self.assertEqual(get_due_time(EmailMessage(send_at=1000)), 1000)
+        self.assertEqual(get_due_time(EmailMessage(send_at=1000, delay=60)), 1060)
+        send_at = datetime.datetime(2013, 1, 9, 9, 0, tzinfo=UTC())
+        self.assertEqual(get_due_time(EmailMessage(send_at=send_at)), 1357722000)
+        due = get_due_time(EmailMessage(delay=datetime.timedelta(minutes=15)))
+        self.assertAlmostEqual(due, time.time() + 900, 0)
+
+    def test_send(self):
+        now = EmailMessage('Now', 'Content', 'from@example.com', ['to@example.com'])
+        later = EmailMessage('Later', 'Content', 'from@example.com', ['to@example.com'], delay=0.2)
+        self.assertEqual(get_connection().send_messages([now, later]), 2)
+        self.assertEqual([m.subject for m in mail.outbox], ['Now'])
+        for i in range(50):
+            if len(mail.outbox) == 2:
+                break
+            time.sleep(0.05)
+        self.assertEqual([m.subject for m in mail.outbox], ['Now', 'Later'])
+
+    def test_cancel(self):
+        connection = get_connection()
+        email = EmailMessage('Later', 'Content', 'from@example.com', ['to@example.com'])
+        handle = connection.schedule(email, time.time() + 0.1)
+        self.assertTrue(handle.cancel())
+        self.assertFalse(handle.cancel())
+        time.sleep(0.2)
+        self.assertEqual(mail.outbox, [])
+
+    def test_cancel_sent_message(self):
+        """Messages scheduled by send() are cancelled through their handle"""
+        email = EmailMessage('Later', 'Content', 'from@example.com', ['to@example.com'], delay=0.1)
+        self.assertEqual(email.send(), 1)
+        self.assertTrue(email.handle.cancel())
+        now = EmailMessage('Now', 'Content', 'from@example.com', ['to@example.com'])
+        later = EmailMessage('Later', 'Content', 'from@example.com', ['to@example.com'], delay=0.1)
+        connection = get_connection()
+        self.assertEqual(connection.send_messages([now, later]), 2)
+        self.assertEqual(now.handle, None)
+        self.assertEqual(connection.handles, [later.handle])
+        for i in range(50):
+            if len(mail.outbox) == 2:
+                break
+            time.sleep(0.05)
+        self.assertEqual([m.subject for m in mail.outbox], ['Now', 'Later'])
+        self.assertFalse(later.handle.cancel())
+
+    def test_pop_due(self):
+        """Due messages come out in order, in batches, skipping cancelled ones"""
+        timer = TimerHeap(self.app, None, batch_size=2)
+        handles = [timer.schedule(EmailMessage(str(due)), due) for due in (3, 1, 4, 2, 5)]
+        handles[1].cancel()
+        self.assertEqual(len(timer), 4)
+        self.assertEqual([m.subject for m in timer.pop_due(now=4)], ['2', '3'])
+        self.assertEqual([m.subject for m in timer.pop_due(now=4)], ['4'])
+        self.assertEqual(timer.pop_due(now=4), [])
+        self.assertEqual(len(timer), 1)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import threading
+from StringIO import StringIO
+
+from flask import current_app as app
+from flask.ext.email.backends.console import Mail as ConsoleMail
+from flask.ext.email.backends.locmem import Mail as LocmemMail, get_outbox
+from flask.ext.email.message import EmailMessage
+from flask.ext.email.signals import (email_dispatched, before_send, send_failed,
+                                     get_dispatcher)
+
+from . import FlaskTestCase, override_settings
+
+
+class BrokenStream(object):
+    def write(self, data):
+        raise IOError('Broken pipe')
+
+
+class SignalsTests(FlaskTestCase):
+
+    def setUp(self):
+        super(SignalsTests, self).setUp()
+        self.received = []
+        for signal in (email_dispatched, before_send, send_failed):
+            signal.connect(self.receiver)
+
+    def tearDown(self):
+        for signal in (email_dispatched, before_send, send_failed):
+            signal.disconnect(self.receiver)
+        super(SignalsTests, self).tearDown()
+
+    def receiver(self, sender, message, backend, **kwargs):
+        self.received.append((sender, message, backend, kwargs.get('error'),
+                              message in get_outbox()))
+
+    def get_messages(self):
+        return [EmailMessage('Subject %d' % i, 'Content', 'from@example.com',
+                             ['to@example.com']) for i in range(2)]
+
+    def test_sync(self):
+        """Receivers are called as the messages are sent"""
+        messages = self.get_messages()
+        backend = LocmemMail(app, global_outbox=False)
+        backend.send_messages(messages)
+        sender = app._get_current_object()
+        self.assertEqual(self.received, [
+            (sender, messages[0], backend, None, False),
+            (sender, messages[1], backend, None, False),
+            (sender, messages[0], backend, None, True),
+            (sender, messages[1], backend, None, True),
+        ])
+
+    def test_failed(self):
+        """Failures send send_failed with the error"""
+        messages = self.get_messages()
+        ConsoleMail(app, stream=BrokenStream(), fail_silently=True).send_messages(messages)
+        self.assertEqual(len(self.received), 4)
+        self.assertEqual([message for sender, message, backend, error, stored
+                          in self.received[2:]], messages)
+        self.assertTrue(isinstance(self.received[2][3], IOError))
+
+    def test_batch(self):
+        """Batched receivers are called once send_messages is done"""
+        messages = self.get_messages()
+        LocmemMail(app, global_outbox=False, signal_dispatch='batch').send_messages(messages)
+        self.assertEqual([(message, stored) for sender, message, backend, error, stored
+                          in self.received], [(message, True) for message in messages * 2])
+
+    def test_receiver_error(self):
+        """Errors of receivers are logged, and do not fail sends, in every mode"""
+        def failing(sender, **kwargs):
+            raise ValueError()
+        email_dispatched.connect(failing)
+        self.addCleanup(email_dispatched.disconnect, failing)
+        for dispatch in ('sync', 'batch', 'async'):
+            self.received = []
+            messages = self.get_messages()
+            backend = LocmemMail(app, global_outbox=False, signal_dispatch=dispatch)
+            self.assertEqual(backend.send_messages(messages), 2)
+            get_dispatcher().flush()
+            self.assertEqual(len(self.received), 4)
+
+    def test_async(self):
+        """Slow receivers do not hold up sending"""
+        release = threading.Event()
+        threads = []
+        def slow(sender, **kwargs):
+            threads.append(threading.current_thread())
+            release.wait()
+        email_dispatched.connect(slow)
+        self.addCleanup(email_dispatched.disconnect, slow)
+        messages = self.get_messages()
+        backend = ConsoleMail(app, stream=StringIO(), signal_dispatch='async')
+        self.assertEqual(backend.send_messages(messages), 2)
+        self.assertTrue('Subject 1' in backend.stream.getvalue())
+        release.set()
+        get_dispatcher().flush()
+        self.assertEqual(len(self.received), 4)
+        self.assertEqual(len(threads), 2)
+        self.assertFalse(threading.current_thread() in threads)
+
+    @override_settings(EMAIL_SIGNAL_DISPATCH='batched')
+    def test_invalid_dispatch(self):
+        self.assertRaises(Exception, ConsoleMail, app)
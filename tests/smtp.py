@@ -2,14 +2,22 @@
 from __future__ import with_statement
 
 from flask import current_app as app
-from flask.ext.email.backends.smtp import Mail
+from flask.ext.email.backends.smtp import LEARNED_LIMIT_TTL, Mail, _learned_max_recipients
+from flask.ext.email.message import EmailMessage
+from flask.ext.email.metrics import get_registry
+from flask.ext.email.results import requeue
+from flask.ext.email.tracing import SlowSendLog
+import flask.ext.email.backends.locmem as mail
 
 import email
+import smtplib
+from email import message_from_string
 import smtpd
 import threading
 import asyncore
 
 from . import BaseEmailBackendTests, FlaskTestCase, override_settings
+from .tracing import Logger, Tracer
 
 class FakeSMTPServer(smtpd.SMTPServer, threading.Thread):
     """
@@ -21,10 +29,19 @@ class FakeSMTPServer(smtpd.SMTPServer, threading.Thread):
         threading.Thread.__init__(self)
         smtpd.SMTPServer.__init__(self, *args, **kwargs)
         self._sink = []
+        self._envelopes = []
         self.active = False
         self.active_lock = threading.Lock()
         self.sink_lock = threading.Lock()
 
+    channel_class = smtpd.SMTPChannel
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            conn, addr = pair
+            self.channel_class(self, conn, addr)
+
     def process_message(self, peer, mailfrom, rcpttos, data):
         m = email.message_from_string(data)
         maddr = email.Utils.parseaddr(m.get('from'))[1]
@@ -32,6 +49,7 @@ class FakeSMTPServer(smtpd.SMTPServer, threading.Thread):
             return "553 '%s' != '%s'" % (mailfrom, maddr)
         self.sink_lock.acquire()
         self._sink.append(m)
+        self._envelopes.append((mailfrom, rcpttos))
         self.sink_lock.release()
 
     def get_sink(self):
@@ -41,9 +59,17 @@ class FakeSMTPServer(smtpd.SMTPServer, threading.Thread):
         finally:
             self.sink_lock.release()
 
+    def get_envelopes(self):
+        self.sink_lock.acquire()
+        try:
+            return self._envelopes[:]
+        finally:
+            self.sink_lock.release()
+
     def flush_sink(self):
         self.sink_lock.acquire()
         self._sink[:] = []
+        self._envelopes[:] = []
         self.sink_lock.release()
 
     def start(self):
@@ -67,6 +93,54 @@ class FakeSMTPServer(smtpd.SMTPServer, threading.Thread):
         self.join()
 
 
+class LimitedSMTPChannel(smtpd.SMTPChannel):
+    """SMTP channel accepting at most two recipients per transaction."""
+    max_recipients = 2
+
+    def smtp_RCPT(self, arg):
+        if len(self._SMTPChannel__rcpttos) >= self.max_recipients:
+            self.push('452 Too many recipients')
+            return
+        smtpd.SMTPChannel.smtp_RCPT(self, arg)
+
+
+class FullMailboxSMTPChannel(smtpd.SMTPChannel):
+    """SMTP channel deferring recipients named full@ with a 452."""
+
+    def smtp_RCPT(self, arg):
+        if 'full@' in arg:
+            self.push('452 4.2.2 Mailbox full')
+        else:
+            smtpd.SMTPChannel.smtp_RCPT(self, arg)
+
+
+class RefusingSMTPChannel(smtpd.SMTPChannel):
+    """SMTP channel refusing recipients named refused@ and deferred@."""
+
+    def smtp_RCPT(self, arg):
+        if 'refused@' in arg:
+            self.push('550 No such user')
+        elif 'deferred@' in arg:
+            self.push('451 Try again later')
+        else:
+            smtpd.SMTPChannel.smtp_RCPT(self, arg)
+
+
+class SizeLimitedSMTPChannel(smtpd.SMTPChannel):
+    """SMTP channel advertising the SIZE extension."""
+    max_size = 1000
+
+    def smtp_EHLO(self, arg):
+        self._SMTPChannel__greeting = arg
+        self.push('250-%s\r\n250 SIZE %d' % (self._SMTPChannel__fqdn, self.max_size))
+
+    def smtp_MAIL(self, arg):
+        smtpd.SMTPChannel.smtp_MAIL(self, arg.split(' ')[0])
+
+    def smtp_DATA(self, arg):
+        raise AssertionError('Oversized message transmitted')
+
+
 class SMTPBackendTests(BaseEmailBackendTests, FlaskTestCase):
     EMAIL_BACKEND = 'flask.ext.email.backends.smtp.Mail'
     EMAIL_HOST = '127.0.0.1'
@@ -119,4 +193,208 @@ class SMTPBackendTests(BaseEmailBackendTests, FlaskTestCase):
     def test_email_disabled_authentication(self):
         backend = Mail(app, username='', password='')
         self.assertEqual(backend.username, '')
-        self.assertEqual(backend.password, '')
\ No newline at end of file
+        self.assertEqual(backend.password, '')
+
+    def test_coalesce_bcc(self):
+        """Messages differing only in Bcc recipients are sent once"""
+        messages = [EmailMessage('Subject', 'Content', 'from@example.com', ['to@example.com'],
+                                 bcc=['bcc%d@example.com' % i]) for i in range(3)]
+        messages.append(EmailMessage('Subject', 'Content', 'from@example.com', ['other@example.com']))
+        self.assertEqual(Mail(app, coalesce='bcc').send_messages(messages), 4)
+        self.assertEqual(self.server.get_envelopes(), [
+            ('from@example.com', ['to@example.com', 'bcc0@example.com', 'bcc1@example.com', 'bcc2@example.com']),
+            ('from@example.com', ['other@example.com']),
+        ])
+
+    def test_coalesce_all(self):
+        """Identical messages to different recipients are broadcast in one transaction"""
+        messages = [EmailMessage('Subject', 'Content', 'from@example.com', ['to%d@example.com' % i])
+                    for i in range(5)]
+        self.assertEqual(Mail(app, coalesce='all', max_recipients=2).send_messages(messages), 5)
+        envelopes = self.server.get_envelopes()
+        self.assertEqual([rcpttos for mailfrom, rcpttos in envelopes], [
+            ['to0@example.com', 'to1@example.com'],
+            ['to2@example.com', 'to3@example.com'],
+            ['to4@example.com'],
+        ])
+        sink = self.server.get_sink()
+        self.assertEqual(sink[0]['To'], 'undisclosed-recipients:;')
+        self.assertEqual(sink[0]['Message-ID'], sink[2]['Message-ID'])
+
+    def test_coalesce_message_id(self):
+        """Messages with their own Message-ID are not merged"""
+        messages = [EmailMessage('Subject', 'Content', 'from@example.com', ['to%d@example.com' % i],
+                                 headers={'Message-ID': '<%d@example.com>' % i})
+                    for i in range(2)]
+        self.assertEqual(Mail(app, coalesce='all').send_messages(messages), 2)
+        self.assertEqual([message['Message-ID'] for message in self.server.get_sink()],
+                         ['<0@example.com>', '<1@example.com>'])
+
+    def test_split_recipients(self):
+        """Recipients over the server's limit are sent in more transactions"""
+        self.server.channel_class = LimitedSMTPChannel
+        self.addCleanup(setattr, self.server, 'channel_class', smtpd.SMTPChannel)
+        self.addCleanup(_learned_max_recipients.clear)
+        backend = Mail(app)
+        email = EmailMessage('Subject', 'Content', 'from@example.com',
+                             ['to%d@example.com' % i for i in range(5)])
+        self.assertEqual(backend.send_messages([email]), 1)
+        self.assertEqual(backend.refused, {})
+        self.assertEqual(backend.get_max_recipients(), 2)
+        self.assertEqual([rcpttos for mailfrom, rcpttos in self.server.get_envelopes()], [
+            ['to0@example.com', 'to1@example.com'],
+            ['to2@example.com', 'to3@example.com'],
+            ['to4@example.com'],
+        ])
+        key = ('127.0.0.1', 2525)
+        _learned_max_recipients[key] = (2, _learned_max_recipients[key][1] - LEARNED_LIMIT_TTL - 1)
+        self.assertEqual(backend.get_max_recipients(), None)
+
+    def test_full_mailbox(self):
+        """Other 452 replies are deferred, and not taken for a recipient limit"""
+        self.server.channel_class = FullMailboxSMTPChannel
+        self.addCleanup(setattr, self.server, 'channel_class', smtpd.SMTPChannel)
+        self.addCleanup(_learned_max_recipients.clear)
+        email = EmailMessage('Subject', 'Content', 'from@example.com',
+                             ['to0@example.com', 'full@example.com', 'to1@example.com'])
+        results = Mail(app, return_results=True).send_messages([email])
+        self.assertEqual(results[0].deferred.keys(), ['full@example.com'])
+        self.assertEqual(Mail(app).get_max_recipients(), None)
+        self.assertEqual(self.server.get_envelopes(),
+                         [('from@example.com', ['to0@example.com', 'to1@example.com'])])
+
+    def test_parallel_connections(self):
+        email = EmailMessage('Subject', 'Content', 'from@example.com',
+                             ['to%d@example.com' % i for i in range(6)])
+        backend = Mail(app, max_recipients=2, parallel=3)
+        self.assertEqual(backend.send_messages([email]), 1)
+        envelopes = self.server.get_envelopes()
+        self.assertEqual(len(envelopes), 3)
+        self.assertEqual(sorted(sum([rcpttos for mailfrom, rcpttos in envelopes], [])),
+                         ['to%d@example.com' % i for i in range(6)])
+
+    def test_results(self):
+        """Per recipient results, and retrying only the deferred recipients"""
+        self.server.channel_class = RefusingSMTPChannel
+        self.addCleanup(setattr, self.server, 'channel_class', smtpd.SMTPChannel)
+        email = EmailMessage('Subject', 'Content', 'from@example.com',
+                             ['to@example.com', 'refused@example.com'], bcc=['deferred@example.com'])
+        results = Mail(app, return_results=True).send_messages([email])
+        self.assertEqual(len(results), 1)
+        result = results[0]
+        self.assertTrue(result.sent)
+        self.assertEqual(result.message, email)
+        self.assertEqual(result.accepted, ['to@example.com'])
+        self.assertEqual(result.refused, {'refused@example.com': (550, 'No such user')})
+        self.assertEqual(result.deferred, {'deferred@example.com': (451, 'Try again later')})
+
+        retry = requeue(results)
+        self.assertEqual(len(retry), 1)
+        self.assertEqual(retry[0].recipients(), ['deferred@example.com'])
+        self.assertEqual(retry[0].rendered, result.data)
+        self.assertEqual(requeue(results, refused=True)[0].recipients(),
+                         ['deferred@example.com', 'refused@example.com'])
+
+        self.server.channel_class = smtpd.SMTPChannel
+        self.server.flush_sink()
+        backend = Mail(app)
+        self.assertEqual(backend.send_messages(retry), 1)
+        self.assertEqual(backend.last_results[0].accepted, ['deferred@example.com'])
+        self.assertEqual(self.server.get_envelopes(), [('from@example.com', ['deferred@example.com'])])
+        self.assertEqual(self.server.get_sink()[0]['Message-ID'],
+                         message_from_string(result.data)['Message-ID'])
+
+    def test_max_size(self):
+        """Messages over the SIZE advertised by the server are not transmitted"""
+        self.server.channel_class = SizeLimitedSMTPChannel
+        self.addCleanup(setattr, self.server, 'channel_class', smtpd.SMTPChannel)
+        email = EmailMessage('Subject', 'Content' * 200, 'from@example.com', ['to@example.com'])
+        backend = Mail(app, fail_silently=True, return_results=True)
+        results = backend.send_messages([email])
+        self.assertEqual(results[0].refused.keys(), ['to@example.com'])
+        self.assertEqual(results[0].refused['to@example.com'][0], 552)
+        self.assertEqual(backend.refused, results[0].refused)
+        self.assertEqual(self.server.get_sink(), [])
+        self.assertRaises(smtplib.SMTPRecipientsRefused, Mail(app).send_messages, [email])
+
+    @override_settings(EMAIL_METRICS=True)
+    def test_metrics(self):
+        """Connections, transmissions and refusals are recorded in the metrics"""
+        self.server.channel_class = RefusingSMTPChannel
+        self.addCleanup(setattr, self.server, 'channel_class', smtpd.SMTPChannel)
+        email1 = EmailMessage('Subject', 'Content', 'from@example.com', ['to@example.com'])
+        email2 = EmailMessage('Subject', 'Content', 'from@example.com', ['refused@example.com'])
+        Mail(app, fail_silently=True).send_messages([email1, email2])
+        registry = get_registry()
+        self.assertEqual(registry.get_counter('email_connections_total', backend='smtp',
+                                              status='opened'), 1)
+        self.assertEqual(registry.get_counter('email_messages_total', backend='smtp',
+                                              status='sent'), 1)
+        self.assertEqual(registry.get_counter('email_messages_total', backend='smtp',
+                                              status='failed'), 1)
+        for phase in ('connect', 'render', 'serialize', 'transmit'):
+            self.assertTrue(registry.get_histogram('email_phase_seconds', backend='smtp',
+                                                   phase=phase).count)
+        self.assertEqual(registry.get_histogram('email_phase_seconds', backend='smtp',
+                                                phase='auth'), None)
+
+    def test_tracing(self):
+        """SMTP commands are traced within the span of their message"""
+        tracer = Tracer()
+        email = EmailMessage('Subject', 'Content', 'from@example.com', ['to@example.com'])
+        Mail(app, tracer=tracer).send_messages([email])
+        root = tracer.get_tree()[0]
+        self.assertEqual(root[0], 'email.send_messages')
+        self.assertEqual([name for name, children in root[1]],
+                         ['email.connect', 'smtp.ehlo', 'smtp.helo', 'email.message',
+                          'smtp.quit'])
+        message = root[1][3]
+        transmit = dict(message[1])['email.transmit']
+        self.assertEqual([name for name, children in transmit],
+                         ['smtp.mail', 'smtp.rcpt', 'smtp.data', 'smtp.content'])
+        codes = [span.attributes['smtp.reply_code'] for span in tracer.spans
+                 if span.name.startswith('smtp.') and span.name != 'smtp.quit']
+        self.assertEqual(codes, [502, 250, 250, 250, 354, 250])
+
+    def test_tracing_parallel(self):
+        """Spans of parallel connections are children of their message"""
+        logger = Logger()
+        email = EmailMessage('Subject', 'Content', 'from@example.com',
+                             ['to%d@example.com' % i for i in range(6)])
+        backend = Mail(app, max_recipients=2, parallel=3, tracer=SlowSendLog(0, logger))
+        self.assertEqual(backend.send_messages([email]), 1)
+        self.assertEqual(len(logger.warnings), 1)
+        lines = logger.warnings[0].splitlines()
+        message = [line for line in lines if ' email.message (' in line][0]
+        depth = len(message) - len(message.lstrip())
+        spans = [line.strip().split(' ', 1)[1].split(' ')[0] for line in lines
+                 if len(line) - len(line.lstrip()) == depth + 2]
+        self.assertEqual(spans.count('email.connect'), 3)
+        self.assertEqual(spans.count('smtp.quit'), 3)
+        self.assertEqual(len([line for line in lines if 'smtp.rcpt' in line]), 6)
+
+    def test_max_size_near_limit(self):
+        """Messages estimated near the size limit are measured before deciding"""
+        class EstimatedMessage(EmailMessage):
+            def estimate_size(self):
+                return 1050
+        small = EstimatedMessage('Subject', 'Content', 'from@example.com', ['to@example.com'])
+        large = EstimatedMessage('Subject', 'Content' * 200, 'from@example.com', ['to@example.com'])
+        backend = Mail(app, max_size=1000, fail_silently=True, return_results=True)
+        results = backend.send_messages([small, large])
+        self.assertTrue(results[0].sent)
+        self.assertEqual(results[1].refused['to@example.com'][0], 552)
+        self.assertEqual(len(self.server.get_sink()), 1)
+
+    def test_oversize_backend(self):
+        """Oversized messages are handed to the oversize backend"""
+        mail.outbox = []
+        email1 = EmailMessage('Subject', 'Content', 'from@example.com', ['to@example.com'])
+        email2 = EmailMessage('Subject', 'Content' * 200, 'from@example.com', ['to@example.com'])
+        backend = Mail(app, max_size=1000, return_results=True,
+                       oversize_backend='flask.ext.email.backends.locmem.Mail')
+        results = backend.send_messages([email1, email2])
+        self.assertEqual([result.message for result in results], [email1, email2])
+        self.assertTrue(results[1].sent)
+        self.assertEqual(len(self.server.get_sink()), 1)
+        self.assertEqual(mail.outbox, [email2])
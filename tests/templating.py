@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+from flask.ext.email import render_email
+from flask.ext.email.templating import get_templates
+
+from jinja2 import DictLoader, TemplateNotFound
+
+from . import FlaskTestCase
+
+
+class TemplatingTests(FlaskTestCase):
+
+    def setUp(self):
+        super(TemplatingTests, self).setUp()
+        self.templates = {
+            'welcome.subject.txt': 'Welcome {{ name }}\n',
+            'welcome.txt': 'Hello {{ name }}, from {{ config.SITE }}',
+            'welcome.html': '<p>Hello {{ name }}</p>',
+            'notice.html': '<p>{{ subject }}</p>',
+        }
+        self.app.config['SITE'] = 'example.com'
+        self.app.jinja_env.loader = DictLoader(self.templates)
+
+    def test_render_email(self):
+        messages = render_email('welcome', [
+            {'name': 'Alice', 'to': 'alice@example.com'},
+            {'name': 'Bob', 'to': ['bob@example.com']},
+        ], from_email='from@example.com')
+        self.assertFalse(isinstance(messages, list))
+        alice, bob = list(messages)
+        self.assertEqual(alice.subject, 'Welcome Alice')
+        self.assertEqual(alice.body, 'Hello Alice, from example.com')
+        self.assertEqual(alice.alternatives, [('<p>Hello Alice</p>', 'text/html')])
+        self.assertEqual(alice.to, ['alice@example.com'])
+        self.assertEqual(alice.from_email, 'from@example.com')
+        self.assertEqual(bob.subject, 'Welcome Bob')
+        self.assertEqual(bob.to, ['bob@example.com'])
+
+    def test_html_only(self):
+        message, = render_email('notice', [{'subject': 'Notice', 'to': 'to@example.com'}])
+        self.assertEqual(message.subject, 'Notice')
+        self.assertEqual(message.body, '<p>Notice</p>')
+        self.assertEqual(message.content_subtype, 'html')
+        self.assertEqual(message.message().get_content_type(), 'text/html')
+
+    def test_missing_template(self):
+        self.assertRaises(TemplateNotFound, get_templates, 'missing')
+
+    def test_cache(self):
+        """Templates are cached, and reloaded when changed with auto reload"""
+        templates = get_templates('welcome')
+        self.assertTrue(get_templates('welcome') is templates)
+        self.templates['welcome.txt'] = 'Hi {{ name }}'
+        self.assertTrue(get_templates('welcome') is templates)
+        self.app.jinja_env.auto_reload = True
+        message, = render_email('welcome', [{'name': 'Alice'}])
+        self.assertEqual(message.body, 'Hi Alice')
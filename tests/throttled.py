@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+from flask.ext.email import get_connection
+from flask.ext.email.backends.throttled import DomainLimiter, get_domains
+from flask.ext.email.ratelimit import TokenBucket
+import flask.ext.email.backends.locmem as mail
+from flask.ext.email.message import EmailMessage
+
+import socket
+import time
+
+from . import FlaskTestCase, override_settings
+
+
+class ThrottledBackendTests(FlaskTestCase):
+    EMAIL_BACKEND = 'flask.ext.email.backends.throttled.Mail'
+    EMAIL_THROTTLE_BACKEND = 'flask.ext.email.backends.locmem.Mail'
+    EMAIL_THROTTLE_LIMITS = {
+        'slow.example.com': {'rate': 10, 'burst': 1, 'concurrency': 1},
+    }
+
+    def setUp(self):
+        super(ThrottledBackendTests, self).setUp()
+        mail.outbox = []
+
+    def test_get_domains(self):
+        email = EmailMessage('Subject', 'Content', 'from@example.com',
+                             ['a@Example.com', 'Name <b@example.org>'], cc=['c@example.com'])
+        self.assertEqual(get_domains(email), ('example.com', 'example.org'))
+
+    def test_interleave_domains(self):
+        """A throttled domain does not hold up other domains"""
+        slow = [EmailMessage('Slow', 'Content', 'from@example.com', ['to@slow.example.com'])
+                for i in range(3)]
+        fast = [EmailMessage('Fast', 'Content', 'from@example.com', ['to@example.com'])
+                for i in range(3)]
+        start = time.time()
+        self.assertEqual(get_connection(workers=1).send_messages(slow + fast), 6)
+        self.assertTrue(time.time() - start >= 0.15)
+        subjects = [m.subject for m in mail.outbox]
+        self.assertEqual(subjects.index('Fast'), 1)
+        self.assertEqual(subjects[-1], 'Slow')
+
+    @override_settings(EMAIL_THROTTLE_BACKEND='flask.ext.email.backends.smtp.Mail')
+    def test_connection_error(self):
+        """Messages of workers that cannot connect are unsent, and the error raised"""
+        emails = [EmailMessage('Subject', 'Content', 'from@example.com', ['to@example.com'])
+                  for i in range(3)]
+        connection = get_connection(host='127.0.0.1', port=1)
+        self.assertRaises(socket.error, connection.send_messages, emails)
+        self.assertEqual(connection.unsent, emails)
+        connection = get_connection(host='127.0.0.1', port=1, fail_silently=True)
+        self.assertEqual(connection.send_messages(emails), 0)
+
+    def test_domain_limiter(self):
+        limiter = DomainLimiter({'*': {'concurrency': 1}})
+        self.assertEqual(limiter.acquire(('example.com',)), 0)
+        self.assertEqual(limiter.acquire(('example.com',)), None)
+        self.assertEqual(limiter.acquire(('example.org',)), 0)
+        limiter.release(('example.com',))
+        self.assertEqual(limiter.acquire(('example.com',)), 0)
+
+    def test_invalid_limits(self):
+        for limit in ({'concurrency': 0}, {'rate': 0}, {'rate': 1, 'burst': 0.5}):
+            self.assertRaises(Exception, get_connection, limits={'example.com': limit})
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(100, 2)
+        self.assertTrue(bucket.acquire(blocking=False))
+        self.assertTrue(bucket.acquire(blocking=False))
+        self.assertFalse(bucket.acquire(blocking=False))
+        self.assertTrue(0 < bucket.delay() <= 0.01)
+        self.assertTrue(bucket.acquire())
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+from contextlib import contextmanager
+from StringIO import StringIO
+
+from flask import current_app as app
+from flask.ext.email.backends.console import Mail as ConsoleMail
+from flask.ext.email.message import EmailMessage
+from flask.ext.email.tracing import SlowSendLog, get_tracer
+
+from . import FlaskTestCase, override_settings
+
+
+class Span(object):
+    def __init__(self, tracer, name, attributes, parent):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.parent = parent
+        self.ended = False
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_exception(self, exception):
+        self.attributes['exception'] = exception
+
+    def end(self):
+        self.ended = True
+
+
+class Tracer(object):
+    """Tracer with the methods of an OpenTelemetry tracer, recording spans."""
+
+    def __init__(self):
+        self.spans = []
+        self.current = None
+
+    def start_span(self, name, attributes=None):
+        span = Span(self, name, attributes, self.current)
+        self.spans.append(span)
+        return span
+
+    @contextmanager
+    def start_as_current_span(self, name, attributes=None):
+        span = self.start_span(name, attributes)
+        self.current = span
+        try:
+            yield span
+        finally:
+            self.current = span.parent
+            span.end()
+
+    def get_tree(self, parent=None):
+        """Returns the spans as nested (name, children) pairs."""
+        return [(span.name, self.get_tree(span)) for span in self.spans
+                if span.parent is parent]
+
+
+class Logger(object):
+    def __init__(self):
+        self.warnings = []
+
+    def warning(self, message):
+        self.warnings.append(message)
+
+tracer = Tracer()
+
+
+class TracingTests(FlaskTestCase):
+
+    def get_messages(self):
+        return [EmailMessage('Subject %d' % i, 'Content', 'from@example.com',
+                             ['to@example.com']) for i in range(2)]
+
+    def test_spans(self):
+        """A span per call, per message and per phase"""
+        tracer = Tracer()
+        backend = ConsoleMail(app, stream=StringIO(), tracer=tracer)
+        backend.send_messages(self.get_messages())
+        message = ('email.message', [('email.render', []), ('email.serialize', [])])
+        self.assertEqual(tracer.get_tree(), [
+            ('email.send_messages', [message, ('email.transmit', []),
+                                     message, ('email.transmit', []),
+                                     ('email.transmit', [])]),
+        ])
+        root = tracer.spans[0]
+        self.assertEqual(root.attributes, {'email.backend': 'console', 'email.messages': 2})
+        self.assertEqual(tracer.spans[1].attributes, {'email.recipients': 1,
+                                                      'email.attempts': 0})
+        self.assertTrue(all(span.ended for span in tracer.spans))
+
+    def test_not_traced(self):
+        backend = ConsoleMail(app, stream=StringIO())
+        self.assertEqual(backend.tracer, None)
+        self.assertEqual(backend.send_messages(self.get_messages()), 2)
+
+    @override_settings(EMAIL_TRACER='tests.tracing.tracer')
+    def test_tracer_setting(self):
+        self.assertTrue(ConsoleMail(app).tracer is tracer)
+
+    def test_slow_send_log(self):
+        """Sends slower than the threshold are logged with their spans"""
+        logger = Logger()
+        log = SlowSendLog(0, logger)
+        ConsoleMail(app, stream=StringIO(), tracer=log).send_messages(self.get_messages())
+        self.assertEqual(len(logger.warnings), 1)
+        lines = logger.warnings[0].splitlines()
+        self.assertTrue(lines[0].startswith('Slow email send: '))
+        self.assertTrue(lines[0].endswith(
+            's email.send_messages (email.backend=console, email.messages=2)'))
+        self.assertEqual([line.strip().split(' ', 1)[1] for line in lines[1:]], [
+            'email.message (email.attempts=0, email.recipients=1)',
+            'email.render',
+            'email.serialize',
+            'email.transmit',
+            'email.message (email.attempts=0, email.recipients=1)',
+            'email.render',
+            'email.serialize',
+            'email.transmit',
+            'email.transmit',
+        ])
+        self.assertTrue(lines[1].startswith('  0'))
+        self.assertTrue(lines[2].startswith('    0'))
+
+        log = SlowSendLog(60, logger)
+        ConsoleMail(app, stream=StringIO(), tracer=log).send_messages(self.get_messages())
+        self.assertEqual(len(logger.warnings), 1)
+
+    def test_slow_send_log_max_spans(self):
+        logger = Logger()
+        log = SlowSendLog(0, logger)
+        log.max_spans = 3
+        ConsoleMail(app, stream=StringIO(), tracer=log).send_messages(self.get_messages())
+        lines = logger.warnings[0].splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(lines[-1], '  (6 more spans)')
+
+    def test_slow_send_log_tracer(self):
+        """The slow send log passes the spans on to the tracer it decorates"""
+        inner = Tracer()
+        logger = Logger()
+        backend = ConsoleMail(app, stream=StringIO(), tracer=inner, slow_send_threshold=0)
+        self.assertTrue(isinstance(backend.tracer, SlowSendLog))
+        self.assertTrue(backend.tracer.tracer is inner)
+        backend.tracer.logger = logger
+        backend.send_messages(self.get_messages())
+        self.assertEqual(len(inner.spans), 10)
+        self.assertEqual(len(logger.warnings), 1)
+
+    @override_settings(EMAIL_SLOW_SEND_THRESHOLD=5)
+    def test_slow_send_log_shared(self):
+        self.assertTrue(get_tracer(app) is get_tracer(app))
+        self.assertEqual(get_tracer(app).threshold, 5)